@@ -9,9 +9,16 @@ imagetools = _LazyModuleLoader('aplustools.data.imagetools')
 advanced_imagetools = _LazyModuleLoader('aplustools.data.advanced_imagetools')
 compressor = _LazyModuleLoader('aplustools.data.compressor')
 unien = _LazyModuleLoader('aplustools.data.unien')
+container_index = _LazyModuleLoader('aplustools.data.container_index')
+container_bench = _LazyModuleLoader('aplustools.data.container_bench')
+bitbuffer = _LazyModuleLoader('aplustools.data.bitbuffer')
+unien_bench = _LazyModuleLoader('aplustools.data.unien_bench')
+varint = _LazyModuleLoader('aplustools.data.varint')
 
 # Define __all__ to limit what gets imported with 'from <package> import *'
-__all__ = ['database', 'updaters', 'imagetools', 'advanced_imagetools', 'compressor', 'unien']
+__all__ = ['database', 'updaters', 'imagetools', 'advanced_imagetools', 'compressor', 'unien',
+           'container_index', 'container_bench', 'bitbuffer', 'unien_bench',
+           'varint']
 
 # Dynamically add exports from _direct_functions
 from aplustools.data._direct_functions import *
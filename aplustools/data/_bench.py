@@ -0,0 +1,88 @@
+# Shared harness of the benchmark suites (container_bench, unien_bench)
+#
+# The suites only define their corpora, codecs and what one case measures, generating the corpora, timing, running
+# every combination and reporting the environment is done here, so their json reports look the same.
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Iterable, Callable, Tuple, Any
+import platform
+import random
+import time
+import json
+import sys
+import os
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def generate_corpus(corpora: Dict[str, Callable[[random.Random, int], Any]], kind: str, size: int, seed: int = 0):
+    """Returns corpora[kind] of roughly size, the same seed always gives the same corpus."""
+    if kind not in corpora:
+        raise ValueError(f"Unknown corpus '{kind}', use one of {list(corpora)}")
+    return corpora[kind](random.Random(f"{kind}-{seed}"), size)
+
+
+def timed(func: Callable, *args) -> Tuple[float, Any]:
+    """Seconds one call took and its result."""
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def best_time(func: Callable, *args, repeats: int = 3) -> Tuple[float, Any]:
+    """The fastest of repeats calls and the result of the last one."""
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        elapsed, result = timed(func, *args)
+        best = min(best, elapsed)
+    return best, result
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))]
+
+
+def peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # macOS reports bytes, Linux kilobytes
+
+
+def _run_case_safely(run_case: Callable[..., dict], keys: Tuple[str, ...], args: tuple) -> dict:
+    try:
+        return run_case(*args)
+    except Exception as e:  # One broken combination shouldn't end the whole run
+        return {**dict(zip(keys, args)), "error": f"{type(e).__name__}: {e}"}
+
+
+def run_cases(run_case: Callable[..., dict], cases: Iterable[tuple], keys: Tuple[str, ...],
+              isolate: bool = False) -> List[dict]:
+    """Calls run_case(*case) for every case, a failing case gives {key: case value, ..., "error": ...}.
+    With isolate every case runs in a fresh process, so peak_rss_kb belongs to that case alone and not to the
+    largest case before it (run_case has to be picklable for that)."""
+    results = []
+    for args in cases:
+        if isolate:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results.append(executor.submit(_run_case_safely, run_case, keys, args).result())
+        else:
+            results.append(_run_case_safely(run_case, keys, args))
+    return results
+
+
+def report(results: List[dict], output: Optional[str] = None, **settings) -> dict:
+    """Returns {"environment": ..., "results": results}, the settings of the run are part of the environment.
+    If output is given, the json is also written there."""
+    environment = {"python": platform.python_version(), "implementation": platform.python_implementation(),
+                   "platform": platform.platform(), "cpu_count": os.cpu_count(), **settings}
+    full_report = {"environment": environment, "results": results}
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(full_report, f, indent=2)
+    return full_report
@@ -2,7 +2,12 @@ from typing import Union as _Union
 import ctypes as _ctypes
 import typing as _typing
 from aplustools.package.argumint import EndPoint as _EndPoint
+from aplustools.data.bitbuffer import BitBuffer as _BitBuffer, bit_lines as _bit_lines
 import json as _json
+from itertools import islice as _islice, chain as _chain
+from collections.abc import Iterable as _Iterable
+from collections import deque as _deque
+import heapq as _heapq
 
 
 def truedivmod(__x, __y):
@@ -58,36 +63,36 @@ def decode(bytes_like: bytes, return_int: bool = False) -> _Union[int, str]:
 
 
 def bits(bytes_like: _typing.Union[bytes, bytearray], return_str: bool = False) -> _Union[list, str]:
-    bytes_like = bytes_like if isinstance(bytes_like, bytes) else bytes(bytes_like)
-    binary = "00000000" + bin(int.from_bytes(bytes_like))[2:]
-    if return_str:
-        return ''.join(list(reversed([binary[i-8:i] for i in range(len(binary), 0, -8)[:-1]])))
-    return list(reversed([binary[i-8:i] for i in range(len(binary), 0, -8)[:-1]]))
+    buffer = _BitBuffer(bytes_like)
+    return buffer.to_str() if return_str else buffer.byte_strings()
 
 
 def nice_bits(bytes_like: _typing.Union[bytes, bytearray], spaced: bool = False, wrap_count: int = 0,
               to_chars: bool = False, edge_space: bool = False) -> str:
-    bytes_like = bytes_like if isinstance(bytes_like, bytes) else bytes(bytes_like)
-    this = [""] + bits(bytes_like)
-    i = 0
-    wrap_count = wrap_count if wrap_count > 0 else len(this) - 1
-    for i in range(0, len(this), wrap_count):
-        if edge_space and i+1 < len(this):
-            this[i+1] = " " + this[i+1]
-        if i + wrap_count < len(this):
-            chars = "  " + ''.join([chr(int(x, 2)) for x in this[i+1:i+wrap_count+1] if x])
-            this[i + wrap_count] += (chars if to_chars else "") + ("\n" if i+wrap_count != len(this)-1 else "")
-            if spaced:
-                for chunk_id in range(i+1, i+wrap_count):
-                    this[chunk_id] += " "
-        else:
-            if spaced:
-                for chunk_id in range(i+1, len(this)-1):
-                    this[chunk_id] += " "
+    data = bytes(bytes_like)
+    wrap_count = wrap_count if wrap_count > 0 else max(len(data), 1)
+    prefix = " " if edge_space else ""
+    head_count = max(len(data) - 1, 0) // wrap_count * wrap_count  # Every line but the last, the last one is special
+    head = _bit_lines(data[:head_count], wrap_count, spaced, prefix, to_chars) if head_count else None
+    if head is None:
+        head, head_count = "", 0
+    data = data[head_count:]
+    buffer = _BitBuffer(data)
+    count = len(buffer) // 8
+    if spaced:
+        flat, step, padding = " ".join(buffer.byte_strings()), 9, "         "
+    else:
+        flat, step, padding = buffer.to_str(), 8, "        "
+    width = wrap_count * step - (step - 8)
     if to_chars:
-        this[-1] += ("         " if spaced else "        ")*((i + wrap_count)-len(this)+1) + "  " + ''.join([chr(int(x, 2)) for x in this[i+1:len(this)] if x])
-    binary_str = ''.join(this)
-    return binary_str  # ("00000000" + binary)[7 + (len(binary) // 8):]
+        chars = data.decode("latin-1")
+        lines = [prefix + flat[i * step:i * step + width] + padding * (i + wrap_count - count) + "  "
+                 + chars[i:i + wrap_count] for i in range(0, count, wrap_count)]
+        if count % wrap_count == 0:
+            lines[-1:] = [(lines[-1] if lines else "") + padding * wrap_count + "  "]
+    else:
+        lines = [prefix + flat[i * step:i * step + width] for i in range(0, count, wrap_count)]
+    return head + "\n".join(lines)
 
 
 def minmax(min_val, max_val, to_reduce):
@@ -203,19 +208,8 @@ def set_bits(bytes_like: _typing.Union[bytes, bytearray], start_position: int, b
              byte_order: _typing.Literal["big", "little"] = "big", return_bytearray: bool = False,
              auto_expand: bool = False):
     byte_arr = bytearray(bytes_like) if not isinstance(bytes_like, bytearray) else bytes_like
-    for i, bit in zip(range(start_position, start_position + len(bits)), [int(char) for char in bits]):
-        byte_index = i // 8
-        bit_index = i % 8 if byte_order == "little" else ((len(bytes_like) * 8) - i % 8) - 1
-        bit_index -= (((len(bytes_like) - 1) - byte_index) * 8)
-        if byte_index >= len(byte_arr) and auto_expand:
-            if byte_order == "big":
-                byte_arr.append(0)
-            else:
-                byte_arr = bytearray(1) + byte_arr
-        if bit:
-            byte_arr[byte_index] |= (1 << (bit_index - (byte_index * 8)))
-        else:
-            byte_arr[byte_index] &= ~(1 << bit_index - (byte_index * 8))
+    value = int(bits if byte_order == "big" else bits[::-1], 2) if bits else 0
+    _BitBuffer.wrap(byte_arr, byte_order).write_bits(start_position, value, len(bits), auto_expand)
     return bytes(byte_arr) if not return_bytearray else byte_arr
 
 
@@ -280,48 +274,145 @@ class UniversalBits(Bits):
         self._original = value
 
 
-def _lod_helper(curr_lod, big_lster, depth):  # Make iterative instead of recursive
-    for x in curr_lod:
-        if isinstance(x, list) and depth > 0:
-            _lod_helper(x, big_lster, depth - 1)
+_UNNESTABLE_TYPES = {str: False, bytes: False, bytearray: False, int: False, float: False, list: True, tuple: True}
+
+
+def _is_unnestable(element) -> bool:
+    element_type = type(element)
+    unnestable = _UNNESTABLE_TYPES.get(element_type)
+    if unnestable is None:  # Cached per type, the Iterable isinstance check is slow
+        unnestable = _UNNESTABLE_TYPES[element_type] = (issubclass(element_type, _Iterable)
+                                                        and not issubclass(element_type, (str, bytes, bytearray)))
+    return unnestable
+
+
+def unnest_iterable(iterable, max_depth: _typing.Optional[int] = 4,
+                    predicate: _typing.Optional[_typing.Callable[[_typing.Any], bool]] = None) -> _typing.Iterator:
+    """Lazily yields the elements of iterable with nested iterables flattened into it, up to max_depth levels deep
+    (None for no limit, which never ends on self-containing structures). By default everything iterable except str,
+    bytes and bytearray gets flattened, predicate(element) can decide that instead. Uses an explicit stack of
+    iterators, so the nesting depth isn't bound by the recursion limit."""
+    predicate = predicate or _is_unnestable
+    max_depth = float("inf") if max_depth is None else max_depth
+    stack = [iter(iterable)]
+    while stack:
+        for element in stack[-1]:
+            if len(stack) <= max_depth and predicate(element):
+                stack.append(iter(element))
+                break
+            yield element
         else:
-            big_lster.append(x)
-    return big_lster
-
-
-def unnest_iterable(iterable, max_depth: int = 4):
-    return _lod_helper(iterable, [], max_depth)
+            stack.pop()
+
+
+def _benchmark_unnest(size: int = 1_000_000, repeats: int = 3):
+    """Times unnest_iterable against itertools.chain based flattening, one level deep and arbitrarily deep."""
+    import time
+
+    def recursive_chain(iterable):
+        return _chain.from_iterable(recursive_chain(x) if isinstance(x, list) else (x,) for x in iterable)
+
+    def best_of(func):
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    shallow = [list(range(10)) for _ in range(size // 10)]
+    deep = [[[i, [i + 1, i + 2]], i + 3] for i in range(0, size, 4)]
+    cases = {
+        "shallow chain.from_iterable": lambda: sum(1 for _ in _chain.from_iterable(shallow)),
+        "shallow unnest_iterable": lambda: sum(1 for _ in unnest_iterable(shallow, 1)),
+        "deep recursive chain": lambda: sum(1 for _ in recursive_chain(deep)),
+        "deep unnest_iterable": lambda: sum(1 for _ in unnest_iterable(deep, None)),
+        "deep unnest_iterable (lists only)": lambda: sum(1 for _ in unnest_iterable(deep, None,
+                                                                                  lambda x: type(x) is list)),
+    }
+    results = {name: best_of(func) for name, func in cases.items()}
+    for name, seconds in results.items():
+        print(f"{name}: {seconds * 1e3:.1f} ms ({size / seconds / 1e6:.1f} M elements/s)")
+    return results
+
+
+def _cutoff_parts(iterable: _Union[list, tuple, dict, set], start: int, end: int):
+    """Returns (head, hidden count, tail), only the shown elements are taken out of iterable.
+    For dicts the elements are (key, value) pairs."""
+    items = iterable.items() if isinstance(iterable, dict) else iterable
+    hidden = len(iterable) - (start + end)
+    if hidden <= 0:
+        return list(items), 0, []
+    head = list(_islice(items, start))
+    if end == 0:
+        tail = []
+    elif isinstance(iterable, (list, tuple)):
+        tail = list(iterable[-end:])
+    elif isinstance(iterable, dict):
+        tail = list(_islice(reversed(items), end))[::-1]
+    else:  # Sets can't be walked backwards, but the bounded deque only ever holds the tail
+        tail = list(_deque(_islice(items, start, None), maxlen=end))
+    return head, hidden, tail
 
 
 def cutoff_iterable(iterable: _Union[list, tuple, dict, set], max_elements_start: int = 4, max_elements_end: int = 0,
-                    show_hidden_elements_num: bool = False, return_lst: bool = False):
+                    show_hidden_elements_num: bool = False, return_lst: bool = False,
+                    max_depth: _typing.Optional[int] = None, max_length: _typing.Optional[int] = None):
+    """Shows the first max_elements_start and last max_elements_end elements, without copying the rest.
+    With max_depth nested lists, tuples, sets and dicts are cut off the same way (deeper ones become "[...]"),
+    otherwise they are shown with str(). max_length caps the returned string, ending it with "..."."""
     if isinstance(iterable, tuple):
         braces = "()"
-        iterable = list(iterable)
     elif isinstance(iterable, list):
         braces = "[]"
-    elif isinstance(iterable, set):
-        braces = "{}"
-        iterable = list(iterable)
-    elif isinstance(iterable, dict):
+    elif isinstance(iterable, (set, dict)):
         braces = "{}"
-        iterable = [f"{key}: {value}" for key, value in iterable.items()]
     else:
         return f"The class '{type(iterable).__name__}' is not a supported iterable."
     max_elements_start, max_elements_end = abs(max_elements_start), abs(max_elements_end)
 
-    elements_lst = ((iterable[:max_elements_start]
-                    + (["..." if not show_hidden_elements_num else
-                        f"..[{len(iterable) - (max_elements_start + max_elements_end)}].."
-                        ] if len(iterable) > max_elements_start + max_elements_end else []))
-                    + (iterable[-max_elements_end:] if max_elements_end != 0 else []))
+    def shown(element):
+        if max_depth is None or not isinstance(element, (list, tuple, set, dict)):
+            return element if return_lst else str(element)
+        return cutoff_iterable(element, max_elements_start, max_elements_end, show_hidden_elements_num,
+                               max_depth=max_depth - 1, max_length=max_length)
 
-    return braces[0] + ', '.join(str(x) for x in elements_lst) + braces[1] if not return_lst else elements_lst
+    if max_depth is not None and max_depth < 0:
+        elements_lst = ["..."] if len(iterable) else []
+    else:
+        head, hidden, tail = _cutoff_parts(iterable, max_elements_start, max_elements_end)
+        if isinstance(iterable, dict):
+            head, tail = ([f"{key}: {shown(value)}" for key, value in part] for part in (head, tail))
+        else:
+            head, tail = ([shown(element) for element in part] for part in (head, tail))
+        elements_lst = head + (["..." if not show_hidden_elements_num else f"..[{hidden}].."]
+                               if hidden > 0 else []) + tail
+    if return_lst:
+        return elements_lst
+
+    if max_length is None:
+        return braces[0] + ', '.join(elements_lst) + braces[1]
+    parts, length = [braces[0]], 1
+    for i, element in enumerate(elements_lst):
+        parts.append(element if i == 0 else ", " + element)
+        length += len(parts[-1])
+        if length > max_length:
+            break
+    else:
+        parts.append(braces[1])
+        length += 1
+    text = ''.join(parts)
+    return text if length <= max_length else text[:max(max_length - 3, 0)] + "..."
 
 
 def cutoff_string(string: str, max_chars_start: int = 4, max_chars_end: int = 0,
                   show_hidden_chars_num: bool = False):
-    return ''.join(cutoff_iterable(list(string), max_chars_start, max_chars_end, show_hidden_chars_num, True))
+    max_chars_start, max_chars_end = abs(max_chars_start), abs(max_chars_end)
+    hidden = len(string) - (max_chars_start + max_chars_end)
+    if hidden <= 0:
+        return string
+    return (string[:max_chars_start] + ("..." if not show_hidden_chars_num else f"..[{hidden}]..")
+            + (string[-max_chars_end:] if max_chars_end != 0 else ""))
 
 
 def _custom_serializer(obj):
@@ -340,20 +431,97 @@ def _custom_serializer(obj):
         raise TypeError(f"Type {type(obj)} not serializable")
 
 
-def beautify_json(data_dict):
+def _json_preview(obj, max_elements: _typing.Optional[int], max_depth: _typing.Optional[int]):
+    """A copy of obj with only the parts beautify_json is going to show."""
+    if not isinstance(obj, (dict, list, tuple, set)):
+        return obj
+    elif max_depth is not None and max_depth < 0:
+        return f"<{type(obj).__name__} with {len(obj)} elements>"
+    elif isinstance(obj, set):
+        return cutoff_iterable(obj, max_elements if max_elements is not None else len(obj), 0, True,
+                               max_depth=max_depth)
+    next_depth = max_depth - 1 if max_depth is not None else None
+    shown = len(obj) if max_elements is None else min(len(obj), max_elements)
+    if isinstance(obj, dict):
+        keys = sorted(obj) if shown == len(obj) else _heapq.nsmallest(shown, obj)
+        preview = {key: _json_preview(obj[key], max_elements, next_depth) for key in keys}
+        if shown < len(obj):
+            preview["..."] = f"{len(obj) - shown} more elements"
+        return preview
+    preview = [_json_preview(element, max_elements, next_depth) for element in _islice(obj, shown)]
+    if shown < len(obj):
+        preview.append(f"... {len(obj) - shown} more elements")
+    return preview
+
+
+def _json_key(key) -> str:
+    """The string json.dumps turns a dict key into."""
+    if isinstance(key, str):
+        return key
+    elif key is True or key is False or key is None:
+        return _json.dumps(key)
+    elif isinstance(key, (int, float)):
+        return _json.dumps(key)
+    raise TypeError(f"keys must be str, int, float, bool or None, not {type(key).__name__}")
+
+
+def _iter_json(obj, encoder: _json.JSONEncoder, level: int = 0):
+    """The chunks of json.dumps(obj, indent=4, sort_keys=True), dict keys are sorted lazily with a heap, so only
+    taking the start of a huge dict doesn't sort all of it."""
+    if isinstance(obj, (dict, list, tuple)) and obj:
+        inner, separator = "\n" + "    " * (level + 1), None
+        yield "{" if isinstance(obj, dict) else "["
+        if isinstance(obj, dict):
+            keys = list(obj)
+            _heapq.heapify(keys)
+            while keys:
+                key = _heapq.heappop(keys)
+                yield (separator or inner) + encoder.encode(_json_key(key)) + ": "
+                yield from _iter_json(obj[key], encoder, level + 1)
+                separator = "," + inner
+        else:
+            for element in obj:
+                yield separator or inner
+                yield from _iter_json(element, encoder, level + 1)
+                separator = "," + inner
+        yield "\n" + "    " * level + ("}" if isinstance(obj, dict) else "]")
+    else:
+        yield encoder.encode(obj)
+
+
+def beautify_json(data_dict, max_elements: _typing.Optional[int] = None, max_depth: _typing.Optional[int] = None,
+                  max_length: _typing.Optional[int] = None):
     """
     Beautifies a dictionary by converting it to a pretty-printed JSON string.
 
     Args:
         data_dict (dict): The dictionary to be beautified.
+        max_elements (int, optional): Show at most this many elements of every dict, list, tuple and set.
+        max_depth (int, optional): Replace containers nested deeper than this with a short description.
+        max_length (int, optional): Stop serialising after this many characters, the result then ends with "...".
 
     Returns:
         str: The beautified JSON string.
     """
     try:
-        # Convert dictionary to a pretty-printed JSON string using custom serializer
-        pretty_json = _json.dumps(data_dict, indent=4, sort_keys=True, default=_custom_serializer)
-        return pretty_json
+        if max_elements is None and max_depth is None and max_length is None:
+            # Convert dictionary to a pretty-printed JSON string using custom serializer
+            pretty_json = _json.dumps(data_dict, indent=4, sort_keys=True, default=_custom_serializer)
+            return pretty_json
+        if max_elements is None and max_depth is None:  # Only max_length, serialise lazily and stop early
+            chunks = _iter_json(data_dict, _json.JSONEncoder(default=_custom_serializer))
+        else:
+            preview = _json_preview(data_dict, max_elements, max_depth)
+            chunks = _json.JSONEncoder(indent=4, default=_custom_serializer).iterencode(preview)
+        if max_length is None:
+            return ''.join(chunks)
+        parts, length = [], 0
+        for chunk in chunks:
+            parts.append(chunk)
+            length += len(chunk)
+            if length > max_length:
+                return ''.join(parts)[:max(max_length - 3, 0)] + "..."
+        return ''.join(parts)
     except (TypeError, ValueError) as e:
         return f"Error converting dictionary to JSON: {e}"
 
@@ -406,3 +574,6 @@ if __name__ == "__main__":
         bits(encode_positive_int(_))
         timer.tock(1)
     print(timer.average(1))
+
+    print(list(unnest_iterable([1, [2, (3, [4])], "56"], max_depth=None)))
+    _benchmark_unnest()
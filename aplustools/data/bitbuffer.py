@@ -0,0 +1,322 @@
+# Bit level engine behind bits, nice_bits and set_bits
+#
+# A BitBuffer is a bytearray plus a bit length. Bit ranges are read and written by converting only the bytes they
+# touch into a Python int, so no operation ever loops over single bits in Python.
+# For bit_order "big" position 0 is the most significant bit of the first byte (the buffer is a big-endian number),
+# for "little" it's the least significant bit of the first byte (the buffer is a little-endian number).
+
+from typing import Union, Literal, Optional, List
+import time
+import os
+
+
+_BYTE_BITS = tuple(format(byte, "08b") for byte in range(256))
+_NUMPY_MIN_BITS = 1 << 16  # From here on to_str and bit_lines let NumPy unpack the bits if it's installed
+
+
+def _numpy():
+    import numpy  # Optional, only needed for the bit array conversions
+    return numpy
+
+
+class BitBuffer:
+    __slots__ = ("_data", "_length", "bit_order")
+
+    def __init__(self, data: Union[bytes, bytearray, memoryview] = b"", bit_length: Optional[int] = None,
+                 bit_order: Literal["big", "little"] = "big"):
+        if bit_order not in ("big", "little"):
+            raise ValueError(f"Invalid bit order '{bit_order}'")
+        self._data = bytearray(data)
+        self._length = len(self._data) * 8 if bit_length is None else bit_length
+        if not 0 <= self._length <= len(self._data) * 8:
+            raise ValueError(f"Bit length {bit_length} doesn't fit into {len(self._data)} bytes")
+        self.bit_order = bit_order
+
+    @classmethod
+    def wrap(cls, data: bytearray, bit_order: Literal["big", "little"] = "big") -> "BitBuffer":
+        """Works on data in place instead of on a copy."""
+        buffer = cls(b"", bit_order=bit_order)
+        buffer._data = data
+        buffer._length = len(data) * 8
+        return buffer
+
+    @classmethod
+    def from_str(cls, bit_str: str, bit_order: Literal["big", "little"] = "big") -> "BitBuffer":
+        """From a string of '0' and '1', the first character ends up at position 0."""
+        buffer = cls(b"", bit_order=bit_order)
+        buffer.append_str(bit_str)
+        return buffer
+
+    @classmethod
+    def from_bit_array(cls, bit_array, bit_order: Literal["big", "little"] = "big") -> "BitBuffer":
+        """From a NumPy array of 0/1 values, needs NumPy."""
+        numpy = _numpy()
+        bit_array = numpy.asarray(bit_array, dtype=numpy.uint8)
+        return cls(numpy.packbits(bit_array, bitorder=bit_order).tobytes(), len(bit_array), bit_order)
+
+    def to_bit_array(self):
+        """A NumPy uint8 array with one 0/1 value per bit, needs NumPy."""
+        numpy = _numpy()
+        return numpy.unpackbits(numpy.frombuffer(bytes(self._data), dtype=numpy.uint8), count=self._length,
+                                bitorder=self.bit_order)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def _check_range(self, position: int, count: int):
+        if position < 0 or count < 0:
+            raise IndexError(f"Invalid bit range {position}:{position + count}")
+
+    def read_bits(self, position: int, count: int) -> int:
+        """Returns count bits from position as an int, the bit at position is the most significant one for "big" and
+        the least significant one for "little"."""
+        self._check_range(position, count)
+        if position + count > self._length:
+            raise IndexError(f"Bit range {position}:{position + count} is out of range ({self._length} bits)")
+        if count == 0:
+            return 0
+        first_byte, end_byte = position // 8, (position + count + 7) // 8
+        if self.bit_order == "big":
+            value = int.from_bytes(self._data[first_byte:end_byte], "big")
+            return (value >> (end_byte * 8 - position - count)) & ((1 << count) - 1)
+        value = int.from_bytes(self._data[first_byte:end_byte], "little")
+        return (value >> (position - first_byte * 8)) & ((1 << count) - 1)
+
+    def write_bits(self, position: int, value: int, count: int, auto_expand: bool = True):
+        """Overwrites count bits from position with value (in the same order read_bits returns them).
+        Writing past the end grows the buffer if auto_expand is set."""
+        self._check_range(position, count)
+        if value < 0 or value.bit_length() > count:
+            raise ValueError(f"{value} doesn't fit into {count} bits")
+        end = position + count
+        if end > len(self._data) * 8:
+            if not auto_expand:
+                raise IndexError(f"Bit range {position}:{end} is out of range ({len(self._data) * 8} bits)")
+            self._data.extend(bytes((end + 7) // 8 - len(self._data)))
+        self._length = max(self._length, end)
+        if count == 0:
+            return
+
+        first_byte, end_byte = position // 8, (end + 7) // 8
+        mask = (1 << count) - 1
+        shift = end_byte * 8 - end if self.bit_order == "big" else position - first_byte * 8
+        current = int.from_bytes(self._data[first_byte:end_byte], self.bit_order)
+        current = (current & ~(mask << shift)) | (value << shift)
+        self._data[first_byte:end_byte] = current.to_bytes(end_byte - first_byte, self.bit_order)
+
+    def append(self, value: int, count: int):
+        self.write_bits(self._length, value, count)
+
+    def append_str(self, bit_str: str):
+        value = int(bit_str if self.bit_order == "big" else bit_str[::-1], 2) if bit_str else 0
+        self.append(value, len(bit_str))
+
+    def extend(self, other: "BitBuffer"):
+        self.append_str(other.to_str()) if other.bit_order != self.bit_order else self.append(
+            other.read_bits(0, len(other)), len(other))
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[int, "BitBuffer"]:
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._length)
+            if step != 1:
+                return BitBuffer.from_str(self.to_str()[item], self.bit_order)
+            count = max(0, stop - start)
+            buffer = BitBuffer(b"", bit_order=self.bit_order)
+            buffer.append(self.read_bits(start, count), count)
+            return buffer
+        if item < 0:
+            item += self._length
+        return self.read_bits(item, 1)
+
+    def __setitem__(self, item: int, bit: int):
+        if item < 0:
+            item += self._length
+        if not 0 <= item < self._length:
+            raise IndexError(f"Bit {item} is out of range ({self._length} bits)")
+        self.write_bits(item, bit, 1)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, BitBuffer):
+            return NotImplemented
+        return len(self) == len(other) and self.to_str() == other.to_str()
+
+    def to_bytes(self) -> bytes:
+        """The bits packed into bytes, the unused bits of the last byte are zero."""
+        return bytes(self._data[:(self._length + 7) // 8])
+
+    def to_str(self) -> str:
+        """The bits as '0' and '1', position 0 first."""
+        if self._length == 0:
+            return ""
+        if self._length >= _NUMPY_MIN_BITS:
+            try:
+                return (self.to_bit_array() + ord("0")).tobytes().decode("ascii")
+            except ImportError:
+                pass
+        if self.bit_order == "big":
+            used_bytes = (self._length + 7) // 8
+            value = int.from_bytes(self._data[:used_bytes], "big") >> (used_bytes * 8 - self._length)
+            return format(value, f"0{self._length}b")
+        value = int.from_bytes(self._data, "little") & ((1 << self._length) - 1)
+        return format(value, f"0{self._length}b")[::-1]
+
+    def byte_strings(self) -> List[str]:
+        """Every byte as an 8 character string of its bits, most significant first."""
+        return [_BYTE_BITS[byte] for byte in self._data[:(self._length + 7) // 8]]
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}('{self.to_str()}', bit_order='{self.bit_order}')"
+
+
+def bit_lines(data: bytes, wrap_count: int, spaced: bool = False, prefix: str = "", to_chars: bool = False
+              ) -> Optional[str]:
+    """The lines of nice_bits for data, which has to fill every line, each ends with a newline. Built as one NumPy
+    uint8 matrix with a row per line, None if NumPy isn't installed or data is too short for it to pay off."""
+    if len(data) * 8 < _NUMPY_MIN_BITS:
+        return None
+    try:
+        numpy = _numpy()
+    except ImportError:
+        return None
+    rows = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, wrap_count)
+    cell = 9 if spaced else 8
+    bits_end = len(prefix) + wrap_count * cell - (cell - 8)
+    lines = numpy.empty((len(rows), bits_end + (2 + wrap_count if to_chars else 0) + 1), dtype=numpy.uint8)
+    if prefix:
+        lines[:, 0] = ord(prefix)
+    # With spaced, the space after the last byte is overwritten by whatever follows the bits
+    cells = lines[:, len(prefix):len(prefix) + wrap_count * cell].reshape(len(rows), wrap_count, cell)
+    numpy.add(numpy.unpackbits(rows, axis=1).reshape(len(rows), wrap_count, 8), ord("0"), out=cells[:, :, :8])
+    if spaced:
+        cells[:, :, 8] = ord(" ")
+    if to_chars:
+        lines[:, bits_end:bits_end + 2] = ord(" ")
+        lines[:, bits_end + 2:-1] = rows
+    lines[:, -1] = ord("\n")
+    return lines.tobytes().decode("latin-1")
+
+
+def _string_bits(bytes_like: bytes, return_str: bool = False) -> Union[List[str], str]:
+    """The string based bits() BitBuffer replaced, kept as the benchmark baseline."""
+    bytes_like = bytes_like if isinstance(bytes_like, bytes) else bytes(bytes_like)
+    binary = "00000000" + bin(int.from_bytes(bytes_like, "big"))[2:]
+    if return_str:
+        return ''.join(list(reversed([binary[i-8:i] for i in range(len(binary), 0, -8)[:-1]])))
+    return list(reversed([binary[i-8:i] for i in range(len(binary), 0, -8)[:-1]]))
+
+
+def _string_set_bits(bytes_like: bytes, start_position: int, bits: str,
+                     byte_order: Literal["big", "little"] = "big", return_bytearray: bool = False,
+                     auto_expand: bool = False):
+    """The per bit set_bits BitBuffer replaced, kept as the benchmark baseline."""
+    byte_arr = bytearray(bytes_like) if not isinstance(bytes_like, bytearray) else bytes_like
+    for i, bit in zip(range(start_position, start_position + len(bits)), [int(char) for char in bits]):
+        byte_index = i // 8
+        bit_index = i % 8 if byte_order == "little" else ((len(bytes_like) * 8) - i % 8) - 1
+        bit_index -= (((len(bytes_like) - 1) - byte_index) * 8)
+        if byte_index >= len(byte_arr) and auto_expand:
+            if byte_order == "big":
+                byte_arr.append(0)
+            else:
+                byte_arr = bytearray(1) + byte_arr
+        if bit:
+            byte_arr[byte_index] |= (1 << (bit_index - (byte_index * 8)))
+        else:
+            byte_arr[byte_index] &= ~(1 << bit_index - (byte_index * 8))
+    return bytes(byte_arr) if not return_bytearray else byte_arr
+
+
+def _string_nice_bits(bytes_like: bytes, spaced: bool = False, wrap_count: int = 0, to_chars: bool = False,
+                      edge_space: bool = False) -> str:
+    """The nice_bits built on the string based bits(), kept as the benchmark baseline."""
+    bytes_like = bytes_like if isinstance(bytes_like, bytes) else bytes(bytes_like)
+    this = [""] + _string_bits(bytes_like)
+    i = 0
+    wrap_count = wrap_count if wrap_count > 0 else len(this) - 1
+    for i in range(0, len(this), wrap_count):
+        if edge_space and i+1 < len(this):
+            this[i+1] = " " + this[i+1]
+        if i + wrap_count < len(this):
+            chars = "  " + ''.join([chr(int(x, 2)) for x in this[i+1:i+wrap_count+1] if x])
+            this[i + wrap_count] += (chars if to_chars else "") + ("\n" if i+wrap_count != len(this)-1 else "")
+            if spaced:
+                for chunk_id in range(i+1, i+wrap_count):
+                    this[chunk_id] += " "
+        else:
+            if spaced:
+                for chunk_id in range(i+1, len(this)-1):
+                    this[chunk_id] += " "
+    if to_chars:
+        this[-1] += ("         " if spaced else "        ")*((i + wrap_count)-len(this)+1) + "  " + ''.join([chr(int(x, 2)) for x in this[i+1:len(this)] if x])
+    binary_str = ''.join(this)
+    return binary_str
+
+
+def benchmark(size: int = 1024 * 1024, repeats: int = 3) -> dict:
+    """Times the string based implementations against BitBuffer on size random bytes and prints the speedups.
+    On 1 MB, with NumPy, bits_str, nice_bits and nice_bits_chars are 24x to 34x faster, set_bits and read_bits
+    about 200x. The list form of bits() stays at 7x to 10x, short of 20x. A Python loop over the bytes alone takes
+    about 17 ms of its 25 to 40 ms. Without NumPy, bits_str and the nice_bits cases are 8x to 11x faster."""
+    from aplustools.data._direct_functions import bits, set_bits, nice_bits
+    data = os.urandom(size)
+    bit_str = "10" * (size * 4 - 2)
+
+    def best_of(func) -> float:
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    cases = {
+        "bits": (lambda: _string_bits(data), lambda: bits(data)),
+        "bits_str": (lambda: _string_bits(data, True), lambda: bits(data, True)),
+        "nice_bits": (lambda: _string_nice_bits(data, True, 16), lambda: nice_bits(data, True, 16)),
+        "nice_bits_chars": (lambda: _string_nice_bits(data, False, 16, True), lambda: nice_bits(data, False, 16, True)),
+        "set_bits": (lambda: _string_set_bits(data, 3, bit_str), lambda: set_bits(data, 3, bit_str)),
+        "read_bits": (lambda: int(_string_bits(data, True)[3:3 + size * 4], 2),
+                      lambda: BitBuffer(data).read_bits(3, size * 4)),
+    }
+    results = {}
+    for name, (string_based, bit_buffer) in cases.items():
+        string_time, buffer_time = best_of(string_based), best_of(bit_buffer)
+        results[name] = {"string_s": string_time, "bitbuffer_s": buffer_time, "speedup": string_time / buffer_time}
+        print(f"{name}: {string_time * 1e3:.2f} ms -> {buffer_time * 1e3:.2f} ms ({string_time / buffer_time:.1f}x)")
+    return results
+
+
+def local_test():
+    try:
+        from aplustools.data import _direct_functions
+        for bit_order in ("big", "little"):
+            buffer = BitBuffer(b"", bit_order=bit_order)
+            buffer.append(0b101, 3)
+            buffer.append_str("0110")
+            buffer.append(0xABCD, 16)
+            if len(buffer) != 23 or buffer.read_bits(7, 16) != 0xABCD or buffer[:3].read_bits(0, 3) != 0b101:
+                raise ValueError(f"BitBuffer ({bit_order}) read back wrong bits: {buffer}")
+            buffer.write_bits(1, 0, 1)
+            buffer[0] = 0
+            if BitBuffer.from_str(buffer.to_str(), bit_order) != buffer or buffer.read_bits(0, 2) != 0:
+                raise ValueError(f"BitBuffer ({bit_order}) string round trip failed: {buffer}")
+        if (BitBuffer(b"\x0f\x80").to_str() != "0000111110000000"
+                or BitBuffer(b"\x01", bit_order="little").to_str() != "10000000"):
+            raise ValueError("BitBuffer uses the wrong bit order")
+        large = BitBuffer(os.urandom(16 * 1024), 16 * 1024 * 8 - 3)
+        if large.to_str() != "".join(large.byte_strings())[:len(large)]:
+            raise ValueError("BitBuffer.to_str differs for large buffers")
+        data = os.urandom(16 * 1024 + 5)  # NumPy builds all but the last line, if it's installed
+        for arguments in ((True, 16), (False, 7, True, True), (True, 0)):
+            if _direct_functions.nice_bits(data, *arguments) != _string_nice_bits(data, *arguments):
+                raise ValueError(f"nice_bits{arguments} differs from the string based version")
+        benchmark(64 * 1024, 1)
+    except Exception as e:
+        print(f"Exception occurred {e}.")
+        return False
+    print("Test completed successfully.")
+    return True
+
+
+if __name__ == "__main__":
+    local_test()
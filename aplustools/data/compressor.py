@@ -1,17 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, Counter, deque
+import hashlib
 import lzma
 import brotli
+import threading
 import json
+import mmap
+import math
 import os
 import zstandard as zstd
 import py7zr
+import tempfile
+import struct
+import time
 import io
-from typing import Type, Union, Tuple
+from typing import Type, Union, Tuple, BinaryIO, Iterable, List, Optional, Callable, Literal, Sequence
+from aplustools.data.container_index import (ContainerIndex, JsonContainerIndex, build_binary_index,
+                                             load_container_index, checksum, DEFAULT_CHECKSUM)
+
+
+# A container whose first 4 bytes (the index length) are zero was streamed, its index sits at the end and is located
+# through this footer: absolute index offset, compressed index length, magic.
+_STREAM_MAGIC = b"APF1"
+_STREAM_FOOTER = struct.Struct(">QI4s")
+# If the compressor needs a header (e.g. a trained dictionary) it is stored after the index and the footer also holds
+# its absolute offset and length.
+_HEADER_STREAM_MAGIC = b"APF2"
+_HEADER_STREAM_FOOTER = struct.Struct(">QIQI4s")
+
+
+def _pack_tail(index_offset: int, compressed_index_data: bytes, compressor_header: bytes) -> bytes:
+    """Returns the index, the compressor header and the footer that end a streamed container."""
+    if not compressor_header:
+        return compressed_index_data + _STREAM_FOOTER.pack(index_offset, len(compressed_index_data), _STREAM_MAGIC)
+    return (compressed_index_data + compressor_header
+            + _HEADER_STREAM_FOOTER.pack(index_offset, len(compressed_index_data),
+                                         index_offset + len(compressed_index_data), len(compressor_header),
+                                         _HEADER_STREAM_MAGIC))
+
+
+def _unpack_tail(compressed_container: bytes) -> Tuple[int, int, bytes]:
+    """Reads the footer of a streamed container, returns the index offset, its length and the compressor header."""
+    magic = bytes(compressed_container[-4:])
+    if magic == _STREAM_MAGIC:
+        index_offset, index_length, _ = _STREAM_FOOTER.unpack(compressed_container[-_STREAM_FOOTER.size:])
+        return index_offset, index_length, b""
+    elif magic == _HEADER_STREAM_MAGIC:
+        index_offset, index_length, header_offset, header_length, _ = _HEADER_STREAM_FOOTER.unpack(
+            compressed_container[-_HEADER_STREAM_FOOTER.size:])
+        return index_offset, index_length, bytes(compressed_container[header_offset:header_offset + header_length])
+    raise ValueError("Container is neither a normal nor a streamed FileContainerV3.")
+
+
+class _BlockCompressionPool:
+    """Compresses sealed blocks on a thread or process pool and hands the results back in submission order.
+    At most max_in_flight blocks are queued, so memory stays bounded by a few blocks."""
+    def __init__(self, compress: Callable[[bytes], bytes], workers: int, use_processes: bool = False,
+                 max_in_flight: Optional[int] = None):
+        self._executor = (ProcessPoolExecutor if use_processes else ThreadPoolExecutor)(max_workers=workers)
+        self._compress = compress
+        self._max_in_flight = max_in_flight or workers * 2
+        self._in_flight = deque()
+
+    def submit(self, block: bytes) -> List[bytes]:
+        """Queues a block and returns every compressed block that is ready, oldest first."""
+        self._in_flight.append(self._executor.submit(self._compress, bytes(block)))
+        ready = []
+        while self._in_flight and (len(self._in_flight) > self._max_in_flight or self._in_flight[0].done()):
+            ready.append(self._in_flight.popleft().result())
+        return ready
+
+    def drain(self) -> List[bytes]:
+        """Waits for all queued blocks and shuts the pool down."""
+        ready = [future.result() for future in self._in_flight]
+        self._in_flight.clear()
+        self._executor.shutdown()
+        return ready
+
+
+def content_digest(data: bytes) -> bytes:
+    """Identifies file or chunk contents for deduplication."""
+    return hashlib.blake2b(data, digest_size=20).digest()
+
+
+def _gear_table() -> Tuple[int, ...]:
+    return tuple(int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=8).digest(), "little") for i in range(256))
+
+
+_GEAR = _gear_table()
+
+
+def content_defined_chunks(data: bytes, min_size: int = 2 * 1024, average_size: int = 8 * 1024,
+                           max_size: int = 64 * 1024) -> List[Tuple[int, int]]:
+    """Splits data into (start, end) chunks with a gear rolling hash (like FastCDC). Boundaries depend on the
+    content around them, not on the position, so an insertion only changes the chunks next to it and all
+    others still deduplicate. average_size has to be a power of two."""
+    bits = average_size.bit_length() - 1
+    mask = ((1 << bits) - 1) << (64 - bits)  # The top bits of a gear hash depend on the most bytes
+    gear = _GEAR
+    chunks = []
+    start = 0
+    length = len(data)
+    while start < length:
+        end = min(start + max_size, length)
+        position = start + min_size  # Nothing before min_size can be a boundary, so the hash is not needed there
+        rolling_hash = 0
+        while position < end:
+            rolling_hash = ((rolling_hash << 1) + gear[data[position]]) & 0xFFFFFFFFFFFFFFFF
+            position += 1
+            if not rolling_hash & mask:
+                end = position
+                break
+        chunks.append((start, min(end, length)))
+        start = chunks[-1][1]
+    return chunks
+
+
+def _check_block(index: ContainerIndex, block_index: int, compressed_block: bytes):
+    expected = index.block_checksum(block_index)
+    if expected is not None and checksum(compressed_block, index.checksum_algorithm) != expected:
+        raise ValueError(f"Block {block_index} is corrupt, its checksum doesn't match.")
+
+
+def _check_file(index: ContainerIndex, file_index: int, data: bytes):
+    expected = index.file_checksum(file_index)
+    if expected is not None and checksum(data, index.checksum_algorithm) != expected:
+        raise ValueError(f"File '{index.name(file_index)}' is corrupt, its checksum doesn't match.")
 
 
 class FileContainer:
-    def __init__(self, compressor: "ChunkCompressorBase", block_size: int = 1024 * 1024):  # Block size of 1 MB
+    def __init__(self, compressor: "ChunkCompressorBase", block_size: int = 1024 * 1024,  # Block size of 1 MB
+                 workers: int = 0, use_processes: bool = False):
         self.compressor = compressor
         self.block_size = block_size
+        self.workers = workers  # More than one compresses sealed blocks in parallel
+        self.use_processes = use_processes  # Only needed for compressors that hold the GIL, must be picklable
+        self._pool: Optional[_BlockCompressionPool] = None
+        self._sealed_blocks = 0
         self.current_block = bytearray()
         self.compressed_data = bytearray()
         self.files = {}
@@ -19,17 +144,34 @@ class FileContainer:
 
     def _compress_current_block(self):
         if self.current_block:
-            compressed_block = self.compressor.compress(self.current_block)
-            self.block_offsets.append({'start': len(self.compressed_data), 'length': len(compressed_block)})
-            self.compressed_data.extend(compressed_block)
+            if self.workers > 1:
+                if self._pool is None:
+                    self._pool = _BlockCompressionPool(self.compressor.compress, self.workers, self.use_processes)
+                for compressed_block in self._pool.submit(self.current_block):
+                    self._store_block(compressed_block)
+            else:
+                self._store_block(self.compressor.compress(self.current_block))
+            self._sealed_blocks += 1
             self.current_block = bytearray()
 
+    def _flush_blocks(self):
+        """Compresses any remaining data in the current block and waits for the pool."""
+        self._compress_current_block()
+        if self._pool is not None:
+            for compressed_block in self._pool.drain():
+                self._store_block(compressed_block)
+            self._pool = None
+
+    def _store_block(self, compressed_block: bytes):
+        self.block_offsets.append({'start': len(self.compressed_data), 'length': len(compressed_block)})
+        self.compressed_data.extend(compressed_block)
+
     def add_file(self, filename: str, data: bytes):
         if len(self.current_block) + len(data) > self.block_size:
             self._compress_current_block()
 
         file_info = {
-            'block_index': len(self.block_offsets),
+            'block_index': self._sealed_blocks,
             'start': len(self.current_block),
             'length': len(data)
         }
@@ -40,7 +182,7 @@ class FileContainer:
             self._compress_current_block()
 
     def get_compressed_container(self) -> bytes:
-        self._compress_current_block()  # Compress any remaining data in the current block
+        self._flush_blocks()  # Compress any remaining data in the current block
         index_data = json.dumps({'files': self.files, 'blocks': self.block_offsets}).encode()
         index_length = len(index_data).to_bytes(4, 'big')
         return index_length + index_data + self.compressed_data
@@ -66,9 +208,14 @@ class FileContainer:
 
 
 class FileContainerV2:
-    def __init__(self, compressor: "ChunkCompressorBase", block_size: int = 1024 * 1024):  # Block size of 1 MB
+    def __init__(self, compressor: "ChunkCompressorBase", block_size: int = 1024 * 1024,  # Block size of 1 MB
+                 workers: int = 0, use_processes: bool = False):
         self.compressor = compressor
         self.block_size = block_size
+        self.workers = workers  # More than one compresses sealed blocks in parallel
+        self.use_processes = use_processes  # Only needed for compressors that hold the GIL, must be picklable
+        self._pool: Optional[_BlockCompressionPool] = None
+        self._sealed_blocks = 0
         self.current_block = bytearray()
         self.compressed_data = bytearray()
         self.file_info = {}  # Stores info about files by filename
@@ -77,11 +224,28 @@ class FileContainerV2:
 
     def _compress_current_block(self):
         if self.current_block:
-            compressed_block = self.compressor.compress(self.current_block)
-            self.block_offsets.append({'start': len(self.compressed_data), 'length': len(compressed_block)})
-            self.compressed_data.extend(compressed_block)
+            if self.workers > 1:
+                if self._pool is None:
+                    self._pool = _BlockCompressionPool(self.compressor.compress, self.workers, self.use_processes)
+                for compressed_block in self._pool.submit(self.current_block):
+                    self._store_block(compressed_block)
+            else:
+                self._store_block(self.compressor.compress(self.current_block))
+            self._sealed_blocks += 1
             self.current_block = bytearray()
 
+    def _flush_blocks(self):
+        """Compresses any remaining data in the current block and waits for the pool."""
+        self._compress_current_block()
+        if self._pool is not None:
+            for compressed_block in self._pool.drain():
+                self._store_block(compressed_block)
+            self._pool = None
+
+    def _store_block(self, compressed_block: bytes):
+        self.block_offsets.append({'start': len(self.compressed_data), 'length': len(compressed_block)})
+        self.compressed_data.extend(compressed_block)
+
     def add_file(self, filename: str, data: bytes) -> int:
         if len(self.current_block) + len(data) > self.block_size:
             self._compress_current_block()
@@ -90,7 +254,7 @@ class FileContainerV2:
         self.index_to_name.append(filename)
         self.file_info[filename] = {
             'index': file_index,
-            'block_index': len(self.block_offsets),
+            'block_index': self._sealed_blocks,
             'start': len(self.current_block),
             'length': len(data)
         }
@@ -102,7 +266,7 @@ class FileContainerV2:
         return file_index
 
     def get_compressed_container(self) -> bytes:
-        self._compress_current_block()  # Compress any remaining data in the current block
+        self._flush_blocks()  # Compress any remaining data in the current block
         index_data = json.dumps({'file_info': self.file_info, 'block_offsets': self.block_offsets, 'index_to_name': self.index_to_name}).encode()
         index_length = len(index_data).to_bytes(4, 'big')
         return index_length + index_data + self.compressed_data
@@ -128,9 +292,26 @@ class FileContainerV2:
 
 
 class FileContainerV3:
-    def __init__(self, compressor: "ChunkCompressorBase", block_size: int = 1024 * 1024):  # Block size of 1 MB
+    def __init__(self, compressor: "ChunkCompressorBase", block_size: int = 1024 * 1024,  # Block size of 1 MB
+                 workers: int = 0, use_processes: bool = False, index_format: Literal["json", "binary"] = "json",
+                 training_sample_size: int = 1024 * 1024, dedup: bool = False,
+                 checksum_algorithm: Optional[str] = DEFAULT_CHECKSUM):
         self.compressor = compressor
         self.block_size = block_size
+        self.index_format = index_format  # Binary indexes open much faster for many files
+        self.workers = workers  # More than one compresses sealed blocks in parallel
+        self.use_processes = use_processes  # Only needed for compressors that hold the GIL, must be picklable
+        self.training_sample_size = training_sample_size  # Bytes of added files a trainable compressor learns from
+        self.dedup = dedup  # Files with the same content are stored once and share their location in the index
+        self._content_locations = {}  # Content digest -> (block index, start, checksum)
+        if checksum_algorithm is not None:
+            checksum(b"", checksum_algorithm)  # Fail now and not when the container is written
+        self.checksum_algorithm = checksum_algorithm  # Checksums of every block and file, None stores none
+        self._pool: Optional[_BlockCompressionPool] = None
+        self._sealed_blocks = 0
+        self._held_blocks = []  # Sealed blocks waiting for the compressor to be trained
+        self._samples = []
+        self._sample_bytes = 0
         self.current_block = bytearray()
         self.compressed_data = bytearray()
         self.file_info = {}  # Stores info about files by filename
@@ -139,74 +320,364 @@ class FileContainerV3:
 
     def _compress_current_block(self):
         if self.current_block:
-            compressed_block = self.compressor.compress(self.current_block)
-            self.block_offsets.append({'start': len(self.compressed_data), 'length': len(compressed_block)})
-            self.compressed_data.extend(compressed_block)
+            self._held_blocks.append(self.current_block)
+            self._sealed_blocks += 1
             self.current_block = bytearray()
+            if not self.compressor.needs_training or self._sample_bytes >= self.training_sample_size:
+                self._release_held_blocks()
+
+    def _release_held_blocks(self):
+        if self.compressor.needs_training:
+            self.compressor.train(self._samples)
+        self._samples, self._sample_bytes = [], 0
+
+        for block in self._held_blocks:
+            if self.workers > 1:
+                if self._pool is None:
+                    self._pool = _BlockCompressionPool(self.compressor.compress, self.workers, self.use_processes)
+                for compressed_block in self._pool.submit(block):
+                    self._store_block(compressed_block)
+            else:
+                self._store_block(self.compressor.compress(block))
+        self._held_blocks = []
+
+    def _flush_blocks(self):
+        """Compresses any remaining data in the current block and waits for the pool."""
+        self._compress_current_block()
+        self._release_held_blocks()
+        if self._pool is not None:
+            for compressed_block in self._pool.drain():
+                self._store_block(compressed_block)
+            self._pool = None
+
+    def _block_entry(self, start: int, compressed_block: bytes) -> dict:
+        block_info = {'start': start, 'length': len(compressed_block)}
+        if self.checksum_algorithm is not None:
+            block_info['checksum'] = checksum(compressed_block, self.checksum_algorithm)
+        return block_info
+
+    def _store_block(self, compressed_block: bytes):
+        self.block_offsets.append(self._block_entry(len(self.compressed_data), compressed_block))
+        self.compressed_data.extend(compressed_block)
 
     def add_file(self, filename: str, data: bytes) -> int:
+        if self.dedup:
+            digest = content_digest(data)
+            if digest in self._content_locations:
+                block_index, start, file_checksum = self._content_locations[digest]
+                return self._add_entry(filename, block_index, start, len(data), file_checksum)
+
         if len(self.current_block) + len(data) > self.block_size:
             self._compress_current_block()
+        if self.compressor.needs_training and self._sample_bytes < self.training_sample_size:
+            self._samples.append(bytes(data))
+            self._sample_bytes += len(data)
+
+        file_checksum = checksum(data, self.checksum_algorithm) if self.checksum_algorithm is not None else None
+        if self.dedup:
+            self._content_locations[digest] = (self._sealed_blocks, len(self.current_block), file_checksum)
+        file_index = self._add_entry(filename, self._sealed_blocks, len(self.current_block), len(data), file_checksum)
+        self.current_block.extend(data)
+
+        if len(self.current_block) >= self.block_size:
+            self._compress_current_block()
+
+        return file_index
 
+    def _add_entry(self, filename: str, block_index: int, start: int, length: int,
+                   file_checksum: Optional[int] = None) -> int:
         file_index = len(self.index_to_name)
         self.index_to_name.append(filename)
         self.file_info[filename] = {
             'index': file_index,
-            'block_index': len(self.block_offsets),
-            'start': len(self.current_block),
-            'length': len(data)
+            'block_index': block_index,
+            'start': start,
+            'length': length
         }
-        self.current_block.extend(data)
-
-        if len(self.current_block) >= self.block_size:
-            self._compress_current_block()
-
+        if file_checksum is not None:
+            self.file_info[filename]['checksum'] = file_checksum
         return file_index
 
+    def _build_index(self) -> bytes:
+        if self.index_format == "binary":
+            return build_binary_index(self.file_info, self.index_to_name, self.block_offsets, self.checksum_algorithm)
+        index = {'file_info': self.file_info, 'block_offsets': self.block_offsets, 'index_to_name': self.index_to_name}
+        if self.checksum_algorithm is not None:
+            index['checksum_algorithm'] = self.checksum_algorithm
+        return json.dumps(index).encode()
+
     def get_compressed_container(self) -> bytes:
-        self._compress_current_block()  # Compress any remaining data in the current block
-        index_data = json.dumps({'file_info': self.file_info, 'block_offsets': self.block_offsets, 'index_to_name': self.index_to_name}).encode()
-        compressed_index_data = self.compressor.compress(index_data)
+        self._flush_blocks()  # Compress any remaining data in the current block
+        compressed_index_data = self.compressor.compress(self._build_index())
+        compressor_header = self.compressor.get_header()
+        if compressor_header:  # Only the streamed layout has room for it
+            return bytes(4) + self.compressed_data + _pack_tail(4 + len(self.compressed_data), compressed_index_data,
+                                                                compressor_header)
         index_length = len(compressed_index_data).to_bytes(4, 'big')
         return index_length + compressed_index_data + self.compressed_data
 
-    def extract_file(self, compressed_container: bytes, file_identifier: Union[str, int]) -> bytes:
+    def _read_index(self, compressed_container: bytes) -> Tuple[ContainerIndex, int]:
+        """Returns the parsed index and the offset the block data starts at, for both the normal and the streamed
+        (footer) layout."""
         compressed_index_length = int.from_bytes(compressed_container[:4], 'big')
-        compressed_index_data = compressed_container[4:4 + compressed_index_length]
+        if compressed_index_length == 0:
+            index_offset, compressed_index_length, compressor_header = _unpack_tail(compressed_container)
+            self.compressor.load_header(compressor_header)
+            data_offset = 4
+        else:
+            index_offset = 4
+            data_offset = 4 + compressed_index_length
+        compressed_index_data = compressed_container[index_offset:index_offset + compressed_index_length]
         index_data = self.compressor.decompress(compressed_index_data)
-        index = json.loads(index_data)
+        return load_container_index(index_data), data_offset
 
-        filename = file_identifier if isinstance(file_identifier, str) else index['index_to_name'][file_identifier]
-        file_info = index['file_info'][filename]
-        block_info = index['block_offsets'][file_info['block_index']]
+    def extract_file(self, compressed_container: bytes, file_identifier: Union[str, int], verify: bool = False) -> bytes:
+        """With verify, the block and the file are checked against their checksums (if the container has them)."""
+        index, data_offset = self._read_index(compressed_container)
 
-        start_block = block_info['start']
-        length_block = block_info['length']
-        compressed_block = compressed_container[4 + compressed_index_length + start_block:4 + compressed_index_length + start_block + length_block]
+        file_index = index.lookup(file_identifier)
+        block_index, start_file, length_file = index.file_entry(file_index)
+        start_block, length_block = index.block_entry(block_index)
+        compressed_block = compressed_container[data_offset + start_block:data_offset + start_block + length_block]
+        if verify:
+            _check_block(index, block_index, compressed_block)
 
         decompressed_block = self.compressor.decompress(compressed_block)
-
-        start_file = file_info['start']
-        length_file = file_info['length']
-        return decompressed_block[start_file:start_file + length_file]
+        data = decompressed_block[start_file:start_file + length_file]
+        if verify:
+            _check_file(index, file_index, data)
+        return data
 
     def get_compressed_container_info(self, compressed_container: bytes) -> Tuple[int, dict, list]:
         """Returns a tuple(Number of Files, Index to name dictionary and an in-order name list)"""
-        compressed_index_length = int.from_bytes(compressed_container[:4], 'big')
-        compressed_index_data = compressed_container[4:4 + compressed_index_length]
-        index_data = self.compressor.decompress(compressed_index_data)
-        index = json.loads(index_data)
-        return (len(index['file_info']),
-                {i: name for i, name in enumerate(index['index_to_name'])}, index['index_to_name'])
+        index, _ = self._read_index(compressed_container)
+        index_to_name = index.names()
+        return len(set(index_to_name)), {i: name for i, name in enumerate(index_to_name)}, index_to_name
+
+
+class StreamingFileContainerV3(FileContainerV3):
+    """A FileContainerV3 that writes every block to the output as soon as it is sealed, so only the current block
+    and the offsets are held in memory. The index is written together with a footer on close, the result can be read
+    by FileContainerV3.extract_file."""
+    def __init__(self, compressor: "ChunkCompressorBase", output: Union[str, os.PathLike, BinaryIO],
+                 block_size: int = 1024 * 1024, workers: int = 0, use_processes: bool = False,  # Block size of 1 MB
+                 index_format: Literal["json", "binary"] = "json", training_sample_size: int = 1024 * 1024,
+                 dedup: bool = False, checksum_algorithm: Optional[str] = DEFAULT_CHECKSUM):
+        super().__init__(compressor, block_size, workers, use_processes, index_format, training_sample_size, dedup,
+                         checksum_algorithm)
+        if isinstance(output, (str, os.PathLike)):
+            self.output = open(output, "wb")
+            self._owns_output = True
+        else:
+            self.output = output
+            self._owns_output = False
+        self.data_length = 0
+        self.closed = False
+        self.output.write(bytes(4))  # An index length of zero marks the streamed layout
+
+    def _store_block(self, compressed_block: bytes):
+        self.block_offsets.append(self._block_entry(self.data_length, compressed_block))
+        self.output.write(compressed_block)
+        self.data_length += len(compressed_block)
+
+    def add_file(self, filename: str, data: bytes) -> int:
+        if self.closed:
+            raise ValueError("Cannot add a file to a closed container.")
+        return super().add_file(filename, data)
+
+    def close(self):
+        """Seals the last block and writes the index and the footer."""
+        if self.closed:
+            return
+        self._flush_blocks()
+        compressed_index_data = self.compressor.compress(self._build_index())
+        self.output.write(_pack_tail(4 + self.data_length, compressed_index_data, self.compressor.get_header()))
+        self.output.flush()
+        if self._owns_output:
+            self.output.close()
+        self.closed = True
+
+    def get_compressed_container(self) -> bytes:
+        raise RuntimeError("A streamed container is written to its output, call close() to finish it.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ContainerReader:
+    """Random access reader for FileContainer, FileContainerV2 and FileContainerV3 archives on disk.
+    The archive is memory-mapped and its index is parsed once, blocks are sliced out of the map without copying and
+    the last cache_size decompressed blocks are kept, so neighbouring files of one block cost a single decompress."""
+    def __init__(self, file_path: Union[str, os.PathLike], compressor: "ChunkCompressorBase", cache_size: int = 8,
+                 verify_on_read: bool = False):
+        self.file_path = file_path
+        self.compressor = compressor
+        self.cache_size = cache_size
+        self.verify_on_read = verify_on_read  # Checks blocks and files against their checksums, if there are any
+        self._block_cache = OrderedDict()
+
+        self._file = open(file_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        self._load_index()
+
+    def _load_index(self):
+        index_length = int.from_bytes(self._view[:4], 'big')
+        if index_length == 0:  # Streamed FileContainerV3
+            index_offset, index_length, compressor_header = _unpack_tail(self._view)
+            self.compressor.load_header(compressor_header)
+            index_data = self.compressor.decompress(self._view[index_offset:index_offset + index_length])
+            self._data_offset = 4
+        else:
+            index_data = bytes(self._view[4:4 + index_length])
+            self._data_offset = 4 + index_length
+            try:  # FileContainer and FileContainerV2 store the index as plain json
+                plain_index = json.loads(index_data)
+            except ValueError:
+                index_data = self.compressor.decompress(index_data)
+            else:
+                self.index: ContainerIndex = JsonContainerIndex(plain_index)
+                return
+        self.index = load_container_index(index_data)
+
+    def _get_block(self, block_index: int) -> bytes:
+        block = self._block_cache.get(block_index)
+        if block is not None:
+            self._block_cache.move_to_end(block_index)
+            return block
+
+        start, length = self.index.block_entry(block_index)
+        start += self._data_offset
+        compressed_block = self._view[start:start + length]
+        if self.verify_on_read:
+            _check_block(self.index, block_index, compressed_block)
+        block = self.compressor.decompress(compressed_block)
+
+        if self.cache_size > 0:
+            self._block_cache[block_index] = block
+            if len(self._block_cache) > self.cache_size:
+                self._block_cache.popitem(last=False)
+        return block
+
+    def list(self) -> List[str]:
+        """Returns all file names in index order."""
+        return self.index.names()
+
+    def stat(self, file_identifier: Union[str, int]) -> dict:
+        """Returns where a file is stored without decompressing anything."""
+        file_index = self.index.lookup(file_identifier)
+        block_index, start, length = self.index.file_entry(file_index)
+        return {'name': self.index.name(file_index), 'index': file_index, 'block_index': block_index,
+                'start': start, 'length': length, 'compressed_block_length': self.index.block_entry(block_index)[1]}
+
+    def extract(self, file_identifier: Union[str, int]) -> bytes:
+        file_index = self.index.lookup(file_identifier)
+        block_index, start, length = self.index.file_entry(file_index)
+        data = self._get_block(block_index)[start:start + length]
+        if self.verify_on_read:
+            _check_file(self.index, file_index, data)
+        return data
+
+    def extract_many(self, file_identifiers: Iterable[Union[str, int]]) -> List[bytes]:
+        """Extracts several files, going through them block by block so every needed block is decompressed once."""
+        file_indexes = [self.index.lookup(identifier) for identifier in file_identifiers]
+        entries = [self.index.file_entry(file_index) for file_index in file_indexes]
+        results: List[Optional[bytes]] = [None] * len(entries)
+        current_block_index, block = None, b""
+
+        for i in sorted(range(len(entries)), key=lambda x: entries[x][0]):
+            block_index, start, length = entries[i]
+            if block_index != current_block_index:
+                current_block_index = block_index
+                block = self._get_block(block_index)
+            results[i] = block[start:start + length]
+            if self.verify_on_read:
+                _check_file(self.index, file_indexes[i], results[i])
+        return results
+
+    def verify(self, workers: Optional[int] = None, deep: bool = False) -> List[dict]:
+        """Checks every compressed block against its checksum on a thread pool, nothing is decompressed for that.
+        Files stored in a damaged block are reported with it. With deep the intact blocks are decompressed as well and
+        every file is checked against its own checksum. Returns the problems found, empty if the archive is intact."""
+        algorithm = self.index.checksum_algorithm
+        if algorithm is None:
+            raise ValueError("The container was written without checksums.")
+        checksum(b"", algorithm)  # Fails once here if the algorithm isn't available
+        files_by_block = {}
+        for file_index in range(len(self.index)):
+            block_index, start, length = self.index.file_entry(file_index)
+            files_by_block.setdefault(block_index, []).append((file_index, start, length))
+
+        def check(block_index: int) -> List[dict]:
+            start, length = self.index.block_entry(block_index)
+            start += self._data_offset
+            compressed_block = self._view[start:start + length]
+            files = files_by_block.get(block_index, [])
+            if len(compressed_block) < length:
+                reason = "truncated"
+            elif checksum(compressed_block, algorithm) != self.index.block_checksum(block_index):
+                reason = "checksum mismatch"
+            elif not deep:
+                return []
+            else:
+                try:
+                    block, reason = self.compressor.decompress(compressed_block), None
+                except Exception as e:
+                    reason = f"decompression failed ({e})"
+            if reason is not None:
+                return [{'kind': 'block', 'block_index': block_index, 'name': None, 'reason': reason}] + [
+                    {'kind': 'file', 'block_index': block_index, 'name': self.index.name(file_index),
+                     'reason': "stored in a damaged block"} for file_index, _, _ in files]
+            return [{'kind': 'file', 'block_index': block_index, 'name': self.index.name(file_index),
+                     'reason': "checksum mismatch"}
+                    for file_index, file_start, file_length in files
+                    if checksum(block[file_start:file_start + file_length], algorithm)
+                    != self.index.file_checksum(file_index)]
+
+        with ThreadPoolExecutor(workers) as executor:
+            return [problem for problems in executor.map(check, range(self.index.block_count)) for problem in problems]
+
+    def close(self):
+        self._block_cache.clear()
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, filename: str):
+        return filename in self.index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class ChunkCompressorBase:
+    needs_training = False  # If True, FileContainerV3 calls train with samples of the added files first
+
     def compress(self, data_chunk: bytes) -> bytes:
         return data_chunk
 
     def decompress(self, compressed_chunk: bytes) -> bytes:
         return compressed_chunk
 
+    def train(self, samples: List[bytes]):
+        pass
+
+    def get_header(self) -> bytes:
+        """Data the container has to store once so the chunks can be decompressed again."""
+        return b""
+
+    def load_header(self, header: bytes):
+        pass
+
 
 class BrotliChunkCompressor(ChunkCompressorBase):
     def __init__(self, quality: int = 11):  # Maximum compression quality
@@ -240,9 +711,54 @@ class LZMAChunkCompressor(ChunkCompressorBase):
 
 
 class ZstdCompressor(ChunkCompressorBase):
-    def __init__(self, level: int=3):
-        self.compressor = zstd.ZstdCompressor(level=level)
-        self.decompressor = zstd.ZstdDecompressor()
+    def __init__(self, level: int=3, dictionary: Optional[bytes] = None, train_dictionary: bool = False,
+                 dictionary_size: int = 112640):  # Default dictionary size of the zstd cli
+        self.level = level
+        self.train_dictionary = train_dictionary
+        self.dictionary_size = dictionary_size
+        self.dictionary: Optional[zstd.ZstdCompressionDict] = None
+        self.load_header(dictionary or b"")
+
+    @property
+    def needs_training(self) -> bool:
+        return self.train_dictionary and self.dictionary is None
+
+    def train(self, samples: List[bytes]):
+        try:
+            self.dictionary = zstd.train_dictionary(self.dictionary_size, samples)
+        except zstd.ZstdError:  # Too few or too uniform samples, stay without a dictionary
+            self.train_dictionary = False
+        self.load_header(self.get_header())
+
+    def get_header(self) -> bytes:
+        return self.dictionary.as_bytes() if self.dictionary is not None else b""
+
+    def load_header(self, header: bytes):
+        self.dictionary = zstd.ZstdCompressionDict(header) if header else None
+        self._contexts = threading.local()  # zstd contexts can't be shared between threads, e.g. of the worker pool
+
+    @property
+    def compressor(self) -> zstd.ZstdCompressor:
+        compressor = getattr(self._contexts, "compressor", None)
+        if compressor is None:
+            compressor = self._contexts.compressor = zstd.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+        return compressor
+
+    @property
+    def decompressor(self) -> zstd.ZstdDecompressor:
+        decompressor = getattr(self._contexts, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._contexts.decompressor = zstd.ZstdDecompressor(dict_data=self.dictionary)
+        return decompressor
+
+    def __getstate__(self):  # For use_processes, the contexts are recreated in the worker
+        state = self.__dict__.copy()
+        del state["_contexts"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._contexts = threading.local()
 
     def compress(self, data_chunk: bytes) -> bytes:
         return self.compressor.compress(data_chunk)
@@ -252,20 +768,270 @@ class ZstdCompressor(ChunkCompressorBase):
 
 
 class LZMA2Compressor(ChunkCompressorBase):
+    """Raw LZMA2 streams without any per chunk container overhead. The filter chain is built once and stored as the
+    container header, so readers don't need to know the settings. bcj is one of BCJ_FILTERS (for executables),
+    delta_distance > 0 adds a delta filter (for sampled data like audio or bitmaps)."""
+    BCJ_FILTERS = {"x86": lzma.FILTER_X86, "arm": lzma.FILTER_ARM, "armthumb": lzma.FILTER_ARMTHUMB,
+                   "powerpc": lzma.FILTER_POWERPC, "ia64": lzma.FILTER_IA64, "sparc": lzma.FILTER_SPARC}
+
+    def __init__(self, preset: int = 6, dict_size: Optional[int] = None, bcj: Optional[str] = None,
+                 delta_distance: int = 0):
+        filters = []
+        if delta_distance > 0:
+            filters.append({"id": lzma.FILTER_DELTA, "dist": delta_distance})
+        if bcj is not None:
+            if bcj not in self.BCJ_FILTERS:
+                raise ValueError(f"Unknown bcj filter '{bcj}', use one of {list(self.BCJ_FILTERS)}")
+            filters.append({"id": self.BCJ_FILTERS[bcj]})
+        lzma2_filter = {"id": lzma.FILTER_LZMA2, "preset": preset}
+        if dict_size is not None:  # Dictionaries larger than a block only cost memory
+            lzma2_filter["dict_size"] = dict_size
+        filters.append(lzma2_filter)
+        self.filters = filters
+
+    def get_header(self) -> bytes:
+        return json.dumps(self.filters).encode()
+
+    def load_header(self, header: bytes):
+        if header:
+            self.filters = json.loads(header)
+
+    def compress(self, data_chunk: bytes) -> bytes:
+        return lzma.compress(data_chunk, format=lzma.FORMAT_RAW, filters=self.filters)
+
+    def decompress(self, compressed_chunk: bytes) -> bytes:
+        return lzma.decompress(compressed_chunk, format=lzma.FORMAT_RAW, filters=self.filters)
+
+
+class SevenZipLZMA2Compressor(ChunkCompressorBase):
+    """The previous LZMA2Compressor, wraps every chunk in its own 7z archive. Only kept to read old data."""
     def compress(self, data_chunk: bytes) -> bytes:
-        with io.BytesIO() as buffer, py7zr.SevenZipFile(buffer, 'w', filters=[{'id': py7zr.FILTER_LZMA2}]) as archive:
-            # Create a file-like object from data_chunk
-            file_like_data = io.BytesIO(data_chunk)
-            archive.write({"data": file_like_data})
-            buffer.seek(0)  # Reset buffer position to the beginning
-            return buffer.getvalue()
+        buffer = io.BytesIO()
+        with py7zr.SevenZipFile(buffer, 'w', filters=[{'id': py7zr.FILTER_LZMA2}]) as archive:
+            archive.writef(io.BytesIO(data_chunk), "data")
+        return buffer.getvalue()
 
     def decompress(self, compressed_chunk: bytes) -> bytes:
         with io.BytesIO(compressed_chunk) as input_buffer, py7zr.SevenZipFile(input_buffer, 'r') as archive:
-            output_buffer = io.BytesIO()
-            archive.extractall(path=output_buffer)
-            output_buffer.seek(0)  # Reset buffer position to the beginning
-            return output_buffer.read()
+            if hasattr(archive, "readall"):  # py7zr < 1.0
+                return archive.readall()["data"].read()
+            from py7zr.io import BytesIOFactory  # extractall(path=...) can't write into a buffer
+            factory = BytesIOFactory(1 << 62)
+            archive.extractall(factory=factory)
+            product = factory.products["data"]
+            product.seek(0)
+            return product.read()
+
+
+class AutoChunkCompressor(ChunkCompressorBase):
+    """Picks the codec per chunk and stores it as a one byte tag in front of the chunk.
+    Chunks that look incompressible (high byte entropy or a fast zstd-1 probe that doesn't shrink them) are stored raw,
+    everything else is compressed with every candidate of the policy and the smallest result is kept.
+    A policy is either one of AUTO_POLICIES or a sequence of (codec tag, level) pairs."""
+    RAW = 0
+    ZSTD = 1
+    BROTLI = 2
+    LZMA = 3
+
+    AUTO_POLICIES = {
+        "speed": ((ZSTD, 1),),
+        "balanced": ((ZSTD, 9),),
+        "ratio": ((BROTLI, 11), (LZMA, 9)),
+    }
+
+    def __init__(self, policy: Union[Literal["speed", "balanced", "ratio"], Sequence[Tuple[int, int]]] = "balanced",
+                 entropy_threshold: float = 7.5, min_gain: float = 0.05, sample_size: int = 64 * 1024):
+        self.candidates = self.AUTO_POLICIES[policy] if isinstance(policy, str) else tuple(policy)
+        self.entropy_threshold = entropy_threshold  # Bits per byte, already compressed data sits close to 8
+        self.min_gain = min_gain  # The probe has to save at least this fraction
+        self.sample_size = sample_size
+        self._contexts = threading.local()  # zstd contexts can't be shared between threads
+
+    @property
+    def _probe(self) -> zstd.ZstdCompressor:
+        probe = getattr(self._contexts, "probe", None)
+        if probe is None:
+            probe = self._contexts.probe = zstd.ZstdCompressor(level=1)
+        return probe
+
+    @property
+    def _zstd_decompressor(self) -> zstd.ZstdDecompressor:
+        decompressor = getattr(self._contexts, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._contexts.decompressor = zstd.ZstdDecompressor()
+        return decompressor
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_contexts"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._contexts = threading.local()
+
+    @staticmethod
+    def entropy(data: bytes) -> float:
+        """Shannon entropy in bits per byte."""
+        if not data:
+            return 0.0
+        total = len(data)
+        return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+    def _sample(self, data_chunk: bytes) -> bytes:
+        if len(data_chunk) <= self.sample_size:
+            return bytes(data_chunk)
+        part = self.sample_size // 3  # Beginning, middle and end, files in a block can differ a lot
+        middle = len(data_chunk) // 2
+        return bytes(data_chunk[:part] + data_chunk[middle - part // 2:middle + part // 2] + data_chunk[-part:])
+
+    def is_incompressible(self, data_chunk: bytes) -> bool:
+        sample = self._sample(data_chunk)
+        if self.entropy(sample[:16 * 1024]) > self.entropy_threshold:
+            return True
+        return len(self._probe.compress(sample)) > len(sample) * (1 - self.min_gain)
+
+    @classmethod
+    def _compress_with(cls, codec: int, level: int, data_chunk: bytes) -> bytes:
+        if codec == cls.ZSTD:
+            return zstd.ZstdCompressor(level=level).compress(data_chunk)
+        elif codec == cls.BROTLI:
+            return brotli.compress(bytes(data_chunk), quality=level)
+        elif codec == cls.LZMA:
+            return lzma.compress(data_chunk, preset=level)
+        raise ValueError(f"Unknown codec tag {codec}")
+
+    def compress(self, data_chunk: bytes) -> bytes:
+        best_codec, best_chunk = self.RAW, data_chunk
+        if not self.is_incompressible(data_chunk):
+            for codec, level in self.candidates:
+                compressed_chunk = self._compress_with(codec, level, data_chunk)
+                if len(compressed_chunk) < len(best_chunk):
+                    best_codec, best_chunk = codec, compressed_chunk
+        return bytes((best_codec,)) + best_chunk
+
+    def decompress(self, compressed_chunk: bytes) -> bytes:
+        codec, chunk = compressed_chunk[0], compressed_chunk[1:]
+        if codec == self.RAW:
+            return bytes(chunk)
+        elif codec == self.ZSTD:
+            return self._zstd_decompressor.decompress(chunk)
+        elif codec == self.BROTLI:
+            return brotli.decompress(chunk)
+        elif codec == self.LZMA:
+            return lzma.decompress(chunk)
+        raise ValueError(f"Unknown codec tag {codec}")
+
+
+def benchmark_workers(compressor: Optional[ChunkCompressorBase] = None, data_size: int = 32 * 1024 * 1024,
+                      block_size: int = 1024 * 1024, worker_counts: Iterable[int] = (1, 2, 4, 8)) -> dict:
+    """Packs the same generated text with an increasing number of workers and prints the throughput of each run.
+    Every run has to produce the same bytes as the first one."""
+    import random
+    compressor = compressor or BrotliChunkCompressor(quality=9)
+    rng = random.Random(0)
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10))) for _ in range(4096)]
+    data = bytearray()
+    while len(data) < data_size:
+        data.extend(b" ".join(rng.choices(words, k=1024)))
+    del data[data_size:]
+
+    print(f"{os.cpu_count()} cores, {data_size / 1e6:.1f} MB, {block_size} byte blocks, {type(compressor).__name__}")
+    results = {}
+    reference = None
+    for workers in worker_counts:
+        container = FileContainerV3(compressor, block_size, workers=workers)
+        start = time.perf_counter()
+        for i in range(0, data_size, 64 * 1024):
+            container.add_file(f"file_{i}", data[i:i + 64 * 1024])
+        compressed_container = container.get_compressed_container()
+        elapsed = time.perf_counter() - start
+
+        if reference is None:
+            reference = compressed_container
+        elif compressed_container != reference:
+            raise ValueError(f"Output with {workers} workers differs from the first run")
+        results[workers] = data_size / elapsed / 1e6
+        print(f"{workers} worker(s): {results[workers]:.2f} MB/s")
+    return results
+
+
+def benchmark_lzma2(data_size: int = 8 * 1024 * 1024, block_size: int = 1024 * 1024) -> dict:
+    """Compresses the same mixed corpus (text, repetitive binary records, random bytes) block by block with the
+    7z based and the raw LZMA2 compressor and prints ratio and throughput of both."""
+    import random
+    rng = random.Random(0)
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10))) for _ in range(2048)]
+    data = bytearray()
+    while len(data) < data_size:
+        data.extend(b" ".join(rng.choices(words, k=2048)))
+        data.extend(b"".join(struct.pack("<IHd", i, rng.randint(0, 9), i * 0.5) for i in range(2048)))
+        data.extend(rng.randbytes(8192))
+    del data[data_size:]
+    blocks = [bytes(data[i:i + block_size]) for i in range(0, data_size, block_size)]
+
+    results = {}
+    for compressor in (SevenZipLZMA2Compressor(), LZMA2Compressor()):
+        name = type(compressor).__name__
+        start = time.perf_counter()
+        compressed_blocks = [compressor.compress(block) for block in blocks]
+        compress_time = time.perf_counter() - start
+        start = time.perf_counter()
+        decompressed_blocks = [compressor.decompress(block) for block in compressed_blocks]
+        decompress_time = time.perf_counter() - start
+        if decompressed_blocks != blocks:
+            raise ValueError(f"{name} did not round trip")
+
+        compressed_size = sum(len(block) for block in compressed_blocks)
+        results[name] = {"ratio": data_size / compressed_size, "compressed_size": compressed_size,
+                         "compress_mb_s": data_size / compress_time / 1e6,
+                         "decompress_mb_s": data_size / decompress_time / 1e6}
+        print(f"{name}: {compressed_size} bytes (ratio {results[name]['ratio']:.3f}), "
+              f"compress {results[name]['compress_mb_s']:.2f} MB/s, "
+              f"decompress {results[name]['decompress_mb_s']:.2f} MB/s")
+    return results
+
+
+def benchmark_dictionary(file_count: int = 5000, block_sizes: Iterable[int] = (1024 * 1024, 16 * 1024, 4 * 1024),
+                         level: int = 3) -> dict:
+    """Packs small, similar json records with and without a trained zstd dictionary and prints the ratio and the
+    average time it takes to extract a single file (without block cache) for every block size."""
+    import random
+    rng = random.Random(0)
+    files = {}
+    for i in range(file_count):
+        record = {"case_id": i, "status": rng.choice(["open", "closed", "pending"]),
+                  "owner": {"name": rng.choice(["Anna", "Ben", "Chris", "Dana"]), "department": rng.randint(1, 20)},
+                  "documents": [f"doc_{rng.randint(0, 10 ** 6)}.pdf" for _ in range(rng.randint(0, 4))],
+                  "notes": " ".join(rng.choices(["urgent", "review", "signed", "missing", "copy"], k=8))}
+        files[f"case_{i}.json"] = json.dumps(record, indent=2).encode()
+    raw_size = sum(len(data) for data in files.values())
+    names = list(files)
+
+    results = {}
+    for block_size in block_sizes:
+        for use_dictionary in (False, True):
+            stream = io.BytesIO()
+            with StreamingFileContainerV3(ZstdCompressor(level, train_dictionary=use_dictionary), stream,
+                                          block_size, index_format="binary") as container:
+                for name, data in files.items():
+                    container.add_file(name, data)
+            with tempfile.NamedTemporaryFile(suffix=".bin", delete=False) as f:
+                f.write(stream.getvalue())
+
+            with ContainerReader(f.name, ZstdCompressor(level), cache_size=0) as reader:
+                sample = rng.sample(names, min(500, len(names)))
+                start = time.perf_counter()
+                for name in sample:
+                    reader.extract(name)
+                latency = (time.perf_counter() - start) / len(sample)
+            os.remove(f.name)
+
+            key = f"{block_size}{'_dictionary' if use_dictionary else ''}"
+            results[key] = {"ratio": len(stream.getvalue()) / raw_size, "extract_latency_us": latency * 1e6}
+            print(f"{block_size:>8} byte blocks, dictionary {'on ' if use_dictionary else 'off'}: ratio "
+                  f"{results[key]['ratio']:.3f}, {results[key]['extract_latency_us']:.1f} us per file")
+    return results
 
 
 def local_test():
@@ -293,6 +1059,10 @@ def local_test():
 
         print("Wrote bin")
 
+        with ContainerReader("./test_data/files.bin", compressor) as reader:
+            if reader.extract_many(reader.list()) != list(data.values()):
+                raise ValueError("ContainerReader returned wrong data")
+
         # To extract a specific file from the compressed data
         try:
             decompressed_files = []
@@ -314,6 +1084,24 @@ def local_test():
         for i, decompressed_file in enumerate(decompressed_files):
             with open(f"./test_data/file_{i}.ext", "wb") as f:
                 f.write(decompressed_file)
+
+        streamed_data = io.BytesIO()
+        with StreamingFileContainerV3(compressor, streamed_data, block_size=2048 * 2048) as streaming_container:
+            for file_name, image in data.items():
+                streaming_container.add_file(file_name, image)
+        for file_name, image in data.items():
+            if streaming_container.extract_file(streamed_data.getvalue(), file_name) != image:
+                raise ValueError(f"Streamed container returned wrong data for {file_name}")
+        print("Streamed container matches")
+
+        dedup_container = FileContainerV3(compressor, block_size=2048 * 2048, dedup=True)
+        attachment = os.urandom(64 * 1024)
+        for i in range(3):
+            dedup_container.add_file(f"case_{i}/attachment.pdf", attachment)
+        dedup_data = dedup_container.get_compressed_container()
+        if len(dedup_data) > len(attachment) * 1.5 or dedup_container.extract_file(dedup_data, 2) != attachment:
+            raise ValueError("Deduplicating container stored the attachment more than once")
+        print("Deduplicated container matches")
     except Exception as e:
         print(f"An error occurred: {e}")
         return False
@@ -1,22 +1,45 @@
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict, deque
+import bisect
 import lzma
 import brotli
+import threading
 import json
 import os
 import zstandard as zstd
-import py7zr
+import tempfile
+import struct
+import zlib
 import io
-from typing import Union, Tuple, List, Optional
+from typing import Union, Tuple, List, Optional, Sequence, Iterable, Iterator, Literal
 from aplustools.security.crypto import CryptUtils
 from aplustools.data import encode_int, decode_int
+from aplustools.data.compressor import (_BlockCompressionPool, AutoChunkCompressor, LZMA2Compressor, content_digest,
+                                        content_defined_chunks)
+from aplustools.data.container_index import checksum, DEFAULT_CHECKSUM
 
 
 class EmptyChunkProcessor:
+    needs_training = False  # If True, the container calls train with samples of the added files first
+
     def process(self, data_chunk: bytes) -> bytes:
         return data_chunk
 
     def unprocess(self, processed_chunk: bytes) -> bytes:
         return processed_chunk
 
+    def train(self, samples: List[bytes]):
+        pass
+
+    def get_header(self) -> bytes:
+        """Data the container has to store once so the chunks can be unprocessed again."""
+        return b""
+
+    def load_header(self, header: bytes):
+        pass
+
 
 class BrotliChunkCompressor(EmptyChunkProcessor):
     def __init__(self, quality: int = 11):  # Maximum compression quality
@@ -50,9 +73,54 @@ class LZMAChunkCompressor(EmptyChunkProcessor):
 
 
 class ZstdChunkCompressor(EmptyChunkProcessor):
-    def __init__(self, level: int=3):
-        self.compressor = zstd.ZstdCompressor(level=level)
-        self.decompressor = zstd.ZstdDecompressor()
+    def __init__(self, level: int=3, dictionary: Optional[bytes] = None, train_dictionary: bool = False,
+                 dictionary_size: int = 112640):  # Default dictionary size of the zstd cli
+        self.level = level
+        self.train_dictionary = train_dictionary
+        self.dictionary_size = dictionary_size
+        self.dictionary: Optional[zstd.ZstdCompressionDict] = None
+        self.load_header(dictionary or b"")
+
+    @property
+    def needs_training(self) -> bool:
+        return self.train_dictionary and self.dictionary is None
+
+    def train(self, samples: List[bytes]):
+        try:
+            self.dictionary = zstd.train_dictionary(self.dictionary_size, samples)
+        except zstd.ZstdError:  # Too few or too uniform samples, stay without a dictionary
+            self.train_dictionary = False
+        self.load_header(self.get_header())
+
+    def get_header(self) -> bytes:
+        return self.dictionary.as_bytes() if self.dictionary is not None else b""
+
+    def load_header(self, header: bytes):
+        self.dictionary = zstd.ZstdCompressionDict(header) if header else None
+        self._contexts = threading.local()  # zstd contexts can't be shared between threads, e.g. of the worker pool
+
+    @property
+    def compressor(self) -> zstd.ZstdCompressor:
+        compressor = getattr(self._contexts, "compressor", None)
+        if compressor is None:
+            compressor = self._contexts.compressor = zstd.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+        return compressor
+
+    @property
+    def decompressor(self) -> zstd.ZstdDecompressor:
+        decompressor = getattr(self._contexts, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._contexts.decompressor = zstd.ZstdDecompressor(dict_data=self.dictionary)
+        return decompressor
+
+    def __getstate__(self):  # For use_processes, the contexts are recreated in the worker
+        state = self.__dict__.copy()
+        del state["_contexts"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._contexts = threading.local()
 
     def process(self, data_chunk: bytes) -> bytes:
         return self.compressor.compress(data_chunk)
@@ -61,34 +129,65 @@ class ZstdChunkCompressor(EmptyChunkProcessor):
         return self.decompressor.decompress(processed_chunk)
 
 
+class AutoChunkProcessor(EmptyChunkProcessor):
+    """Chooses raw/zstd/brotli/lzma per chunk, see AutoChunkCompressor."""
+    def __init__(self, policy: Union[str, Sequence[Tuple[int, int]]] = "balanced", entropy_threshold: float = 7.5,
+                 min_gain: float = 0.05, sample_size: int = 64 * 1024):
+        self._auto_compressor = AutoChunkCompressor(policy, entropy_threshold, min_gain, sample_size)
+
+    def process(self, data_chunk: bytes) -> bytes:
+        return self._auto_compressor.compress(data_chunk)
+
+    def unprocess(self, processed_chunk: bytes) -> bytes:
+        return self._auto_compressor.decompress(processed_chunk)
+
+
 class LZMA2ChunkCompressor(EmptyChunkProcessor):
+    """Raw LZMA2 chunks, see LZMA2Compressor for the filter options."""
+    def __init__(self, preset: int = 6, dict_size: Optional[int] = None, bcj: Optional[str] = None,
+                 delta_distance: int = 0):
+        self._lzma2_compressor = LZMA2Compressor(preset, dict_size, bcj, delta_distance)
+
+    def get_header(self) -> bytes:
+        return self._lzma2_compressor.get_header()
+
+    def load_header(self, header: bytes):
+        self._lzma2_compressor.load_header(header)
+
     def process(self, data_chunk: bytes) -> bytes:
-        with io.BytesIO() as buffer, py7zr.SevenZipFile(buffer, 'w', filters=[{'id': py7zr.FILTER_LZMA2}]) as archive:
-            # Create a file-like object from data_chunk
-            file_like_data = io.BytesIO(data_chunk)
-            archive.write({"data": file_like_data})
-            buffer.seek(0)  # Reset buffer position to the beginning
-            return buffer.getvalue()
+        return self._lzma2_compressor.compress(data_chunk)
 
     def unprocess(self, processed_chunk: bytes) -> bytes:
-        with io.BytesIO(processed_chunk) as input_buffer, py7zr.SevenZipFile(input_buffer, 'r') as archive:
-            output_buffer = io.BytesIO()
-            archive.extractall(path=output_buffer)
-            output_buffer.seek(0)  # Reset buffer position to the beginning
-            return output_buffer.read()
+        return self._lzma2_compressor.decompress(processed_chunk)
 
 
 class AESChunkEncryptor(EmptyChunkProcessor):
+    _TAG_LENGTH = 16
+
     def __init__(self, key: Optional[bytes] = None):
         self.key = key if key is not None else CryptUtils.generate_aes_key(128)
+        self._cipher = AESGCM(self.key)  # Key schedule is set up once and shared by every chunk
+
+    def __getstate__(self):  # For use_processes, AESGCM can't be pickled and is set up again from the key
+        state = self.__dict__.copy()
+        del state["_cipher"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cipher = AESGCM(self.key)
 
     def process(self, data_chunk: bytes) -> bytes:
-        iv, encrypted_data, tag = CryptUtils.aes_encrypt(data_chunk, key=self.key)
-        return CryptUtils.pack_ae_data(iv, encrypted_data, tag)
+        nonce = os.urandom(12)  # Fresh random nonce per chunk, the cipher context is reused
+        encrypted_data = self._cipher.encrypt(nonce, bytes(data_chunk), None)
+        return CryptUtils.pack_ae_data(nonce, encrypted_data[:-self._TAG_LENGTH], encrypted_data[-self._TAG_LENGTH:])
 
     def unprocess(self, processed_chunk: bytes) -> bytes:
         iv, encrypted_data, tag = CryptUtils.unpack_ae_data(processed_chunk)
-        return CryptUtils.aes_decrypt(iv, encrypted_data, tag, key=self.key)
+        try:
+            return self._cipher.decrypt(iv, encrypted_data + tag, None)
+        except InvalidTag:
+            raise ValueError("AES Decryption Error: MAC check failed")
 
 
 class DESChunkEncryptor(EmptyChunkProcessor):
@@ -116,180 +215,863 @@ class RSAChunkEncryptor(EmptyChunkProcessor):
         return CryptUtils.rsa_decrypt(processed_chunk, private_key=self.key)
 
 
+class _StagePipeline:
+    """Runs every stage on its own thread, so stage i works on block N while stage i - 1 already works on block N + 1.
+    Has the same submit/drain interface as _BlockCompressionPool."""
+    def __init__(self, stages: Sequence[EmptyChunkProcessor], max_in_flight: Optional[int] = None):
+        self._stages = stages
+        self._executors = [ThreadPoolExecutor(max_workers=1) for _ in stages]
+        self._max_in_flight = max_in_flight or len(stages) * 2
+        self._in_flight = deque()
+
+    @staticmethod
+    def _run_stage(stage: EmptyChunkProcessor, previous: Future) -> bytes:
+        return stage.process(previous.result())
+
+    def submit(self, block: bytes) -> List[bytes]:
+        """Queues a block and returns every processed block that is ready, oldest first."""
+        future = self._executors[0].submit(self._stages[0].process, bytes(block))
+        for stage, executor in zip(self._stages[1:], self._executors[1:]):
+            future = executor.submit(self._run_stage, stage, future)
+        self._in_flight.append(future)
+        ready = []
+        while self._in_flight and (len(self._in_flight) > self._max_in_flight or self._in_flight[0].done()):
+            ready.append(self._in_flight.popleft().result())
+        return ready
+
+    def drain(self) -> List[bytes]:
+        """Waits for all queued blocks and shuts the stage threads down."""
+        ready = [future.result() for future in self._in_flight]
+        self._in_flight.clear()
+        for executor in self._executors:
+            executor.shutdown()
+        return ready
+
+    def cancel(self):
+        """Drops the queued blocks and shuts the stage threads down without waiting for them."""
+        self._in_flight.clear()
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ProcessorPipeline(EmptyChunkProcessor):
+    """Chains processors, process runs them in order and unprocess in reverse, e.g. compress then encrypt."""
+    def __init__(self, *processors: Optional[EmptyChunkProcessor]):
+        self.processors = [processor for processor in processors if processor is not None]
+
+    @property
+    def needs_training(self) -> bool:
+        return any(processor.needs_training for processor in self.processors)
+
+    def train(self, samples: List[bytes]):
+        # Every stage gets to see the samples the way they'll arrive at it, stages after the last trained one don't
+        # need to process them
+        last_trained = max((index for index, processor in enumerate(self.processors) if processor.needs_training),
+                           default=-1)
+        for index, processor in enumerate(self.processors[:last_trained + 1]):
+            if processor.needs_training:
+                processor.train(samples)
+            if index < last_trained:
+                samples = [processor.process(sample) for sample in samples]
+
+    def get_header(self) -> bytes:
+        headers = [processor.get_header() for processor in self.processors]
+        if not any(headers):
+            return b""
+        return b"".join(struct.pack(">I", len(header)) + header for header in headers)
+
+    def load_header(self, header: bytes):
+        position = 0
+        for processor in self.processors:
+            if position >= len(header):
+                break
+            (length,) = struct.unpack_from(">I", header, position)
+            processor.load_header(header[position + 4:position + 4 + length])
+            position += 4 + length
+
+    def process(self, data_chunk: bytes) -> bytes:
+        for processor in self.processors:
+            data_chunk = processor.process(data_chunk)
+        return data_chunk
+
+    def unprocess(self, processed_chunk: bytes) -> bytes:
+        for processor in reversed(self.processors):
+            processed_chunk = processor.unprocess(processed_chunk)
+        return processed_chunk
+
+    def pipelined(self, max_in_flight: Optional[int] = None) -> _StagePipeline:
+        return _StagePipeline(self.processors, max_in_flight)
+
+    def process_many(self, data_chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Processes chunks with all stages running concurrently, results keep the input order."""
+        pipeline = self.pipelined()
+        try:
+            for data_chunk in data_chunks:
+                yield from pipeline.submit(data_chunk)
+            remaining = pipeline.drain()
+        finally:  # Also runs when the consumer stops early, which must not wait for or yield the queued blocks
+            pipeline.cancel()
+        yield from remaining
+
+
+# FileContainerV4 manages the region [container_start, container_end) of a file in place.
+# The region starts with a superblock (magic, version, reserved, index offset, index length, crc32 of the index),
+# blocks and the index live anywhere in the space after _V4_DATA_START. All offsets are relative to container_start.
+# Since version 2 the index extent starts with the compressor header (e.g. a trained zstd dictionary), encrypted by
+# the encryptor and prefixed with its length, as the index itself can only be unprocessed once the header is loaded.
+# A new index is always written into free space before the superblock is switched over to it and space freed by
+# remove_file only becomes reusable after that switch, so an interrupted update leaves the last committed state intact.
+_V4_MAGIC = b"APV4"
+_V4_VERSION = 2
+_V4_SUPERBLOCK = struct.Struct(">4sHHQII")
+_V4_DATA_START = 32
+
+
 class FileContainerV4:
-    def __init__(self, compressor: EmptyChunkProcessor, encryptor: EmptyChunkProcessor, file_path: str, container_start: int, container_end: int,
-                 block_size: int = 1024 * 1024, load_now: bool = True):
+    def __init__(self, compressor: EmptyChunkProcessor, encryptor: Optional[EmptyChunkProcessor], file_path: str, container_start: int, container_end: int,
+                 block_size: int = 1024 * 1024, load_now: bool = True, workers: int = 0, use_processes: bool = False,
+                 cache_size: int = 4, dedup: Literal["off", "file", "chunks"] = "off",
+                 checksum_algorithm: Optional[str] = DEFAULT_CHECKSUM, verify_on_read: bool = False,
+                 training_sample_size: int = 1024 * 1024):
         self.compressor = compressor
+        self.encryptor = encryptor
+        self.processor = ProcessorPipeline(compressor, encryptor)  # Blocks and the index are compressed, then encrypted
         self.block_size = block_size
+        self.cache_size = cache_size  # Decompressed blocks kept for ranged and file-like reads
+        self._block_cache = OrderedDict()
+        if dedup not in ("off", "file", "chunks"):
+            raise ValueError(f"Unknown dedup mode '{dedup}'")
+        # file stores identical files once, chunks also shares content defined chunks between different files
+        self.dedup = dedup
+        self.content_index = {}  # Hex digest of a file or chunk -> its segments
+        if checksum_algorithm is not None:
+            checksum(b"", checksum_algorithm)  # Fail now and not when the first file is added
+        self.checksum_algorithm = checksum_algorithm  # An existing container keeps the algorithm it was written with
+        self.verify_on_read = verify_on_read  # Checks blocks and whole files against their checksums
+        self.workers = workers  # More than one processes sealed blocks in parallel, otherwise stages are pipelined
+        self.use_processes = use_processes  # Only needed for processors that hold the GIL, must be picklable
+        self._pool: Optional[Union[_BlockCompressionPool, _StagePipeline]] = None
+        self._sealed_blocks = 0
         self.current_block = bytearray()
+        self.training_sample_size = training_sample_size  # Bytes of added files a trainable compressor learns from
+        self._training_allowed = True  # Blocks already stored without a dictionary can't be read with a new one
+        self._samples = []
+        self._sample_bytes = 0
+        self._held_blocks = []  # Sealed, but waiting for the compressor to be trained
 
         self.file_path = file_path
         self.container_start = container_start
         self.container_end = container_end
-        self.file_info = {}
+        self.region_size = container_end - container_start
+        if self.region_size <= _V4_DATA_START:
+            raise ValueError("The designated container range is too small.")
+        self.file_info = {}  # Every file has a list of [block index, start, length] segments under 'blocks'
         self.index_to_name = []
-        self.block_offsets = []
-
+        self.block_offsets: List[Optional[dict]] = []  # Removed blocks stay as None so block indexes don't shift
+        self._block_refs = {}  # Block index -> number of files stored in it
+        self._free_extents: List[List[int]] = []  # Known once the metadata is loaded, nothing can be allocated before
+        self._pending_free: List[Tuple[int, int]] = []  # Freed, but the committed index may still point there
+        self._index_extent: Optional[Tuple[int, int]] = None
+        self._metadata_loaded = False  # With load_now=False it's loaded by the first call that needs it
+        self._dirty = False  # Something changed since the last commit, close only commits then
+
+        if not os.path.exists(file_path):
+            with open(file_path, "wb") as f:
+                f.seek(container_start)
+                f.write(b'\0' * (self.container_end - self.container_start))
+        self._file = open(file_path, "r+b")
+        self._file_lock = threading.Lock()  # verify reads from several threads
         if load_now:
-            if os.path.exists(file_path):
-                self.load_compressed_container_metadata()
-            else:
-                with open(file_path, "wb") as f:
-                    f.seek(container_start)
-                    f.write(b'\0' * (self.container_end - self.container_start))
+            self.load_compressed_container_metadata()
+
+    def _read(self, offset: int, length: int) -> bytes:
+        if offset < 0 or offset + length > self.region_size:
+            raise ValueError("Read is outside of the designated container range.")
+        with self._file_lock:
+            self._file.seek(self.container_start + offset)
+            return self._file.read(length)
+
+    def _write(self, offset: int, data: bytes):
+        if offset < 0 or offset + len(data) > self.region_size:
+            raise ValueError("Write is outside of the designated container range.")
+        self._file.seek(self.container_start + offset)
+        self._file.write(data)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _allocate(self, length: int) -> int:
+        """Takes length bytes from the first free extent that is large enough."""
+        for i, (offset, free_length) in enumerate(self._free_extents):
+            if free_length >= length:
+                if free_length == length:
+                    del self._free_extents[i]
+                else:
+                    self._free_extents[i] = [offset + length, free_length - length]
+                return offset
+        raise ValueError("Not enough free space in the designated container range, try defragment().")
+
+    def _release(self, offset: int, length: int):
+        """Gives an extent back to the free list, merging it with its neighbours."""
+        i = bisect.bisect(self._free_extents, [offset, length])
+        self._free_extents.insert(i, [offset, length])
+        if i + 1 < len(self._free_extents) and offset + length == self._free_extents[i + 1][0]:
+            self._free_extents[i][1] += self._free_extents.pop(i + 1)[1]
+        if i > 0 and self._free_extents[i - 1][0] + self._free_extents[i - 1][1] == offset:
+            self._free_extents[i - 1][1] += self._free_extents.pop(i)[1]
+
+    def _rebuild_allocation(self):
+        self._block_refs = {}
+        for file_info in self.file_info.values():
+            for block_index, _, _ in file_info['blocks']:
+                self._block_refs[block_index] = self._block_refs.get(block_index, 0) + 1
+        used_extents = []
+        for block_index, block_info in enumerate(self.block_offsets):
+            if block_info is not None and block_index not in self._block_refs:
+                self.block_offsets[block_index] = None  # Nothing points to it anymore
+            elif block_info is not None:
+                used_extents.append((block_info['start'], block_info['length']))
+        if self._index_extent is not None:
+            used_extents.append(self._index_extent)
+
+        self._free_extents = []
+        position = _V4_DATA_START
+        for offset, length in sorted(used_extents):
+            if offset > position:
+                self._free_extents.append([position, offset - position])
+            position = max(position, offset + length)
+        if position < self.region_size:
+            self._free_extents.append([position, self.region_size - position])
+        self._pending_free = []
+        self._block_cache.clear()
+        self._sealed_blocks = len(self.block_offsets)
+
+    def _load_metadata_if_needed(self):
+        if not self._metadata_loaded:
+            self.load_compressed_container_metadata()
 
     def load_compressed_container_metadata(self):
         """Loads only the metadata for the compressed container part within the specified range."""
-        with open(self.file_path, 'rb') as file:
-            file.seek(self.container_start)
-            index_length_bytes = file.read(4)
-            index_length = int.from_bytes(index_length_bytes, 'big')
-
-            if index_length > self.container_end - self.container_start - 4:
-                raise ValueError("Index size is larger than the designated container range.")
-
-            compressed_index_data = file.read(index_length)
-            index_data = self.compressor.unprocess(compressed_index_data)
-            index = json.loads(index_data)
-            self.file_info = index['file_info']
-            self.index_to_name = index['index_to_name']
-            self.block_offsets = index['block_offsets']
+        self._metadata_loaded = True
+        superblock = self._read(0, _V4_SUPERBLOCK.size)
+        if len(superblock) < _V4_SUPERBLOCK.size or not any(superblock):  # Fresh region
+            self.file_info, self.index_to_name, self.block_offsets, self.content_index = {}, [], [], {}
+            self._index_extent = None
+            self._rebuild_allocation()
+            return
+
+        magic, version, _, index_offset, index_length, index_crc = _V4_SUPERBLOCK.unpack(superblock)
+        if magic != _V4_MAGIC:
+            raise ValueError("The designated container range does not hold a FileContainerV4.")
+        if version > _V4_VERSION:
+            raise ValueError(f"FileContainerV4 version {version} is not supported.")
+        if index_offset + index_length > self.region_size:
+            raise ValueError("Index size is larger than the designated container range.")
+
+        compressed_index_data = self._read(index_offset, index_length)
+        if zlib.crc32(compressed_index_data) != index_crc:
+            raise ValueError("The container index is corrupt.")
+        if version >= 2:
+            (header_length,) = struct.unpack_from(">I", compressed_index_data)
+            header = compressed_index_data[4:4 + header_length]
+            if header and self.encryptor is not None:
+                header = self.encryptor.unprocess(header)
+            if header:
+                self.compressor.load_header(header)
+            compressed_index_data = compressed_index_data[4 + header_length:]
+        index_data = self.processor.unprocess(compressed_index_data)
+        index = json.loads(index_data)
+        self.file_info = index['file_info']
+        self.index_to_name = index['index_to_name']
+        self.block_offsets = index['block_offsets']
+        self.content_index = index.get('content_index', {})
+        if index.get('checksum_algorithm') is not None:
+            self.checksum_algorithm = index['checksum_algorithm']
+        for file_info in self.file_info.values():
+            if 'block_index' in file_info:  # Written before files could span blocks
+                file_info['blocks'] = [[file_info.pop('block_index'), file_info.pop('start'), file_info['length']]]
+        self._index_extent = (index_offset, index_length)
+        self._training_allowed = not any(self.block_offsets)
+        self._rebuild_allocation()
+
+    def _needs_training(self) -> bool:
+        return self._training_allowed and self.processor.needs_training
 
     def _compress_current_block(self):
         if self.current_block:
-            compressed_block = self.compressor.process(self.current_block)
-            self.block_offsets.append({'start': len(self.compressed_data), 'length': len(compressed_block)})
-            self.compressed_data.extend(compressed_block)
+            self._held_blocks.append(self.current_block)
+            self._sealed_blocks += 1
             self.current_block = bytearray()
+            if not self._needs_training() or self._sample_bytes >= self.training_sample_size:
+                self._release_held_blocks()
+
+    def _release_held_blocks(self):
+        if not self._held_blocks:
+            return
+        if self._needs_training():
+            self.processor.train(self._samples)
+        self._samples, self._sample_bytes = [], 0
+
+        for block in self._held_blocks:
+            if self.workers > 1 or len(self.processor.processors) > 1:
+                if self._pool is None:
+                    self._pool = (_BlockCompressionPool(self.processor.process, self.workers, self.use_processes)
+                                  if self.workers > 1 else self.processor.pipelined())
+                for compressed_block in self._pool.submit(block):
+                    self._store_block(compressed_block)
+            else:
+                self._store_block(self.processor.process(block))
+        self._held_blocks = []
+
+    def _flush_blocks(self):
+        """Compresses any remaining data in the current block and waits for the pool."""
+        self._compress_current_block()
+        self._release_held_blocks()
+        if self._pool is not None:
+            for compressed_block in self._pool.drain():
+                self._store_block(compressed_block)
+            self._pool = None
+
+    def _store_block(self, compressed_block: bytes):
+        """Writes a block straight into free space of the region."""
+        if len(self.block_offsets) not in self._block_refs:  # Every file in it was removed before it was sealed
+            self.block_offsets.append(None)
+            return
+        offset = self._allocate(len(compressed_block))
+        self._write(offset, compressed_block)
+        block_info = {'start': offset, 'length': len(compressed_block)}
+        if self.checksum_algorithm is not None:
+            block_info['checksum'] = checksum(compressed_block, self.checksum_algorithm)
+        self.block_offsets.append(block_info)
+
+    def _get_block(self, block_index: int) -> bytes:
+        block = self._block_cache.get(block_index)
+        if block is not None:
+            self._block_cache.move_to_end(block_index)
+            return block
+
+        if block_index >= len(self.block_offsets):  # Still in the current block or the pool
+            self._flush_blocks()
+        block_info = self.block_offsets[block_index]
+        processed_block = self._read(block_info['start'], block_info['length'])
+        if self.verify_on_read:
+            self._check(processed_block, block_info, f"Block {block_index}")
+        block = self.processor.unprocess(processed_block)
+
+        if self.cache_size > 0:
+            self._block_cache[block_index] = block
+            if len(self._block_cache) > self.cache_size:
+                self._block_cache.popitem(last=False)
+        return block
+
+    def _check(self, data: bytes, info: dict, what: str):
+        if info.get('checksum') is not None and checksum(data, self.checksum_algorithm) != info['checksum']:
+            raise ValueError(f"{what} is corrupt, its checksum doesn't match.")
+
+    def _read_segments(self, segments: List[List[int]], offset: int, length: int) -> bytes:
+        """Reads [offset, offset + length) of the data the segments make up, only touching overlapping blocks."""
+        parts = []
+        end = offset + length
+        position = 0
+        for block_index, start, segment_length in segments:
+            if position >= end:
+                break
+            if position + segment_length > offset:
+                block = self._get_block(block_index)
+                parts.append(block[start + max(offset - position, 0):start + min(end - position, segment_length)])
+            position += segment_length
+        return b"".join(parts)
+
+    def _append_data(self, data: Union[bytes, memoryview]) -> List[List[int]]:
+        """Puts data into the current block, sealing every block that gets full, and returns the segments."""
+        segments = []
+        data_view = memoryview(data)
+        position = 0
+        while position < len(data_view):
+            piece = data_view[position:position + self.block_size - len(self.current_block)]
+            segments.append([self._sealed_blocks, len(self.current_block), len(piece)])
+            self._block_refs[self._sealed_blocks] = self._block_refs.get(self._sealed_blocks, 0) + 1
+            self.current_block.extend(piece)
+            position += len(piece)
+
+            if len(self.current_block) >= self.block_size:
+                self._compress_current_block()
+        return segments
+
+    def _store_content(self, data: Union[bytes, memoryview], digest: Optional[str] = None) -> List[List[int]]:
+        """Returns the segments of data that is already stored, or appends it. Only costs a hash for known data."""
+        digest = digest or content_digest(data).hex()
+        segments = self.content_index.get(digest)
+        if segments is None:
+            segments = self._append_data(data)
+            self.content_index[digest] = [list(segment) for segment in segments]
+            return segments
+        for block_index, _, _ in segments:
+            self._block_refs[block_index] += 1
+        return [list(segment) for segment in segments]
 
     def add_file(self, filename: str, data: bytes) -> int:
-        if len(self.current_block) + len(data) > self.block_size:
-            self._compress_current_block()
+        """Adds a file, an existing file with the same name is replaced.
+        Files that don't fit into the current block start a new one, files larger than block_size span several."""
+        self._load_metadata_if_needed()
+        if filename in self.file_info:
+            self.remove_file(filename)
+        self._dirty = True
+        if self._needs_training() and self._sample_bytes < self.training_sample_size:
+            self._samples.append(bytes(data))
+            self._sample_bytes += len(data)
+
+        if self.dedup == "chunks":
+            segments = []
+            data_view = memoryview(data)
+            for start, end in content_defined_chunks(data):
+                for segment in self._store_content(data_view[start:end]):
+                    last = segments[-1] if segments else None
+                    if last is not None and last[0] == segment[0] and last[1] + last[2] == segment[1]:
+                        last[2] += segment[2]  # Merge chunks that ended up next to each other
+                        self._block_refs[segment[0]] -= 1
+                    else:
+                        segments.append(segment)
+        else:
+            digest = content_digest(data).hex() if self.dedup == "file" else None
+            if len(self.current_block) + len(data) > self.block_size and digest not in self.content_index:
+                self._compress_current_block()
+            segments = self._store_content(data, digest) if self.dedup == "file" else self._append_data(data)
 
         file_index = len(self.index_to_name)
         self.index_to_name.append(filename)
         self.file_info[filename] = {
             'index': file_index,
-            'block_index': len(self.block_offsets),
-            'start': len(self.current_block),
+            'blocks': segments,
             'length': len(data)
         }
-        self.current_block.extend(data)
-
-        if len(self.current_block) >= self.block_size:
-            self._compress_current_block()
-
+        if self.checksum_algorithm is not None:
+            self.file_info[filename]['checksum'] = checksum(data, self.checksum_algorithm)
         return file_index
 
     def get_entire_compressed_container(self) -> bytes:
-        self._compress_current_block()  # Compress any remaining data in the current block
-        index_data = json.dumps({'file_info': self.file_info, 'block_offsets': self.block_offsets, 'index_to_name': self.index_to_name}).encode()
-        compressed_index_data = self.compressor.process(index_data)
-        index_length = len(compressed_index_data).to_bytes(4, 'big')
-        return index_length + compressed_index_data + self.compressed_data
+        """Commits all changes and returns the raw bytes of the container range."""
+        self.update_compressed_container()
+        return self._read(0, self.region_size)
 
-    def extract_file_partial(self, file_identifier: Union[str, int], offset: int, length: int) -> bytes:
-        """Extracts a part of a file by direct access, only within the compressed container range."""
+    def extract_file(self, file_identifier: Union[str, int]) -> bytes:
+        self._load_metadata_if_needed()
         filename = file_identifier if isinstance(file_identifier, str) else self.index_to_name[file_identifier]
         file_info = self.file_info[filename]
-        block_info = self.block_offsets[file_info['block_index']]
-
-        with open(self.file_path, 'rb') as file:
-            # Calculate the position and ensure it's within the designated container range
-            start_position = self.container_start + block_info['start']
-            if start_position < self.container_start or start_position > self.container_end:
-                raise ValueError("Block start position is outside of the designated container range.")
+        data = self._read_segments(file_info['blocks'], 0, file_info['length'])
+        if self.verify_on_read:
+            self._check(data, file_info, f"File '{filename}'")
+        return data
 
-            file.seek(start_position)
-            compressed_block = file.read(block_info['length'])
-            decompressed_block = self.compressor.unprocess(compressed_block)
-
-        # Calculate the actual positions in the decompressed block
-        actual_start = file_info['start'] + offset
-        actual_end = actual_start + length
+    def extract_file_partial(self, file_identifier: Union[str, int], offset: int, length: int) -> bytes:
+        """Extracts a part of a file, only the blocks overlapping the range get decompressed."""
+        self._load_metadata_if_needed()
+        filename = file_identifier if isinstance(file_identifier, str) else self.index_to_name[file_identifier]
+        return self._read_segments(self.file_info[filename]['blocks'], offset, length)
 
-        return decompressed_block[actual_start:actual_end]
+    def open(self, file_identifier: Union[str, int]) -> "ContainerFile":
+        """Returns a read-only, seekable file object for one file."""
+        self._load_metadata_if_needed()
+        filename = file_identifier if isinstance(file_identifier, str) else self.index_to_name[file_identifier]
+        return ContainerFile(self, filename)
 
     def remove_file(self, file_identifier: Union[str, int]):
-        """Removes a file's metadata and index but does not modify the actual compressed data."""
+        """Removes a file from the index, its block is freed once no other file is stored in it."""
+        self._load_metadata_if_needed()
         filename = file_identifier if isinstance(file_identifier, str) else self.index_to_name[file_identifier]
 
         # Remove file info and update mappings
-        del self.file_info[filename]
-        self.index_to_name = [name for name in self.index_to_name if name != filename]
-        self.block_offsets = [offset for offset in self.block_offsets if self.file_info.get(filename, {}).get('block_index') != offset]
+        file_info = self.file_info.pop(filename)
+        self._dirty = True
+        self.index_to_name.remove(filename)
+        for i in range(file_info['index'], len(self.index_to_name)):
+            self.file_info[self.index_to_name[i]]['index'] = i
+
+        freed_blocks = set()
+        for block_index, _, _ in file_info['blocks']:
+            self._block_refs[block_index] -= 1
+            if self._block_refs[block_index] == 0:
+                del self._block_refs[block_index]
+                freed_blocks.add(block_index)
+                self._block_cache.pop(block_index, None)
+                if block_index < len(self.block_offsets):  # Blocks that are not stored yet are skipped when sealed
+                    block_info = self.block_offsets[block_index]
+                    self.block_offsets[block_index] = None
+                    self._pending_free.append((block_info['start'], block_info['length']))
+        if freed_blocks and self.content_index:
+            self.content_index = {digest: segments for digest, segments in self.content_index.items()
+                                  if not any(segment[0] in freed_blocks for segment in segments)}
+
+    def verify(self, workers: Optional[int] = None, deep: bool = False) -> List[dict]:
+        """Checks every stored block against its checksum on a thread pool, without unprocessing anything. Files with
+        a segment in a damaged block are reported with it. With deep every intact block is unprocessed once and all
+        files are checked against their own checksums. Returns the problems found, empty if the container is intact."""
+        self._load_metadata_if_needed()
+        self._flush_blocks()
+        if self.checksum_algorithm is None:
+            raise ValueError("The container was written without checksums.")
+        live_blocks = [i for i, block_info in enumerate(self.block_offsets) if block_info is not None]
+        damaged = {}
+        workers = workers or min(32, (os.cpu_count() or 1) + 4)  # The ThreadPoolExecutor default
+
+        def check_block(block_index: int) -> Optional[str]:
+            block_info = self.block_offsets[block_index]
+            if block_info.get('checksum') is None:
+                return None
+            if checksum(self._read(block_info['start'], block_info['length']),
+                        self.checksum_algorithm) != block_info['checksum']:
+                return "checksum mismatch"
+            return None
+
+        with ThreadPoolExecutor(workers) as executor:
+            for block_index, reason in zip(live_blocks, executor.map(check_block, live_blocks)):
+                if reason is not None:
+                    damaged[block_index] = reason
+            if deep:
+                file_problems = self._verify_files(executor, workers * 2, damaged)
+
+        problems = [{'kind': 'block', 'block_index': block_index, 'name': None, 'reason': reason}
+                    for block_index, reason in sorted(damaged.items())]
+        for filename in self.index_to_name:
+            damaged_blocks = [segment[0] for segment in self.file_info[filename]['blocks'] if segment[0] in damaged]
+            if damaged_blocks:
+                problems.append({'kind': 'file', 'block_index': damaged_blocks[0], 'name': filename,
+                                 'reason': "stored in a damaged block"})
+        return problems + (file_problems if deep else [])
+
+    def _verify_files(self, executor: ThreadPoolExecutor, max_in_flight: int, damaged: dict) -> List[dict]:
+        """Unprocesses the needed blocks in order with a few in flight and checks every file as soon as its last
+        block is there, a block is dropped once no unchecked file needs it. Blocks that fail are added to damaged."""
+        pending = {}  # Last block of a file -> files
+        block_users = {}
+        for filename, file_info in self.file_info.items():
+            used_blocks = {segment[0] for segment in file_info['blocks']}
+            if file_info.get('checksum') is None or not used_blocks or used_blocks & damaged.keys():
+                continue
+            pending.setdefault(max(used_blocks), []).append(filename)
+            for block_index in used_blocks:
+                block_users[block_index] = block_users.get(block_index, 0) + 1
+
+        def unprocess(block_index: int) -> bytes:
+            block_info = self.block_offsets[block_index]
+            return self.processor.unprocess(self._read(block_info['start'], block_info['length']))
+
+        order = iter(sorted(block_users))
+        in_flight = deque()
+
+        def fill():
+            for block_index in order:
+                in_flight.append((block_index, executor.submit(unprocess, block_index)))
+                if len(in_flight) >= max_in_flight:
+                    break
+
+        problems = []
+        blocks = {}
+        fill()
+        while in_flight:
+            block_index, future = in_flight.popleft()
+            fill()
+            try:
+                blocks[block_index] = future.result()
+            except Exception as e:
+                damaged[block_index] = f"unprocessing failed ({e})"
+
+            for filename in pending.pop(block_index, []):
+                file_info = self.file_info[filename]
+                segments = file_info['blocks']
+                if all(segment[0] in blocks for segment in segments):  # Otherwise reported with its damaged block
+                    data = b"".join(blocks[used_block][start:start + length] for used_block, start, length in segments)
+                    if checksum(data, self.checksum_algorithm) != file_info['checksum']:
+                        problems.append({'kind': 'file', 'block_index': segments[0][0], 'name': filename,
+                                         'reason': "checksum mismatch"})
+                for used_block in {segment[0] for segment in segments}:
+                    block_users[used_block] -= 1
+                    if block_users[used_block] == 0:
+                        blocks.pop(used_block, None)
+        return problems
 
     def get_compressed_container_info(self) -> Tuple[int, List[str]]:
         """Loads and returns basic info about the compressed container."""
-        if not self.file_info:
-            self.load_compressed_container_metadata()
+        self._load_metadata_if_needed()
         return len(self.file_info), self.index_to_name
 
+    def free_space(self) -> int:
+        """Bytes that can be allocated right now."""
+        self._load_metadata_if_needed()
+        return sum(length for _, length in self._free_extents)
+
     def update_compressed_container(self):
-        """Updates the metadata index in the compressed file to reflect changes."""
-        index_data = json.dumps({'file_info': self.file_info, 'block_offsets': self.block_offsets, 'index_to_name': self.index_to_name}).encode()
-        compressed_index_data = self.compressor.process(index_data)
-        index_length = len(compressed_index_data).to_bytes(4, 'big')
-
-        with open(self.file_path, 'r+b') as file:
-            file.seek(self.container_start)
-            file.write(index_length + compressed_index_data)  # Overwrite old index
-
-    def defragment(self):
-        "metadatawrtie" "mdw"
-        "metadataread" "mdr"
-        "metdadataclear" "mdc"
-
-        op_code = "mdw"
-        start_pos = 241 + self.container_start
-        end_pos = 256 + self.container_start
-        print(f"{op_code} | {start_pos}-{end_pos}")
-        """Optimizes the current blocks into one continuous block."""
-        with open(self.file_path, 'r+b') as file:
-            # Seek to the start of the container
-            file.seek(self.container_start)
-            next_write_position = 0
-            updated_block_offsets = []
-
-            # Read each block, decompress, recompress (if needed), and write back contiguously
-            for block_info in self.block_offsets:
-                file.seek(self.container_start + block_info['start'])
-                compressed_block = file.read(block_info['length'])
-                updated_block_offsets.append({
-                    'start': next_write_position,
-                    'length': block_info['length']
-                })
-                # Write block back at the new position
-                file.seek(self.container_start + next_write_position)
-                file.write(compressed_block)
-                next_write_position += block_info['length']
-
-            # Fill the rest of the container with zeros to clear leftover data
-            remaining_space = self.container_end - (self.container_start + next_write_position)
-            if remaining_space < 0:
-                raise ValueError("Defragmentation would overflow the container bounds.")
-
-            file.write(b'\0' * remaining_space)
-
-            # Update block offsets with their new positions
-            self.block_offsets = updated_block_offsets
-
-            # Optionally update the container's metadata here as well
+        """Writes the index into free space and then atomically points the superblock at it."""
+        self._load_metadata_if_needed()
+        self._flush_blocks()
+        index = {'file_info': self.file_info, 'block_offsets': self.block_offsets, 'index_to_name': self.index_to_name}
+        if self.checksum_algorithm is not None:
+            index['checksum_algorithm'] = self.checksum_algorithm
+        if self.content_index:
+            index['content_index'] = self.content_index
+        index_data = json.dumps(index).encode()
+        header = self.compressor.get_header()
+        if header and self.encryptor is not None:
+            header = self.encryptor.process(header)  # A trained dictionary holds pieces of the files
+        compressed_index_data = struct.pack(">I", len(header)) + header + self.processor.process(index_data)
+
+        index_offset = self._allocate(len(compressed_index_data))
+        self._write(index_offset, compressed_index_data)
+        self._sync()
+        self._write(0, _V4_SUPERBLOCK.pack(_V4_MAGIC, _V4_VERSION, 0, index_offset, len(compressed_index_data),
+                                           zlib.crc32(compressed_index_data)))
+        self._sync()
+
+        # The old index and the removed blocks aren't referenced on disk anymore
+        if self._index_extent is not None:
+            self._release(*self._index_extent)
+        self._index_extent = (index_offset, len(compressed_index_data))
+        for extent in self._pending_free:
+            self._release(*extent)
+        self._pending_free = []
+        self._dirty = False
+
+    def defragment(self, max_moves: Optional[int] = None) -> int:
+        """Moves live blocks into free space in front of them, one block at a time, and commits after every pass
+        so the previous location of a moved block stays valid until the index no longer points to it.
+        Returns the number of moved blocks."""
+        self.update_compressed_container()
+        moves = 0
+        moved = True
+        while moved and (max_moves is None or moves < max_moves):
+            moved = False
+            for block_info in sorted((info for info in self.block_offsets if info is not None),
+                                     key=lambda info: info['start']):
+                if max_moves is not None and moves >= max_moves:
+                    break
+                if not self._free_extents or self._free_extents[0][0] >= block_info['start']:
+                    continue
+                target = next((offset for offset, length in self._free_extents
+                               if offset < block_info['start'] and length >= block_info['length']), None)
+                if target is None:
+                    continue
+                self._write(self._allocate_at(target, block_info['length']),
+                            self._read(block_info['start'], block_info['length']))
+                self._pending_free.append((block_info['start'], block_info['length']))
+                block_info['start'] = target
+                self._dirty = True
+                moves += 1
+                moved = True
+            self.update_compressed_container()
+        return moves
+
+    def _allocate_at(self, offset: int, length: int) -> int:
+        for i, (free_offset, free_length) in enumerate(self._free_extents):
+            if free_offset == offset:
+                if free_length == length:
+                    del self._free_extents[i]
+                else:
+                    self._free_extents[i] = [offset + length, free_length - length]
+                return offset
+        raise ValueError(f"No free extent starts at {offset}.")
 
     def clear_unneeded(self):
-        pass
+        """Overwrites all free space with zeros."""
+        self.update_compressed_container()
+        for offset, length in self._free_extents:
+            for position in range(offset, offset + length, self.block_size):
+                self._write(position, b'\0' * min(self.block_size, offset + length - position))
+        self._sync()
 
     def optimize(self):
-        """Shifts all"""
+        """Shifts all blocks to the front and removes the traces of deleted blocks from the index."""
         self.defragment()
         self.delete_unneeded()
 
     def delete_unneeded(self):
-        pass
+        """Drops the empty slots removed blocks left in the block list and commits the renumbered index."""
+        self._load_metadata_if_needed()
+        self._flush_blocks()
+        new_block_indexes = {}
+        block_offsets = []
+        for block_index, block_info in enumerate(self.block_offsets):
+            if block_info is not None:
+                new_block_indexes[block_index] = len(block_offsets)
+                block_offsets.append(block_info)
+        for segments in [file_info['blocks'] for file_info in self.file_info.values()] + list(self.content_index.values()):
+            for segment in segments:
+                segment[0] = new_block_indexes[segment[0]]
+        self.block_offsets = block_offsets
+        self._block_cache.clear()
+        self._block_refs = {new_block_indexes[block_index]: refs for block_index, refs in self._block_refs.items()}
+        self._sealed_blocks = len(self.block_offsets)
+        self._dirty = True
+        self.update_compressed_container()
+
+    def close(self):
+        """Commits all changes, if there are any, and closes the file."""
+        if not self._file.closed:
+            if self._dirty:
+                self.update_compressed_container()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ContainerFile(io.RawIOBase):
+    """Read-only file object over one file of a FileContainerV4, reads only decompress the blocks they touch.
+    Wrap it in io.BufferedReader for many small reads."""
+    def __init__(self, container: FileContainerV4, filename: str):
+        super().__init__()
+        self.container = container
+        self.name = filename
+        file_info = container.file_info[filename]
+        self._segments = [list(segment) for segment in file_info['blocks']]
+        self._segment_starts = []
+        position = 0
+        for _, _, segment_length in self._segments:
+            self._segment_starts.append(position)
+            position += segment_length
+        self.length = file_info['length']
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def _read(self, size: int) -> bytes:
+        size = max(0, min(size, self.length - self._position))
+        if size == 0:
+            return b""
+        first_segment = bisect.bisect_right(self._segment_starts, self._position) - 1
+        data = self.container._read_segments(self._segments[first_segment:],
+                                             self._position - self._segment_starts[first_segment], size)
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        view = memoryview(buffer).cast("B")
+        data = self._read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def readall(self) -> bytes:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        return self._read(self.length - self._position)
+
+
+def benchmark_pipeline(data_size: int = 32 * 1024 * 1024, block_size: int = 1024 * 1024):
+    """Compares compression alone, compress-then-encrypt one block after another and the pipelined stages."""
+    import time
+    blocks = [(os.urandom(64) * (block_size // 64))[:block_size // 2] + os.urandom(block_size // 2)
+              for _ in range(max(1, data_size // block_size))]
+    compressor, encryptor = ZstdChunkCompressor(), AESChunkEncryptor()
+    pipeline = ProcessorPipeline(compressor, encryptor)
+    runs = (
+        ("compress only", lambda: [compressor.process(block) for block in blocks]),
+        ("compress+encrypt sequential", lambda: [pipeline.process(block) for block in blocks]),
+        ("compress+encrypt pipelined", lambda: list(pipeline.process_many(blocks))),
+    )
+    for name, run in runs:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {len(blocks) * block_size / elapsed / 1024 / 1024:.1f} MB/s")
 
 
 def local_test():
     try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            container_path = os.path.join(temp_dir, "container.bin")
+            with FileContainerV4(ZstdChunkCompressor(), EmptyChunkProcessor(), container_path, 64, 64 + 1024 * 1024,
+                                 block_size=64 * 1024) as in_place_container:
+                for i in range(64):
+                    in_place_container.add_file(f"file_{i}", os.urandom(256) * (i + 1))
+                for i in range(0, 64, 2):
+                    in_place_container.remove_file(f"file_{i}")
+                in_place_container.add_file("large_file", os.urandom(1024) * 200)
+                in_place_container.update_compressed_container()
+                in_place_container.optimize()
+                with in_place_container.open("large_file") as large_file:
+                    large_file.seek(100_000)
+                    if large_file.read(1000) != in_place_container.extract_file("large_file")[100_000:101_000]:
+                        raise ValueError("FileContainerV4 returned a wrong range")
+            with FileContainerV4(ZstdChunkCompressor(), EmptyChunkProcessor(), container_path, 64,
+                                 64 + 1024 * 1024) as in_place_container:
+                if sorted(in_place_container.index_to_name) != sorted([f"file_{i}" for i in range(1, 64, 2)]
+                                                                      + ["large_file"]):
+                    raise ValueError("FileContainerV4 lost files while optimizing")
+                print(f"FileContainerV4 free space after optimize: {in_place_container.free_space()} bytes")
+            deferred_container = FileContainerV4(ZstdChunkCompressor(), EmptyChunkProcessor(), container_path, 64,
+                                                 64 + 1024 * 1024, load_now=False)
+            deferred_container.add_file("late_file", b"late" * 1000)
+            deferred_container.close()
+            with FileContainerV4(ZstdChunkCompressor(), EmptyChunkProcessor(), container_path, 64,
+                                 64 + 1024 * 1024) as in_place_container:
+                if len(in_place_container.index_to_name) != 34 or not in_place_container.extract_file("file_1"):
+                    raise ValueError("Adding to a FileContainerV4 opened with load_now=False overwrote it")
+            with open(container_path, "rb") as f:
+                committed = f.read()
+            with FileContainerV4(ZstdChunkCompressor(), EmptyChunkProcessor(), container_path, 64,
+                                 64 + 1024 * 1024) as in_place_container:
+                in_place_container.extract_file("late_file")
+            with open(container_path, "rb") as f:
+                if f.read() != committed:
+                    raise ValueError("Closing an unchanged FileContainerV4 wrote to it")
+
+            encrypted_path = os.path.join(temp_dir, "encrypted.bin")
+            encryptor = AESChunkEncryptor()
+            with FileContainerV4(ZstdChunkCompressor(), encryptor, encrypted_path, 0, 1024 * 1024,
+                                 block_size=16 * 1024) as encrypted_container:
+                encrypted_container.add_file("secret", b"secret data " * 10_000)
+            with FileContainerV4(ZstdChunkCompressor(), encryptor, encrypted_path, 0,
+                                 1024 * 1024) as encrypted_container:
+                if encrypted_container.extract_file("secret") != b"secret data " * 10_000:
+                    raise ValueError("Encrypted FileContainerV4 returned wrong data")
+            with FileContainerV4(ZstdChunkCompressor(), encryptor, encrypted_path, 0, 1024 * 1024,
+                                 block_size=16 * 1024, workers=2, use_processes=True) as encrypted_container:
+                encrypted_container.add_file("secret_2", os.urandom(1024) * 64)
+                if encrypted_container.extract_file("secret_2")[:1024] * 64 != encrypted_container.extract_file(
+                        "secret_2"):
+                    raise ValueError("Encrypted FileContainerV4 returned wrong data with use_processes")
+
+            trained_path = os.path.join(temp_dir, "trained.bin")
+            records = [f'{{"id": {i}, "name": "user_{i}", "active": {str(i % 3 == 0).lower()}}}'.encode()
+                       for i in range(2000)]
+            with FileContainerV4(ZstdChunkCompressor(train_dictionary=True, dictionary_size=4096), encryptor,
+                                 trained_path, 0, 1024 * 1024, block_size=4096,
+                                 training_sample_size=32 * 1024) as trained_container:
+                for i, record in enumerate(records):
+                    trained_container.add_file(f"record_{i}", record)
+            trained_compressor = ZstdChunkCompressor()
+            with FileContainerV4(trained_compressor, encryptor, trained_path, 0, 1024 * 1024) as trained_container:
+                if trained_compressor.dictionary is None:
+                    raise ValueError("FileContainerV4 didn't store the trained dictionary")
+                if trained_container.extract_file("record_1999") != records[1999]:
+                    raise ValueError("Trained FileContainerV4 returned wrong data")
+
         compressor = BrotliChunkCompressor()
         container = FileContainerV3(compressor, block_size=2048 * 2048)
 
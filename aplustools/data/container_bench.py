@@ -0,0 +1,297 @@
+# Container benchmark suite
+#
+# Generates synthetic corpora (text, json, already compressed images, many tiny files), packs every corpus with every
+# container version and codec and measures compress/decompress MB/s, ratio, archive open time, p50/p99 single file
+# extraction latency and peak RSS. Everything is returned (and optionally written) as json, so runs of different
+# commits can be put next to each other with compare_results.
+
+from typing import Dict, List, Optional, Iterable, Callable
+import tempfile
+import random
+import struct
+import json
+import zlib
+import sys
+import os
+
+from aplustools.data import compressor as _compressor
+from aplustools.data import _bench
+
+
+_WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore "
+          "magna aliqua container block index stream archive compress extract offset length header footer").split()
+
+
+def _text_corpus(rng: random.Random, total_size: int) -> Dict[str, bytes]:
+    files = {}
+    size = 0
+    while size < total_size:
+        lines = [" ".join(rng.choices(_WORDS, k=rng.randint(4, 16))).capitalize() + "." for _ in range(rng.randint(20, 400))]
+        data = "\n".join(lines).encode()
+        files[f"text/doc_{len(files)}.txt"] = data
+        size += len(data)
+    return files
+
+
+def _json_corpus(rng: random.Random, total_size: int) -> Dict[str, bytes]:
+    files = {}
+    size = 0
+    while size < total_size:
+        records = [{"id": rng.randint(0, 10 ** 9), "name": " ".join(rng.choices(_WORDS, k=2)),
+                    "active": rng.random() < 0.5, "score": round(rng.uniform(0, 100), 3),
+                    "tags": rng.sample(_WORDS, rng.randint(0, 5))} for _ in range(rng.randint(5, 200))]
+        data = json.dumps(records, indent=2).encode()
+        files[f"json/records_{len(files)}.json"] = data
+        size += len(data)
+    return files
+
+
+def _png(width: int, height: int, pixels: bytes) -> bytes:
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+    rows = b"".join(b"\0" + pixels[y * width * 3:(y + 1) * width * 3] for y in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, 9)) + chunk(b"IEND", b""))
+
+
+def _image_corpus(rng: random.Random, total_size: int) -> Dict[str, bytes]:
+    files = {}
+    size = 0
+    while size < total_size:
+        width, height = rng.randint(64, 256), rng.randint(64, 256)
+        # Noisy gradients, so the deflate stream inside is already close to incompressible
+        pixels = bytes((x + y + rng.randint(0, 64)) & 0xFF for y in range(height) for x in range(width * 3))
+        data = _png(width, height, pixels)
+        files[f"images/image_{len(files)}.png"] = data
+        size += len(data)
+    return files
+
+
+def _tiny_corpus(rng: random.Random, total_size: int) -> Dict[str, bytes]:
+    files = {}
+    size = 0
+    while size < total_size:
+        data = f"key={rng.choice(_WORDS)}\nvalue={rng.randint(0, 10 ** 6)}\n".encode() * rng.randint(1, 8)
+        files[f"tiny/{len(files) // 1000}/entry_{len(files)}.cfg"] = data
+        size += len(data)
+    return files
+
+
+CORPORA: Dict[str, Callable[[random.Random, int], Dict[str, bytes]]] = {
+    "text": _text_corpus,
+    "json": _json_corpus,
+    "images": _image_corpus,
+    "tiny": _tiny_corpus,
+}
+
+
+def generate_corpus(kind: str, total_size: int = 4 * 1024 * 1024, seed: int = 0) -> Dict[str, bytes]:
+    """Returns {name: data} of roughly total_size bytes, the same seed always gives the same files."""
+    return _bench.generate_corpus(CORPORA, kind, total_size, seed)
+
+
+CODECS: Dict[str, Callable[[], "_compressor.ChunkCompressorBase"]] = {
+    "zstd": lambda: _compressor.ZstdCompressor(3),
+    "brotli": lambda: _compressor.BrotliChunkCompressor(quality=9),
+    "lzma": lambda: _compressor.LZMAChunkCompressor(),
+    "lzma2": lambda: _compressor.LZMA2Compressor(),
+    "auto": lambda: _compressor.AutoChunkCompressor(),
+}
+
+
+def _v4_processor(codec: str):
+    from aplustools.data import compressor_n  # Needs the cryptography package
+    return {
+        "zstd": lambda: compressor_n.ZstdChunkCompressor(3),
+        "brotli": lambda: compressor_n.BrotliChunkCompressor(quality=9),
+        "lzma": lambda: compressor_n.LZMAChunkCompressor(),
+        "lzma2": lambda: compressor_n.LZMA2ChunkCompressor(),
+        "auto": lambda: compressor_n.AutoChunkProcessor(),
+    }[codec]()
+
+
+class _InMemoryArchive:
+    """FileContainer, V2 and V3 only work on the whole container bytes."""
+    def __init__(self, container, path: str):
+        self._container = container
+        with open(path, "rb") as f:
+            self._data = f.read()
+
+    def extract(self, name: str) -> bytes:
+        return self._container.extract_file(self._data, name)
+
+    def close(self):
+        pass
+
+
+def _pack_in_memory(container_type) -> Callable:
+    def pack(files: Dict[str, bytes], codec: str, block_size: int, path: str):
+        container = container_type(CODECS[codec](), block_size)
+        for name, data in files.items():
+            container.add_file(name, data)
+        with open(path, "wb") as f:
+            f.write(container.get_compressed_container())
+    return pack
+
+
+def _open_in_memory(container_type) -> Callable:
+    def open_archive(codec: str, block_size: int, path: str, _):
+        return _InMemoryArchive(container_type(CODECS[codec](), block_size), path)
+    return open_archive
+
+
+def _pack_streaming(index_format: str) -> Callable:
+    def pack(files: Dict[str, bytes], codec: str, block_size: int, path: str):
+        with _compressor.StreamingFileContainerV3(CODECS[codec](), path, block_size,
+                                                  index_format=index_format) as container:
+            for name, data in files.items():
+                container.add_file(name, data)
+    return pack
+
+
+def _open_reader(codec: str, block_size: int, path: str, _):
+    return _compressor.ContainerReader(path, CODECS[codec](), cache_size=0)
+
+
+def _v4_region_end(raw_size: int) -> int:
+    return 64 * 1024 + raw_size * 2
+
+
+def _pack_v4(files: Dict[str, bytes], codec: str, block_size: int, path: str) -> int:
+    from aplustools.data.compressor_n import FileContainerV4
+    raw_size = sum(len(data) for data in files.values())
+    with FileContainerV4(_v4_processor(codec), None, path, 0, _v4_region_end(raw_size), block_size) as container:
+        for name, data in files.items():
+            container.add_file(name, data)
+        container.update_compressed_container()
+        return container.region_size - container.free_space()  # The region itself is preallocated
+
+
+class _V4Archive:
+    def __init__(self, codec: str, block_size: int, path: str, raw_size: int):
+        from aplustools.data.compressor_n import FileContainerV4
+        self._container = FileContainerV4(_v4_processor(codec), None, path, 0,
+                                          _v4_region_end(raw_size), block_size, cache_size=0)
+
+    def extract(self, name: str) -> bytes:
+        return self._container.extract_file(name)
+
+    def close(self):
+        self._container.close()
+
+
+# Container name -> (pack(files, codec, block size, path), open(codec, block size, path, raw size))
+# pack may return the archive size if it isn't the size of the file
+CONTAINERS = {
+    "v1": (_pack_in_memory(_compressor.FileContainer), _open_in_memory(_compressor.FileContainer)),
+    "v2": (_pack_in_memory(_compressor.FileContainerV2), _open_in_memory(_compressor.FileContainerV2)),
+    "v3": (_pack_in_memory(_compressor.FileContainerV3), _open_in_memory(_compressor.FileContainerV3)),
+    "v3_stream_json": (_pack_streaming("json"), _open_reader),
+    "v3_stream_binary": (_pack_streaming("binary"), _open_reader),
+    "v4": (_pack_v4, _V4Archive),
+}
+
+
+def run_case(corpus: str, container: str, codec: str, corpus_size: int = 4 * 1024 * 1024,
+             block_size: int = 1024 * 1024, latency_samples: int = 200, seed: int = 0) -> dict:
+    """Packs one corpus with one container and codec and returns the measurements."""
+    files = generate_corpus(corpus, corpus_size, seed)
+    raw_size = sum(len(data) for data in files.values())
+    pack, open_archive = CONTAINERS[container]
+    result = {"corpus": corpus, "container": container, "codec": codec, "files": len(files), "raw_size": raw_size,
+              "block_size": block_size}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "archive.bin")
+        compress_time, archive_size = _bench.timed(pack, files, codec, block_size, path)
+        if archive_size is None:
+            archive_size = os.path.getsize(path)
+
+        open_time, archive = _bench.timed(open_archive, codec, block_size, path, raw_size)
+        try:
+            def extract_all():
+                for name, data in files.items():
+                    if archive.extract(name) != data:
+                        raise ValueError(f"{container}/{codec} returned wrong data for {name}")
+            decompress_time, _ = _bench.timed(extract_all)
+
+            sample = random.Random(seed).choices(list(files), k=latency_samples)
+            latencies = sorted(_bench.timed(archive.extract, name)[0] for name in sample)
+        finally:
+            archive.close()
+
+    result.update({
+        "archive_size": archive_size,
+        "ratio": raw_size / archive_size,
+        "compress_mb_s": raw_size / compress_time / 1e6,
+        "decompress_mb_s": raw_size / decompress_time / 1e6,
+        "open_ms": open_time * 1e3,
+        "extract_p50_ms": _bench.percentile(latencies, 50) * 1e3,
+        "extract_p99_ms": _bench.percentile(latencies, 99) * 1e3,
+        "peak_rss_kb": _bench.peak_rss_kb(),
+    })
+    return result
+
+
+def run_benchmarks(corpora: Iterable[str] = tuple(CORPORA), containers: Iterable[str] = tuple(CONTAINERS),
+                   codecs: Iterable[str] = tuple(CODECS), corpus_size: int = 4 * 1024 * 1024,
+                   block_size: int = 1024 * 1024, latency_samples: int = 200, seed: int = 0, isolate: bool = True,
+                   output: Optional[str] = None) -> dict:
+    """Runs every combination and returns {"environment": ..., "results": [...]}.
+    With isolate every case runs in a fresh process, so peak_rss_kb belongs to that case alone and not to the
+    largest case before it. If output is given, the json is also written there."""
+    cases = [(corpus, container, codec, corpus_size, block_size, latency_samples, seed)
+             for corpus in corpora for container in containers for codec in codecs]
+    results = _bench.run_cases(run_case, cases, ("corpus", "container", "codec"), isolate)
+    return _bench.report(results, output, seed=seed, corpus_size=corpus_size, block_size=block_size,
+                         isolated=isolate)
+
+
+_HIGHER_IS_BETTER = {"ratio": True, "compress_mb_s": True, "decompress_mb_s": True, "open_ms": False,
+                     "extract_p50_ms": False, "extract_p99_ms": False, "peak_rss_kb": False}
+
+
+def compare_results(baseline: dict, current: dict, tolerance: float = 0.1) -> List[dict]:
+    """Returns every metric of current that is more than tolerance (relative) worse than in baseline."""
+    def key(result: dict):
+        return result["corpus"], result["container"], result["codec"]
+
+    baseline_results = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = baseline_results.get(key(result))
+        if old is None or "error" in old or "error" in result:
+            continue
+        for metric, higher_is_better in _HIGHER_IS_BETTER.items():
+            if not old.get(metric) or result.get(metric) is None:
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append({"corpus": result["corpus"], "container": result["container"],
+                                    "codec": result["codec"], "metric": metric, "baseline": old[metric],
+                                    "current": result[metric], "change": change})
+    return regressions
+
+
+def local_test():
+    try:
+        report = run_benchmarks(corpora=("text", "tiny"), containers=("v2", "v3_stream_binary"), codecs=("zstd",),
+                                corpus_size=64 * 1024, block_size=16 * 1024, latency_samples=20, isolate=False)
+        for result in report["results"]:
+            if "error" in result:
+                raise ValueError(f"{result['container']}/{result['codec']}: {result['error']}")
+            print(f"{result['corpus']:>6} {result['container']:>18} {result['codec']:>6}: ratio {result['ratio']:.2f}, "
+                  f"{result['compress_mb_s']:.1f}/{result['decompress_mb_s']:.1f} MB/s, "
+                  f"p99 {result['extract_p99_ms']:.3f} ms")
+        if compare_results(report, report):
+            raise ValueError("A run regressed against itself")
+    except Exception as e:
+        print(f"Exception occurred {e}.")
+        return False
+    print("Test completed successfully.")
+    return True
+
+
+if __name__ == "__main__":
+    # python -m aplustools.data.container_bench [output.json]
+    print(json.dumps(run_benchmarks(output=sys.argv[1] if len(sys.argv) > 1 else None), indent=2))
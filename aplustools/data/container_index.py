@@ -0,0 +1,327 @@
+# Binary container index
+
+# Layout (all integers little-endian):
+# Header, 16 bytes: magic b"APIX", u16 version, u16 reserved, u32 file count, u32 block count
+# Then sections, each with a 16 byte header: 4 byte tag, u32 item size, u64 payload length
+# Every payload is padded with zeros to a multiple of 8 bytes, so all arrays stay 8-byte aligned.
+#
+# Sections of version 1:
+# FILE -> u64 x3 per file: block index, start inside the decompressed block, length
+# BLCK -> u64 x2 per block: start inside the block data, compressed length
+# NOFF -> u64 per file + 1: offsets of every name inside NAME
+# NAME -> all utf-8 encoded names back to back
+# SORT -> u32 per file: file indexes ordered by their encoded name, used for binary search
+# Optional:
+# CALG -> name of the checksum algorithm, see CHECKSUM_ALGORITHMS
+# BSUM -> u64 per block: checksum of the compressed block as stored
+# FSUM -> u64 per file: checksum of the file data
+#
+# Every array section can be read without creating per-entry objects, with memoryview.cast/array.frombytes or
+# numpy.frombuffer(payload, "<u8").reshape(-1, 3). Unknown sections are skipped, so newer writers stay readable.
+
+from typing import Union, Tuple, List, Dict, Optional, Callable
+from abc import ABC, abstractmethod
+from array import array
+import struct
+import json
+import zlib
+import sys
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+BINARY_INDEX_MAGIC = b"APIX"
+BINARY_INDEX_VERSION = 1
+
+_HEADER = struct.Struct("<4sHHII")
+_SECTION = struct.Struct("<4sIQ")
+
+CHECKSUM_ALGORITHMS: Dict[str, Callable[[bytes], int]] = {"crc32": zlib.crc32}
+if xxhash is not None:
+    CHECKSUM_ALGORITHMS["xxh3_64"] = xxhash.xxh3_64_intdigest
+DEFAULT_CHECKSUM = "xxh3_64" if xxhash is not None else "crc32"  # Both run at several GB/s
+
+
+def checksum(data: bytes, algorithm: str = DEFAULT_CHECKSUM) -> int:
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError(f"Checksum algorithm '{algorithm}' is not available, install xxhash for xxh3_64")
+    return CHECKSUM_ALGORITHMS[algorithm](data)
+
+
+def _column(payload: memoryview, typecode: str) -> Union[memoryview, array]:
+    if sys.byteorder == "little":
+        return payload.cast(typecode)
+    column = array(typecode)
+    column.frombytes(payload)
+    column.byteswap()
+    return column
+
+
+def _pack_column(typecode: str, values) -> bytes:
+    column = array(typecode, values)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column.tobytes()
+
+
+def build_binary_index(file_info: Dict[str, dict], index_to_name: List[str], block_offsets: List[dict],
+                       checksum_algorithm: Optional[str] = None) -> bytes:
+    """Packs the dictionaries FileContainerV3 keeps while writing into the binary index format.
+    With a checksum_algorithm, the 'checksum' of every file and block entry is stored as well."""
+    encoded_names = [name.encode("utf-8") for name in index_to_name]
+    name_offsets = [0]
+    for encoded_name in encoded_names:
+        name_offsets.append(name_offsets[-1] + len(encoded_name))
+
+    files = []
+    for name in index_to_name:
+        info = file_info[name]
+        files.extend((info['block_index'], info['start'], info['length']))
+    blocks = []
+    for block_info in block_offsets:
+        blocks.extend((block_info['start'], block_info['length']))
+
+    sections = [
+        (b"FILE", 24, _pack_column("Q", files)),
+        (b"BLCK", 16, _pack_column("Q", blocks)),
+        (b"NOFF", 8, _pack_column("Q", name_offsets)),
+        (b"NAME", 1, b"".join(encoded_names)),
+        (b"SORT", 4, _pack_column("I", sorted(range(len(encoded_names)), key=encoded_names.__getitem__))),
+    ]
+    if checksum_algorithm is not None:
+        sections.extend([
+            (b"CALG", 1, checksum_algorithm.encode("ascii")),
+            (b"BSUM", 8, _pack_column("Q", [block_info['checksum'] for block_info in block_offsets])),
+            (b"FSUM", 8, _pack_column("Q", [file_info[name]['checksum'] for name in index_to_name])),
+        ])
+    parts = [_HEADER.pack(BINARY_INDEX_MAGIC, BINARY_INDEX_VERSION, 0, len(index_to_name), len(block_offsets))]
+    for tag, item_size, payload in sections:
+        parts.append(_SECTION.pack(tag, item_size, len(payload)))
+        parts.append(payload)
+        parts.append(bytes(-len(payload) % 8))
+    return b"".join(parts)
+
+
+class ContainerIndex(ABC):
+    """What containers and readers need from an index, no matter how it was stored."""
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @property
+    @abstractmethod
+    def block_count(self) -> int:
+        pass
+
+    @abstractmethod
+    def name(self, file_index: int) -> str:
+        pass
+
+    def names(self) -> List[str]:
+        return [self.name(i) for i in range(len(self))]
+
+    @abstractmethod
+    def find(self, filename: str) -> int:
+        """Returns the index of filename or -1."""
+
+    def lookup(self, file_identifier: Union[str, int]) -> int:
+        if isinstance(file_identifier, str):
+            file_index = self.find(file_identifier)
+            if file_index == -1:
+                raise KeyError(file_identifier)
+            return file_index
+        if not -len(self) <= file_identifier < len(self):
+            raise IndexError(f"File index {file_identifier} out of range")
+        return file_identifier % len(self)
+
+    @abstractmethod
+    def file_entry(self, file_index: int) -> Tuple[int, int, int]:
+        """Returns (block index, start, length)."""
+
+    @abstractmethod
+    def block_entry(self, block_index: int) -> Tuple[int, int]:
+        """Returns (start, compressed length)."""
+
+    @property
+    def checksum_algorithm(self) -> Optional[str]:
+        """None if the container was written without checksums."""
+        return None
+
+    def block_checksum(self, block_index: int) -> Optional[int]:
+        return None
+
+    def file_checksum(self, file_index: int) -> Optional[int]:
+        return None
+
+    def __contains__(self, filename: str) -> bool:
+        return self.find(filename) != -1
+
+
+class JsonContainerIndex(ContainerIndex):
+    """The json dictionaries of FileContainer (files/blocks) and FileContainerV2/V3
+    (file_info/block_offsets/index_to_name)."""
+    def __init__(self, index: dict):
+        if 'files' in index:  # FileContainer
+            self._file_info = index['files']
+            self._index_to_name = list(self._file_info)
+            self._block_offsets = index['blocks']
+        else:
+            self._file_info = index['file_info']
+            self._index_to_name = index['index_to_name']
+            self._block_offsets = index['block_offsets']
+        self._checksum_algorithm = index.get('checksum_algorithm')
+        self._name_to_index = {name: i for i, name in enumerate(self._index_to_name)}
+
+    def __len__(self) -> int:
+        return len(self._index_to_name)
+
+    @property
+    def block_count(self) -> int:
+        return len(self._block_offsets)
+
+    def name(self, file_index: int) -> str:
+        return self._index_to_name[file_index]
+
+    def names(self) -> List[str]:
+        return list(self._index_to_name)
+
+    def find(self, filename: str) -> int:
+        return self._name_to_index.get(filename, -1)
+
+    def file_entry(self, file_index: int) -> Tuple[int, int, int]:
+        info = self._file_info[self._index_to_name[file_index]]
+        return info['block_index'], info['start'], info['length']
+
+    def block_entry(self, block_index: int) -> Tuple[int, int]:
+        block_info = self._block_offsets[block_index]
+        return block_info['start'], block_info['length']
+
+    @property
+    def checksum_algorithm(self) -> Optional[str]:
+        return self._checksum_algorithm
+
+    def block_checksum(self, block_index: int) -> Optional[int]:
+        return self._block_offsets[block_index].get('checksum')
+
+    def file_checksum(self, file_index: int) -> Optional[int]:
+        return self._file_info[self._index_to_name[file_index]].get('checksum')
+
+
+class BinaryContainerIndex(ContainerIndex):
+    """Reads the binary index in place, entries are only turned into Python objects when they are asked for."""
+    def __init__(self, index_data: bytes):
+        view = memoryview(index_data)
+        magic, self.version, _, self._file_count, self._block_count = _HEADER.unpack_from(view)
+        if magic != BINARY_INDEX_MAGIC:
+            raise ValueError("Not a binary container index.")
+        if self.version > BINARY_INDEX_VERSION:
+            raise ValueError(f"Binary index version {self.version} is newer than the supported "
+                             f"version {BINARY_INDEX_VERSION}.")
+
+        self.sections: Dict[bytes, memoryview] = {}
+        position = _HEADER.size
+        while position < len(view):
+            tag, _, length = _SECTION.unpack_from(view, position)
+            position += _SECTION.size
+            self.sections[tag] = view[position:position + length]
+            position += length + (-length % 8)
+
+        self._files = _column(self.sections[b"FILE"], "Q")
+        self._blocks = _column(self.sections[b"BLCK"], "Q")
+        self._name_offsets = _column(self.sections[b"NOFF"], "Q")
+        self._names = self.sections[b"NAME"]
+        self._sorted = _column(self.sections[b"SORT"], "I")
+        self._checksum_algorithm = None
+        if b"CALG" in self.sections:
+            self._checksum_algorithm = bytes(self.sections[b"CALG"]).decode("ascii")
+            self._block_checksums = _column(self.sections[b"BSUM"], "Q")
+            self._file_checksums = _column(self.sections[b"FSUM"], "Q")
+
+    def __len__(self) -> int:
+        return self._file_count
+
+    @property
+    def block_count(self) -> int:
+        return self._block_count
+
+    def _encoded_name(self, file_index: int) -> bytes:
+        return bytes(self._names[self._name_offsets[file_index]:self._name_offsets[file_index + 1]])
+
+    def name(self, file_index: int) -> str:
+        return self._encoded_name(file_index).decode("utf-8")
+
+    def find(self, filename: str) -> int:
+        encoded_name = filename.encode("utf-8")
+        low, high = 0, self._file_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._encoded_name(self._sorted[middle]) < encoded_name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._file_count and self._encoded_name(self._sorted[low]) == encoded_name:
+            return self._sorted[low]
+        return -1
+
+    def file_entry(self, file_index: int) -> Tuple[int, int, int]:
+        position = file_index * 3
+        return self._files[position], self._files[position + 1], self._files[position + 2]
+
+    def block_entry(self, block_index: int) -> Tuple[int, int]:
+        return self._blocks[block_index * 2], self._blocks[block_index * 2 + 1]
+
+    @property
+    def checksum_algorithm(self) -> Optional[str]:
+        return self._checksum_algorithm
+
+    def block_checksum(self, block_index: int) -> Optional[int]:
+        return self._block_checksums[block_index] if self._checksum_algorithm is not None else None
+
+    def file_checksum(self, file_index: int) -> Optional[int]:
+        return self._file_checksums[file_index] if self._checksum_algorithm is not None else None
+
+
+def load_container_index(index_data: bytes) -> ContainerIndex:
+    """Opens a decompressed index, binary or json."""
+    if index_data[:4] == BINARY_INDEX_MAGIC:
+        return BinaryContainerIndex(index_data)
+    return JsonContainerIndex(json.loads(index_data))
+
+
+def local_test():
+    try:
+        file_info = {name: {'index': i, 'block_index': i // 3, 'start': (i % 3) * 10, 'length': 10,
+                            'checksum': checksum(name.encode())}
+                     for i, name in enumerate(["b.txt", "a.json", "über.svg", "c", "", "a"])}
+        index_to_name = list(file_info)
+        block_offsets = [{'start': 0, 'length': 17, 'checksum': 1}, {'start': 17, 'length': 23, 'checksum': 2}]
+
+        binary_index = load_container_index(build_binary_index(file_info, index_to_name, block_offsets,
+                                                               DEFAULT_CHECKSUM))
+        json_index = load_container_index(json.dumps({'file_info': file_info, 'block_offsets': block_offsets,
+                                                      'index_to_name': index_to_name,
+                                                      'checksum_algorithm': DEFAULT_CHECKSUM}).encode())
+        for index in (binary_index, json_index):
+            if index.names() != index_to_name or index.block_count != 2 or "missing" in index:
+                raise ValueError(f"{type(index).__name__} lost names or blocks")
+            for i, name in enumerate(index_to_name):
+                info = file_info[name]
+                if index.lookup(name) != i or index.file_entry(i) != (info['block_index'], info['start'], info['length']):
+                    raise ValueError(f"{type(index).__name__} returned a wrong entry for {name!r}")
+                if index.file_checksum(i) != info['checksum']:
+                    raise ValueError(f"{type(index).__name__} returned a wrong checksum for {name!r}")
+            if index.checksum_algorithm != DEFAULT_CHECKSUM or index.block_checksum(1) != 2:
+                raise ValueError(f"{type(index).__name__} lost the block checksums")
+            print(f"{type(index).__name__}: {len(index)} files, last block {index.block_entry(1)}")
+    except Exception as e:
+        print(f"Exception occurred {e}.")
+        return False
+    print("Test completed successfully.")
+    return True
+
+
+if __name__ == "__main__":
+    local_test()
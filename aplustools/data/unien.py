@@ -8,27 +8,32 @@
 # 110 -> 21 bits (~2 million code points)
 # 111 -> 0 bits
 
-# We have 1 bit to tell us if it's in relation to the last chunk (bundle)
-# 0 -> Off
-# 1 -> On
+# We have 1 bit to tell us if it's in relation to the last character (bundle)
+# 0 -> Off, the data is the code point
+# 1 -> On, the data is the signed (two's complement) difference to the last code point
 
 # Then we have the rest of the data so it looks like this:
 
 # 1 Encoded:
 # 0 0 0000 0001
-# ^ Size
+# ^ ^
+# Size & in-relation
+
+# "ĀĂ" Encoded (Ă is Ā in relation +2, which fits into 8 instead of 16 bits):
+# 10 0 0000 0001 0000 0000 0 1 0000 0010
+# ^^ ^                     ^ ^
+# Size & in-relation
+
+# "aa" Encoded (the same character again is in relation +0, which needs 0 bits):
+# 0 0 0110 0001 111 1
 
 # At the very end of the last chunk, it appends one 1 and then 0 to fill the last byte
 # (Only if the communication can only transmit full bytes)
+# Characters can be split between chunks at any bit, the decoder carries the bit position over to the next chunk.
 
-# or 10 000 that is a bundle end (If something is in-between a bundle start and a bundle end it is automatically
-# in-relation, even if in-relation is turned off, so usually it's turned off and implied)
-# 10 1 0 0010 0111 0001 0000
-# ^^ ^ ^
-# Size & in-relation & end of a bundle
-
-from aplustools.data import (encode_possible_negative_int, encode_positive_int, nice_bits, bits, nice_number,
-                             decode_possible_negative_int, set_bits, decode_positive_int, bit_length)
+from aplustools.data import nice_number, set_bits, bits
+from typing import Iterable, Iterator, Tuple, List
+import random
 import math
 
 
@@ -103,44 +108,200 @@ def pack_number_at_end(num, total_bytes):
     return output
 
 
+# Length indicator, its bit count and the data bits for values of 0, 1, 2 and 3 bytes
+_WIDTHS = ((0b111, 3, 0), (0b0, 1, 8), (0b10, 2, 16), (0b110, 3, 21))
+_MAX_CODE_POINT = 0x10FFFF
+
+
+def _absolute_width(code_point: int) -> int:
+    if code_point == 0:
+        return 0
+    elif code_point < 1 << 8:
+        return 1
+    elif code_point < 1 << 16:
+        return 2
+    return 3
+
+
+def _relative_width(difference: int) -> int:
+    if difference == 0:
+        return 0
+    elif -(1 << 7) <= difference < 1 << 7:
+        return 1
+    elif -(1 << 15) <= difference < 1 << 15:
+        return 2
+    return 3
+
+
+def encode_char(code_point: int, last_code_point: int = 0) -> Tuple[int, int]:
+    """Returns the bits of one character as (value, bit count), in relation to last_code_point if that's shorter."""
+    if not 0 <= code_point <= _MAX_CODE_POINT:
+        raise ValueError(f"Code point {code_point} can't be encoded")
+    width = _absolute_width(code_point)
+    difference = code_point - last_code_point
+    relative_width = _relative_width(difference)
+    bundle = relative_width < width
+    if bundle:
+        width = relative_width
+        code_point = difference & ((1 << _WIDTHS[width][2]) - 1)
+    prefix, prefix_bits, data_bits = _WIDTHS[width]
+    return (((prefix << 1) | bundle) << data_bits) | code_point, prefix_bits + 1 + data_bits
+
+
+_ENCODE_TABLES = None
+# Decoding table, indexed by the first 4 bits of a character (length indicator and in-relation bit):
+# (bit count of the character, data mask, sign bit of in-relation data, in-relation)
+_HEADS = tuple((1 + 1 + 8, 0xFF, 1 << 7, bool(head & 0b0100)) if head < 0b1000 else
+               (2 + 1 + 16, 0xFFFF, 1 << 15, bool(head & 0b0010)) if head < 0b1100 else
+               (3 + 1 + 21, 0x1FFFFF, 1 << 20, bool(head & 0b0001)) if head < 0b1110 else
+               (3 + 1, 0, 0, bool(head & 0b0001)) for head in range(16))
+
+
+def _encode_tables() -> Tuple[List[int], List[int]]:
+    """The characters (value << 5 | bit count) for code points below 65536 and in-relation differences from -32768 to
+    32767, so encoding only has to pick the shorter of two entries. Built on first use."""
+    global _ENCODE_TABLES
+    if _ENCODE_TABLES is None:
+        absolute = [value << 5 | bit_count for value, bit_count in map(encode_char, range(1 << 16))]
+        relative = []
+        for difference in range(-(1 << 15), 1 << 15):
+            prefix, prefix_bits, data_bits = _WIDTHS[_relative_width(difference)]
+            relative.append((((prefix << 1 | 1) << data_bits) | difference & ((1 << data_bits) - 1)) << 5
+                            | prefix_bits + 1 + data_bits)
+        _ENCODE_TABLES = absolute, relative
+    return _ENCODE_TABLES
+
+
+class UnienEncoder:
+    """Incremental encoder, returns only full bytes and keeps the bits of a started byte for the next call."""
+    def __init__(self):
+        self._bits = 0
+        self._bit_count = 0
+        self._last_code_point = 0
+
+    def encode(self, data: str, final: bool = False) -> bytes:
+        absolute, relative = _encode_tables()
+        bits, bit_count, last_code_point = self._bits, self._bit_count, self._last_code_point
+        encoded = bytearray()
+        for char in data:
+            code_point = ord(char)
+            entry = absolute[code_point] if code_point < 1 << 16 else ((0b1100 << 21) | code_point) << 5 | 25
+            difference = code_point - last_code_point + (1 << 15)
+            if 0 <= difference < 1 << 16 and relative[difference] & 31 < entry & 31:
+                entry = relative[difference]
+            bits = (bits << (entry & 31)) | (entry >> 5)
+            bit_count += entry & 31
+            if bit_count >= 256:
+                full_bits = bit_count & ~7
+                bit_count -= full_bits
+                encoded += (bits >> bit_count).to_bytes(full_bits // 8, "big")
+                bits &= (1 << bit_count) - 1
+            last_code_point = code_point
+        full_bits = bit_count & ~7
+        encoded += (bits >> (bit_count - full_bits)).to_bytes(full_bits // 8, "big")
+        self._bits, self._bit_count = bits & ((1 << (bit_count - full_bits)) - 1), bit_count - full_bits
+        self._last_code_point = last_code_point
+        if final:
+            encoded += self.flush()
+        return bytes(encoded)
+
+    def flush(self, terminate: bool = True) -> bytes:
+        """Ends the stream, with the 1 end marker if terminate is set, and pads the last byte with 0s."""
+        bits, bit_count = self._bits, self._bit_count
+        if terminate:
+            bits, bit_count = bits << 1 | 1, bit_count + 1
+        encoded = (bits << (-bit_count % 8)).to_bytes((bit_count + 7) // 8, "big")
+        self.reset()
+        return encoded
+
+    def reset(self):
+        self._bits = 0
+        self._bit_count = 0
+        self._last_code_point = 0
+
+
+class UnienDecoder:
+    """Incremental decoder, characters can be split across chunks at any bit."""
+    def __init__(self):
+        self._pending = b""
+        self._bit_position = 0
+        self._last_code_point = 0
+
+    def decode(self, chunk: bytes, final: bool = False) -> str:
+        data = self._pending + bytes(chunk)
+        padded = data + bytes(4)  # Every character fits into a 4 byte window, even at the end
+        position, total_bits = self._bit_position, len(data) * 8
+        last_code_point = self._last_code_point
+        heads = _HEADS
+        chars = []
+
+        while total_bits - position >= 4:
+            byte = position >> 3
+            window = int.from_bytes(padded[byte:byte + 4], "big") << (position & 7)
+            bit_count, mask, sign_bit, in_relation = heads[(window >> 28) & 15]
+            if total_bits - position < bit_count:
+                break
+            value = (window >> (32 - bit_count)) & mask
+            if in_relation:
+                value = ((value + sign_bit) & mask) - sign_bit + last_code_point
+                if not 0 <= value <= _MAX_CODE_POINT:
+                    raise ValueError(f"Invalid Unien data, decoded code point {value} at bit {position}")
+            elif value > _MAX_CODE_POINT:
+                raise ValueError(f"Invalid Unien data, decoded code point {value} at bit {position}")
+            chars.append(value)
+            last_code_point = value
+            position += bit_count
+
+        if final:
+            rest_bits = total_bits - position
+            rest = int.from_bytes(data[position >> 3:], "big") & ((1 << rest_bits) - 1)
+            if rest_bits > 8 or rest not in (0, 1 << max(rest_bits - 1, 0)):
+                raise ValueError("Incomplete Unien data, the stream ends inside of a character")
+            self.reset()
+        else:
+            self._pending = data[position >> 3:]
+            self._bit_position = position & 7
+            self._last_code_point = last_code_point
+        return "".join(map(chr, chars))
+
+    def reset(self):
+        self._pending = b""
+        self._bit_position = 0
+        self._last_code_point = 0
+
+
+def encode_iter(strings: Iterable[str], terminate: bool = True) -> Iterator[bytes]:
+    """Encodes every string as the next part of one stream, empty byte chunks are skipped."""
+    encoder = UnienEncoder()
+    for string in strings:
+        encoded = encoder.encode(string)
+        if encoded:
+            yield encoded
+    encoded = encoder.flush(terminate)
+    if encoded:
+        yield encoded
+
+
+def decode_iter(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Decodes the chunks of one stream, yields the characters that were completed by every chunk."""
+    decoder = UnienDecoder()
+    for chunk in chunks:
+        decoded = decoder.decode(chunk)
+        if decoded:
+            yield decoded
+    decoded = decoder.decode(b"", final=True)
+    if decoded:
+        yield decoded
+
+
 class UnienEnAndDeCoder:
     def __init__(self):
+        self._decoder = UnienDecoder()
         self._buffer = ""
         self._completed = ""
 
     def add_chunk(self, chunk: bytes, completed: bool = True):
-        bit_str = nice_bits(chunk)
-        decoded_str = ""
-        last_char_value = 0
-        bit_index = 0
-
-        if completed:
-            bit_str = bit_str.rstrip("0")[:-1]
-
-        while bit_index < len(bit_str):
-            length_encoding, len_bits_len = decode_length_svf(3, bit_str[bit_index:])
-            length_encoding = {4: 0,
-                               1: 1,
-                               2: 2,
-                               3: 3}[length_encoding]
-
-            bit_index += len_bits_len
-
-            bundle = int(bit_str[bit_index])
-            bit_index += 1
-
-            bit_index += length_encoding * 8 if bit_index != 3 else 21
-            char_bits = bit_str[bit_index:bit_index + bit_index]
-
-            if bundle:
-                char_value = decode_possible_negative_int(encode_positive_int(int(char_bits, 2))) + last_char_value
-            else:
-                char_value = decode_positive_int(encode_positive_int(int(char_bits, 2)))
-
-            decoded_str += chr(char_value)
-            last_char_value = char_value
-
-        self._buffer += decoded_str
+        self._buffer += self._decoder.decode(chunk, final=completed)
         if completed:
             self._completed += self._buffer
             self._buffer = ""
@@ -157,51 +318,59 @@ class UnienEnAndDeCoder:
 
     @staticmethod
     def encode(data: str, completed: bool = True) -> bytes:
-        last_char_value = 0
-        final_byte_arr = bytearray()
-        i, bits_len = 0, 0
-        for char in data:
-            char_length, bundle = len(encode_positive_int(ord(char))), 0
-
-            char_value = ord(char)
-            char_bytes = encode_positive_int(char_value)
-
-            bundle_num = encode_possible_negative_int(char_value - last_char_value)
-            if len(bundle_num) < len(char_bytes):
-                bundle = 1
-                char_length = len(bundle_num)
-
-            to_pack_len = {0: 4,
-                           1: 1,
-                           2: 2,
-                           3: 3}[char_length]
-            length_encoding, len_bits_len = encode_length_svf(3, to_pack_len)
-
-            # Pack everything into the length_encoding
-            meta_bytes = set_bits(length_encoding, len_bits_len, str(bundle))
-            len_bits_len += 1
-            if bundle:
-                new_char_value = char_value - last_char_value
-                char_bytes = encode_possible_negative_int(new_char_value)
-                # meta_bytes = meta_bytes[
-                #              :-(len(char_bytes) - len(encode_possible_negative_int(char_value - last_char_value)))]
-                # print("BU")
-
-            to_set_bytes = set_bits(meta_bytes, len_bits_len, nice_bits(char_bytes))
-            final_byte_arr = set_bits(final_byte_arr, bits_len, nice_bits(to_set_bytes), return_bytearray=True,
-                                      auto_expand=True)
-            # if bundle:
-            #     print(bits(final_byte_arr), bits(meta_bytes), len_bits_len, nice_bits(char_bytes))
-            # final_byte_arr[i:i+len(to_set_bytes)] = to_set_bytes
-            i += len(to_set_bytes)
-
-            last_char_value = char_value
-            bits_len += len_bits_len + ((len(char_bytes) * 8) if len(char_bytes) != 3 else 21)
-            i += 1
+        encoder = UnienEncoder()
+        return encoder.encode(data) + encoder.flush(completed)
 
-        if completed:
-            final_byte_arr = set_bits(final_byte_arr, bits_len, "1", return_bytearray=True, auto_expand=True)
-        return bytes(final_byte_arr)
+    @staticmethod
+    def decode(data: bytes) -> str:
+        return UnienDecoder().decode(data, final=True)
+
+
+def _split_randomly(sequence, rng: random.Random):
+    start = 0
+    while start < len(sequence):
+        end = start + rng.randint(0, 40)
+        yield sequence[start:end]
+        start = end
+
+
+def local_test():
+    try:
+        every_code_point = "".join(map(chr, range(_MAX_CODE_POINT + 1)))
+        if UnienEnAndDeCoder.decode(UnienEnAndDeCoder.encode(every_code_point)) != every_code_point:
+            raise ValueError("Round trip over every code point failed")
+        descending = every_code_point[::-7]
+        if UnienEnAndDeCoder.decode(UnienEnAndDeCoder.encode(descending, False)) != descending:
+            raise ValueError("Round trip over descending code points (unterminated) failed")
+
+        rng = random.Random(15)
+        for _ in range(200):
+            text = "".join(chr(rng.choice((rng.randrange(128), rng.randrange(0x800), rng.randrange(0x110000))))
+                           for _ in range(rng.randrange(80)))
+            encoded = UnienEnAndDeCoder.encode(text)
+            if "".join(decode_iter(_split_randomly(encoded, rng))) != text:
+                raise ValueError(f"Chunked decode of {text!r} failed")
+            if b"".join(encode_iter(_split_randomly(text, rng))) != encoded:
+                raise ValueError(f"Chunked encode of {text!r} doesn't match the encoding at once")
+
+        coder = UnienEnAndDeCoder()
+        coder.add_chunk(UnienEnAndDeCoder.encode("Hello"))
+        coder.add_chunk(UnienEnAndDeCoder.encode("Hello ")[:3], completed=False)
+        partial = coder.get_buffer()
+        coder.add_chunk(UnienEnAndDeCoder.encode("Hello ")[3:])
+        if coder.get_completed() != "Hello" + "Hello "[len(partial):] or not "Hello ".startswith(partial):
+            raise ValueError("UnienEnAndDeCoder lost characters between chunks")
+        try:
+            UnienEnAndDeCoder.decode(UnienEnAndDeCoder.encode("\U0001F44B")[:2])
+        except ValueError:
+            pass
+        else:
+            raise ValueError("Truncated data was decoded without an error")
+    except Exception as e:
+        print(f"Exception occurred {e}.")
+        return False
+    print("Test completed successfully.")
+    return True
 
 
 if __name__ == "__main__":
@@ -216,3 +385,4 @@ if __name__ == "__main__":
     un.add_chunk(encoded_uni_str)
     un.add_chunk(normal_str)
     print(un.get_completed())
+    local_test()
@@ -0,0 +1,126 @@
+# Unien benchmark suite
+#
+# Generates multilingual text (latin prose, CJK prose, emoji heavy chat logs and a mix of all three) and encodes and
+# decodes it with Unien, UTF-8 and UTF-16, reporting bytes per character and MB/s. MB/s always means megabytes of the
+# text as UTF-8 per second, so the numbers of different codecs can be compared directly.
+
+from typing import Dict, Iterable, Optional, Callable, Tuple
+import random
+import json
+import sys
+
+from aplustools.data import unien as _unien
+from aplustools.data import _bench
+
+
+_LATIN_WORDS = ("the quick brown fox jumps over lazy dog während über straße größe café déjà vu naïve façade "
+                "año señor mañana smörgåsbord crème brûlée encoder decoder stream chunk").split()
+_CJK_CHARS = ("的一是不了人我在有他这中大来上国个到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么心多"
+              "天而能好都然没日于起还发成事只作当想看文无开手十用主行方又如前所本见经头面公同三已老从动两长知民样现分将外但身"
+              "ひらがなカタカナです。ますこんにちは世界、")
+_EMOJIS = "😀😂🥲😍🤔👍👎🙏🔥🎉💯✨🚀❤️🥳😅😭🙃👀🍕☕🐍"
+_CHAT_WORDS = ("lol ok sure brb gg wp see you tomorrow did you push the fix yes no maybe haha nice build is green again "
+               "deploying now").split()
+
+
+def _latin_text(rng: random.Random, chars: int) -> str:
+    text = []
+    size = 0
+    while size < chars:
+        sentence = " ".join(rng.choices(_LATIN_WORDS, k=rng.randint(4, 14))).capitalize() + ". "
+        text.append(sentence)
+        size += len(sentence)
+    return "".join(text)[:chars]
+
+
+def _cjk_text(rng: random.Random, chars: int) -> str:
+    text = []
+    size = 0
+    while size < chars:
+        sentence = "".join(rng.choices(_CJK_CHARS, k=rng.randint(8, 30))) + rng.choice("。、！？")
+        text.append(sentence)
+        size += len(sentence)
+    return "".join(text)[:chars]
+
+
+def _chat_text(rng: random.Random, chars: int) -> str:
+    text = []
+    size = 0
+    while size < chars:
+        words = rng.choices(_CHAT_WORDS, k=rng.randint(1, 8))
+        for _ in range(rng.randint(1, 4)):
+            words.insert(rng.randint(0, len(words)), "".join(rng.choices(_EMOJIS, k=rng.randint(1, 3))))
+        line = f"[{rng.randint(0, 23):02}:{rng.randint(0, 59):02}] user{rng.randint(1, 9)}: {' '.join(words)}\n"
+        text.append(line)
+        size += len(line)
+    return "".join(text)[:chars]
+
+
+def _mixed_text(rng: random.Random, chars: int) -> str:
+    parts = (_latin_text, _cjk_text, _chat_text)
+    return "".join(rng.choice(parts)(rng, rng.randint(50, 400)) for _ in range(chars // 225 + 1))[:chars]
+
+
+CORPORA: Dict[str, Callable[[random.Random, int], str]] = {
+    "latin": _latin_text,
+    "cjk": _cjk_text,
+    "emoji_chat": _chat_text,
+    "mixed": _mixed_text,
+}
+
+
+def generate_corpus(kind: str, chars: int = 1_000_000, seed: int = 0) -> str:
+    """Returns chars characters of the corpus, the same seed always gives the same text."""
+    return _bench.generate_corpus(CORPORA, kind, chars, seed)
+
+
+CODECS: Dict[str, Tuple[Callable[[str], bytes], Callable[[bytes], str]]] = {
+    "unien": (_unien.UnienEnAndDeCoder.encode, _unien.UnienEnAndDeCoder.decode),
+    "utf-8": (lambda text: text.encode("utf-8"), lambda data: data.decode("utf-8")),
+    "utf-16": (lambda text: text.encode("utf-16-le"), lambda data: data.decode("utf-16-le")),
+}
+
+
+def run_case(corpus: str, codec: str, chars: int = 1_000_000, repeats: int = 3, seed: int = 0) -> dict:
+    """Encodes and decodes one corpus with one codec and returns the measurements."""
+    text = generate_corpus(corpus, chars, seed)
+    utf8_size = len(text.encode("utf-8"))
+    encode, decode = CODECS[codec]
+    decode(encode(text[:1000]))  # Warm up, so lazily built tables aren't part of the measurement
+    encode_time, encoded = _bench.best_time(encode, text, repeats=repeats)
+    decode_time, decoded = _bench.best_time(decode, encoded, repeats=repeats)
+    if decoded != text:
+        raise ValueError(f"{codec} didn't round trip the {corpus} corpus")
+    return {"corpus": corpus, "codec": codec, "chars": len(text), "size": len(encoded),
+            "bytes_per_char": len(encoded) / len(text), "encode_mb_s": utf8_size / encode_time / 1e6,
+            "decode_mb_s": utf8_size / decode_time / 1e6}
+
+
+def run_benchmarks(corpora: Iterable[str] = tuple(CORPORA), codecs: Iterable[str] = tuple(CODECS),
+                   chars: int = 1_000_000, repeats: int = 3, seed: int = 0, output: Optional[str] = None) -> dict:
+    """Runs every combination and returns {"environment": ..., "results": [...]}, also written to output if given."""
+    cases = [(corpus, codec, chars, repeats, seed) for corpus in corpora for codec in codecs]
+    return _bench.report(_bench.run_cases(run_case, cases, ("corpus", "codec")), output, seed=seed, chars=chars)
+
+
+def local_test():
+    try:
+        report = run_benchmarks(chars=20_000, repeats=1)
+        for result in report["results"]:
+            if "error" in result:
+                raise ValueError(f"{result['corpus']}/{result['codec']}: {result['error']}")
+            print(f"{result['corpus']:>10} {result['codec']:>6}: {result['bytes_per_char']:.3f} bytes/char, "
+                  f"{result['encode_mb_s']:.2f}/{result['decode_mb_s']:.2f} MB/s")
+        sizes = {(result["corpus"], result["codec"]): result["size"] for result in report["results"]}
+        if sizes[("latin", "unien")] > sizes[("latin", "utf-16")]:
+            raise ValueError("Unien is larger than UTF-16 on latin text")
+    except Exception as e:
+        print(f"Exception occurred {e}.")
+        return False
+    print("Test completed successfully.")
+    return True
+
+
+if __name__ == "__main__":
+    # python -m aplustools.data.unien_bench [output.json]
+    print(json.dumps(run_benchmarks(output=sys.argv[1] if len(sys.argv) > 1 else None), indent=2))
@@ -0,0 +1,316 @@
+# Variable length integer codecs
+#
+# LEB128: 7 bits per byte, least significant group first, every byte but the last has the high bit set.
+# ZigZag: maps signed to unsigned ints (0, -1, 1, -2, ... -> 0, 1, 2, 3, ...) before LEB128, so small negative
+# numbers stay short as well.
+# Group varint: a LEB128 count, then groups of 4 unsigned 32 bit ints, each group is one tag byte holding the byte
+# length - 1 of every value (2 bits each, first value in the lowest bits) followed by the values in little-endian.
+# The last group only has the remaining values.
+#
+# encode_many/decode_many work on whole sequences and return array('q'), so decoded values need no Python int per
+# element once the call returns. With NumPy installed, LEB128 and ZigZag use vectorized paths for larger inputs.
+
+from typing import Iterable, Optional, Tuple, Union
+from array import array
+
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
+
+_BytesLike = Union[bytes, bytearray, memoryview]
+NUMPY_THRESHOLD = 4096  # Below this many values (or bytes) setting up NumPy arrays costs more than it saves
+_INT64_MIN, _INT64_MAX, _UINT64_MAX = -(1 << 63), (1 << 63) - 1, (1 << 64) - 1
+
+
+def _numpy_wanted(size: int, use_numpy: Optional[bool]) -> bool:
+    if use_numpy and _np is None:
+        raise RuntimeError("NumPy is not installed")
+    return _np is not None and (size >= NUMPY_THRESHOLD if use_numpy is None else use_numpy)
+
+
+def _numpy_encode_unsigned(values) -> bytes:
+    """Vectorized LEB128 of a uint64 array, one pass per 7 bit group instead of one per value."""
+    if not len(values):
+        return b""
+    lengths = _np.ones(len(values), dtype=_np.int64)
+    for group in range(1, 10):
+        lengths += values >= _np.uint64(1 << (7 * group))
+    starts = _np.cumsum(lengths) - lengths
+    encoded = _np.empty(int(lengths.sum()), dtype=_np.uint8)
+    for group in range(int(lengths.max())):
+        has_group = lengths > group
+        group_bits = (values[has_group] >> _np.uint64(7 * group)) & _np.uint64(0x7F)
+        continued = (lengths[has_group] > group + 1).astype(_np.uint64) << _np.uint64(7)
+        encoded[starts[has_group] + group] = group_bits | continued
+    return encoded.tobytes()
+
+
+def _numpy_decode_unsigned(buffer: _BytesLike):
+    """Vectorized LEB128 decoding into a uint64 array."""
+    data = _np.frombuffer(buffer, dtype=_np.uint8)
+    if not len(data):
+        return _np.zeros(0, dtype=_np.uint64)
+    if data[-1] & 0x80:
+        raise ValueError("Incomplete LEB128 data, the last value has no end")
+    ends = _np.flatnonzero(data < 0x80)
+    starts = _np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts + 1
+    if lengths.max() > 10 or (data[ends[lengths == 10]] > 1).any():
+        raise ValueError("LEB128 value is larger than 64 bits")
+    shifts = (_np.arange(len(data)) - _np.repeat(starts, lengths)).astype(_np.uint64) * _np.uint64(7)
+    return _np.bitwise_or.reduceat((data & 0x7F).astype(_np.uint64) << shifts, starts)
+
+
+class LEB128:
+    """Unsigned LEB128 varints from 0 to 2**64 - 1 (decode_many up to 2**63 - 1, as it returns array('q'))."""
+    @staticmethod
+    def encode(value: int) -> bytes:
+        if not 0 <= value <= _UINT64_MAX:
+            raise ValueError(f"{value} is out of the unsigned 64 bit range")
+        encoded = bytearray()
+        while value > 0x7F:
+            encoded.append((value & 0x7F) | 0x80)
+            value >>= 7
+        encoded.append(value)
+        return bytes(encoded)
+
+    @staticmethod
+    def decode(buffer: _BytesLike, offset: int = 0) -> Tuple[int, int]:
+        """Returns the value at offset and the offset right after it."""
+        value = shift = 0
+        for position in range(offset, min(len(buffer), offset + 10)):
+            byte = buffer[position]
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                if value > _UINT64_MAX:
+                    break
+                return value, position + 1
+            shift += 7
+        raise ValueError(f"Invalid or incomplete LEB128 value at offset {offset}")
+
+    @classmethod
+    def encode_many(cls, values: Iterable[int], use_numpy: Optional[bool] = None) -> bytes:
+        """Encodes all values back to back, use_numpy None picks NumPy for large inputs if it's installed."""
+        values = values if hasattr(values, "__len__") else list(values)
+        if _numpy_wanted(len(values), use_numpy):
+            return cls._numpy_encode(values)
+        if len(values) and 0 <= min(values) and max(values) < 0x80:
+            # Every value is a single byte, bytes() of an array or ndarray would copy its memory instead
+            return bytes(values if isinstance(values, (list, tuple)) else list(values))
+        encoded = bytearray()
+        append = encoded.append
+        for value in values:
+            if not 0 <= value <= _UINT64_MAX:
+                raise ValueError(f"{value} is out of the unsigned 64 bit range")
+            while value > 0x7F:
+                append((value & 0x7F) | 0x80)
+                value >>= 7
+            append(value)
+        return bytes(encoded)
+
+    @classmethod
+    def decode_many(cls, buffer: _BytesLike, use_numpy: Optional[bool] = None) -> array:
+        if _numpy_wanted(len(buffer), use_numpy):
+            return cls._numpy_decode(buffer)
+        if not len(buffer) or max(buffer) < 0x80:
+            return array("q", list(buffer))  # Every value is a single byte
+        try:
+            return array("q", cls._decode_unsigned(buffer))
+        except OverflowError:
+            raise ValueError("Decoded value doesn't fit into a signed 64 bit int") from None
+
+    @staticmethod
+    def _decode_unsigned(buffer: _BytesLike) -> list:
+        values = []
+        append = values.append
+        value = shift = 0
+        for byte in bytes(buffer):
+            if byte & 0x80:
+                value |= (byte & 0x7F) << shift
+                shift += 7
+                if shift > 63:
+                    raise ValueError("LEB128 value is larger than 64 bits")
+            else:
+                append(value | (byte << shift))
+                value = shift = 0
+        if shift:
+            raise ValueError("Incomplete LEB128 data, the last value has no end")
+        if values and max(values) > _UINT64_MAX:  # The 10th byte of a value may only hold the 64th bit
+            raise ValueError("LEB128 value is larger than 64 bits")
+        return values
+
+    @staticmethod
+    def _numpy_encode(values) -> bytes:
+        values = _np.asarray(values)
+        if values.dtype.kind not in "iu" and len(values):
+            values = _np.asarray(values, dtype=object)  # Python ints beyond int64, checked below
+        if len(values) and (values.min() < 0 or values.max() > _UINT64_MAX):
+            raise ValueError("Values are out of the unsigned 64 bit range")
+        return _numpy_encode_unsigned(values.astype(_np.uint64))
+
+    @staticmethod
+    def _numpy_decode(buffer: _BytesLike) -> array:
+        values = _numpy_decode_unsigned(buffer)
+        if len(values) and values.max() > _np.uint64(_INT64_MAX):
+            raise ValueError("Decoded value doesn't fit into a signed 64 bit int")
+        return array("q", values.astype(_np.int64).tobytes())
+
+
+class ZigZag(LEB128):
+    """Signed varints from -2**63 to 2**63 - 1, zigzag mapped and stored as LEB128."""
+    @staticmethod
+    def to_unsigned(value: int) -> int:
+        if not _INT64_MIN <= value <= _INT64_MAX:
+            raise ValueError(f"{value} is out of the signed 64 bit range")
+        return (value << 1) ^ (value >> 63)
+
+    @staticmethod
+    def to_signed(value: int) -> int:
+        return (value >> 1) ^ -(value & 1)
+
+    @classmethod
+    def encode(cls, value: int) -> bytes:
+        return LEB128.encode(cls.to_unsigned(value))
+
+    @classmethod
+    def decode(cls, buffer: _BytesLike, offset: int = 0) -> Tuple[int, int]:
+        value, offset = LEB128.decode(buffer, offset)
+        return cls.to_signed(value), offset
+
+    @classmethod
+    def encode_many(cls, values: Iterable[int], use_numpy: Optional[bool] = None) -> bytes:
+        values = values if hasattr(values, "__len__") else list(values)
+        if _numpy_wanted(len(values), use_numpy):
+            values = _np.asarray(values)
+            if values.dtype.kind not in "iu" or (values.dtype.kind == "u" and values.max(initial=0) > _INT64_MAX):
+                values = _np.asarray([cls.to_unsigned(int(value)) for value in values.tolist()], dtype=_np.uint64)
+                return _numpy_encode_unsigned(values)
+            values = values.astype(_np.int64)
+            return _numpy_encode_unsigned(((values << 1) ^ (values >> 63)).view(_np.uint64))
+        return LEB128.encode_many([cls.to_unsigned(value) for value in values], use_numpy=False)
+
+    @classmethod
+    def decode_many(cls, buffer: _BytesLike, use_numpy: Optional[bool] = None) -> array:
+        if _numpy_wanted(len(buffer), use_numpy):
+            values = _numpy_decode_unsigned(buffer)
+            signed = (values >> _np.uint64(1)).view(_np.int64) ^ -(values & _np.uint64(1)).view(_np.int64)
+            return array("q", signed.tobytes())
+        return array("q", [(value >> 1) ^ -(value & 1) for value in LEB128._decode_unsigned(buffer)])
+
+
+def _group_layout(tag: int) -> Tuple[Tuple[int, int], ...]:
+    """(start, end) of the 4 values behind a tag byte, relative to the first value byte."""
+    layout, start = [], 0
+    for index in range(4):
+        end = start + ((tag >> (2 * index)) & 3) + 1
+        layout.append((start, end))
+        start = end
+    return tuple(layout)
+
+
+_GROUP_LAYOUTS = tuple(_group_layout(tag) for tag in range(256))
+
+
+class GroupVarint:
+    """Unsigned 32 bit ints in groups of 4 behind a tag byte, decoding needs one table lookup per group."""
+    @staticmethod
+    def encode_many(values: Iterable[int]) -> bytes:
+        values = list(values)
+        encoded = bytearray(LEB128.encode(len(values)))
+        for group_start in range(0, len(values), 4):
+            tag, body = 0, bytearray()
+            for index, value in enumerate(values[group_start:group_start + 4]):
+                if not 0 <= value <= 0xFFFFFFFF:
+                    raise ValueError(f"{value} is out of the unsigned 32 bit range")
+                length = 1 if value < 1 << 8 else 2 if value < 1 << 16 else 3 if value < 1 << 24 else 4
+                tag |= (length - 1) << (2 * index)
+                body += value.to_bytes(length, "little")
+            encoded.append(tag)
+            encoded += body
+        return bytes(encoded)
+
+    @staticmethod
+    def decode_many(buffer: _BytesLike) -> array:
+        buffer = bytes(buffer)
+        count, position = LEB128.decode(buffer)
+        from_bytes = int.from_bytes
+        values = array("q")
+        append = values.append
+        try:
+            while len(values) < count:
+                layout = _GROUP_LAYOUTS[buffer[position]][:count - len(values)]
+                base = position + 1
+                for start, end in layout:
+                    append(from_bytes(buffer[base + start:base + end], "little"))
+                position = base + layout[-1][1]
+        except IndexError:
+            raise ValueError("Incomplete group varint data") from None
+        if position > len(buffer):
+            raise ValueError("Incomplete group varint data")
+        return values
+
+
+def local_test():
+    try:
+        import random
+        rng = random.Random(17)
+        unsigned = [0, 1, 127, 128, 300, 16383, 16384, _INT64_MAX] + [rng.getrandbits(rng.randint(1, 63))
+                                                                      for _ in range(5000)]
+        signed = [0, -1, 1, -64, 64, _INT64_MIN, _INT64_MAX] + [rng.getrandbits(rng.randint(1, 63))
+                                                                * rng.choice((1, -1)) for _ in range(5000)]
+        uint32 = [0, 255, 256, 65535, 65536, 0xFFFFFF, 0x1000000, 0xFFFFFFFF] + [rng.getrandbits(rng.randint(1, 32))
+                                                                                 for _ in range(4001)]
+        numpy_modes = (False, True) if _np is not None else (False,)
+
+        if LEB128.encode(300) != b"\xac\x02" or LEB128.decode(b"\x00\xac\x02", 1) != (300, 3):
+            raise ValueError("LEB128 doesn't match the reference encoding")
+        if ZigZag.encode(-1) != b"\x01" or ZigZag.encode(1) != b"\x02" or ZigZag.encode(_INT64_MIN)[-1] != 1:
+            raise ValueError("ZigZag doesn't match the reference encoding")
+        for use_numpy in numpy_modes:
+            for codec, values in ((LEB128, unsigned), (ZigZag, signed), (LEB128, list(range(128)))):
+                encoded = codec.encode_many(values, use_numpy=use_numpy)
+                if encoded != b"".join(map(codec.encode, values)):
+                    raise ValueError(f"{codec.__name__}.encode_many (numpy {use_numpy}) differs from encode")
+                decoded = codec.decode_many(encoded, use_numpy=use_numpy)
+                if not isinstance(decoded, array) or decoded.typecode != "q" or decoded.tolist() != values:
+                    raise ValueError(f"{codec.__name__} (numpy {use_numpy}) didn't round trip")
+            for codec in (LEB128, ZigZag):
+                for broken in (b"\x80", b"\x01\xff\xff", b"\xff" * 9 + b"\x02", b"\xff" * 10 + b"\x01"):
+                    try:
+                        codec.decode_many(broken, use_numpy=use_numpy)
+                    except ValueError:
+                        pass
+                    else:
+                        raise ValueError(f"Invalid data {broken!r} (numpy {use_numpy}) was decoded by "
+                                         f"{codec.__name__}")
+        small = [0, 1, 5, 127]
+        inputs = [array("q", small), array("B", small)] + ([_np.array(small)] if _np is not None else [])
+        for use_numpy in numpy_modes:
+            for codec in (LEB128, ZigZag):
+                for values in inputs + [array("q", unsigned[:100])]:
+                    decoded = codec.decode_many(codec.encode_many(values, use_numpy=use_numpy), use_numpy=use_numpy)
+                    if decoded.tolist() != list(values):
+                        raise ValueError(f"{codec.__name__} (numpy {use_numpy}) didn't round trip "
+                                         f"{type(values).__name__} input")
+        for values in (uint32, uint32[:5], []):
+            if GroupVarint.decode_many(GroupVarint.encode_many(values)).tolist() != values:
+                raise ValueError(f"GroupVarint didn't round trip {len(values)} values")
+        if len(GroupVarint.encode_many([1, 2, 3, 4])) != 6:
+            raise ValueError("GroupVarint used more than one byte for small values")
+        try:
+            GroupVarint.decode_many(GroupVarint.encode_many(uint32)[:-1])
+        except ValueError:
+            pass
+        else:
+            raise ValueError("Incomplete group varint data was decoded")
+    except Exception as e:
+        print(f"Exception occurred {e}.")
+        return False
+    print("Test completed successfully.")
+    return True
+
+
+if __name__ == "__main__":
+    local_test()
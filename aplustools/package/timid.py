@@ -1,13 +1,25 @@
 from typing import (Callable as _Callable, Union as _Union, List as _List, Tuple as _Tuple, Optional as _Optional,
-                    Type as _Type, Iterable as _Iterable, Any as _Any, Generator as _Generator, Literal as _Literal)
-from sklearn.linear_model import RANSACRegressor as _RANSACRegressor
+                    Type as _Type, Iterable as _Iterable, Any as _Any, Generator as _Generator, Literal as _Literal,
+                    AsyncGenerator as _AsyncGenerator)
 from datetime import timedelta as _timedelta, datetime as _datetime
-from scipy.optimize import curve_fit as _curve_fit
-from timeit import default_timer as _default_timer
+from array import array as _array
 import threading as _threading
+import statistics as _statistics
+import itertools as _itertools
+import asyncio as _asyncio
 import pickle as _pickle
+import json as _json
+import queue as _queue
+import heapq as _heapq
+import random as _random
 import time as _time
+import gc as _gc
 import numpy as _np
+import os as _os
+
+
+_get_ident = _threading.get_ident
+_perf_counter_ns = _time.perf_counter_ns
 
 
 class TimeFormat:
@@ -237,248 +249,675 @@ class SmallTimeDiff:
         return -self._timedelta.total_seconds() if self.negative else self._timedelta.total_seconds()
 
 
+def _percentile(sorted_values: _List[float], percent: float) -> float:
+    """Linear interpolation between the closest ranks, like numpy.percentile."""
+    position = (len(sorted_values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class BenchResult:
+    """The result of TimidTimer.bench, all times are nanoseconds per call."""
+
+    def __init__(self, name: str, timings: _List[float], loops: int, overhead_ns: float, clock: str = "TimidTimer"):
+        if not timings:
+            raise ValueError("A benchmark result needs at least one timing")
+        self.name, self.timings, self.loops, self.clock = name, list(timings), loops, clock
+        self.overhead_ns = overhead_ns
+        ordered = sorted(self.timings)
+        self.min, self.max = ordered[0], ordered[-1]
+        self.median, self.mean = _statistics.median(ordered), _statistics.fmean(ordered)
+        self.stdev = _statistics.stdev(ordered) if len(ordered) > 1 else 0.0
+        self.p95, self.p99 = _percentile(ordered, 95), _percentile(ordered, 99)
+        self.q1, self.q3 = _percentile(ordered, 25), _percentile(ordered, 75)
+        iqr = self.q3 - self.q1  # Tukey's fences, mild outliers are past 1.5 IQR and severe ones past 3 IQR
+        self.outliers = sum(not self.q1 - 1.5 * iqr <= t <= self.q3 + 1.5 * iqr for t in ordered)
+        self.severe_outliers = sum(not self.q1 - 3 * iqr <= t <= self.q3 + 3 * iqr for t in ordered)
+        self.ops_per_sec = 1e9 / self.median if self.median > 0 else None  # Too fast to be told apart from nothing
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "clock": self.clock, "loops": self.loops, "repeats": len(self.timings),
+                "overhead_ns": self.overhead_ns, "min": self.min, "median": self.median, "mean": self.mean,
+                "stdev": self.stdev, "p95": self.p95, "p99": self.p99, "max": self.max, "outliers": self.outliers,
+                "severe_outliers": self.severe_outliers, "ops_per_sec": self.ops_per_sec, "timings": self.timings}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BenchResult":
+        return cls(data["name"], data["timings"], data["loops"], data["overhead_ns"], data.get("clock", "TimidTimer"))
+
+    def to_json(self, indent: _Optional[int] = None) -> str:
+        return _json.dumps(self.to_dict(), indent=indent)
+
+    @classmethod
+    def from_json(cls, json_str: str) -> "BenchResult":
+        return cls.from_dict(_json.loads(json_str))
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            f.write(self.to_json(indent=2))
+
+    @classmethod
+    def load(cls, path: str) -> "BenchResult":
+        with open(path) as f:
+            return cls.from_json(f.read())
+
+    def compare(self, baseline: "BenchResult") -> dict:
+        """Compares the medians, the change only counts as significant if the interquartile ranges don't overlap."""
+        ratio = self.median / baseline.median if baseline.median else float("inf")
+        significant = self.q1 > baseline.q3 or self.q3 < baseline.q1
+        verdict = ("slower" if ratio > 1 else "faster") if significant else "same"
+        return {"name": self.name, "baseline": baseline.name, "ratio": ratio, "change_percent": (ratio - 1) * 100,
+                "significant": significant, "verdict": verdict}
+
+    def __str__(self) -> str:
+        ops_per_sec = f"{self.ops_per_sec:,.0f}" if self.ops_per_sec is not None else "inf"
+        return (f"{self.name}: {self.median:.1f} ns median (min {self.min:.1f}, mean {self.mean:.1f} +- "
+                f"{self.stdev:.1f}, p95 {self.p95:.1f}, p99 {self.p99:.1f}), {ops_per_sec} ops/s, "
+                f"{self.outliers} outliers, {len(self.timings)} x {self.loops} loops")
+
+    def __repr__(self) -> str:
+        return f"BenchResult({self.name!r}, median={self.median}, repeats={len(self.timings)}, loops={self.loops})"
+
+
+_EMPTY = -(1 << 63)  # Start of an unused timer index
+_NO_LIMIT = (1 << 63) - 1  # Pause without a maximum duration
+_LOCK_CREATION = _threading.Lock()
+_SAMPLE_CHUNK = 512  # Tick/tock samples are collected in a list and moved into the index's array in chunks this big
+_ASYNC_SPIN_MARGIN = 1_500_000  # Event loops wake up to about a millisecond late, the rest is done by yielding to it
+
+
+_MIN_MEASUREMENT = 50_000  # ns
+
+
+def _loops_needed(func: _Callable, args: tuple, kwargs: dict, clock: _Callable) -> int:
+    """Calls faster than _MIN_MEASUREMENT are looped, so the clock's own resolution doesn't decide the result."""
+    start = clock()
+    func(*args, **kwargs)
+    return min(1000, _MIN_MEASUREMENT // max(clock() - start, 1) + 1)
+
+
+def _time_per_call(func: _Callable, args: tuple, kwargs: dict, loops: int, clock: _Callable) -> float:
+    start = clock()
+    for _ in range(loops):
+        func(*args, **kwargs)
+    return (clock() - start) / loops
+
+
+def _median_time(func: _Callable, args: tuple, kwargs: dict, repeats: int, clock: _Callable = _perf_counter_ns
+                 ) -> float:
+    """Median time of repeats measurements in nanoseconds per call, module level so process pools can pickle it."""
+    gc_was_enabled = _gc.isenabled()
+    _gc.disable()
+    try:
+        loops = _loops_needed(func, args, kwargs, clock)
+        times = [_time_per_call(func, args, kwargs, loops, clock) for _ in range(repeats)]
+    finally:
+        if gc_was_enabled:
+            _gc.enable()
+    return _statistics.median(times)
+
+
+def _interleaved_median_times(func: _Callable, inputs: list, repeats: int, clock: _Callable = _perf_counter_ns
+                              ) -> _List[float]:
+    """Like _median_time for every input, but every round measures all inputs once in a new random order. Timing
+    the sizes one after another in increasing order turns any drift of the machine into a trend over N."""
+    gc_was_enabled = _gc.isenabled()
+    _gc.disable()
+    try:
+        loops = [_loops_needed(func, args, kwargs, clock) for args, kwargs in inputs]
+        times = [[] for _ in inputs]
+        order = list(range(len(inputs)))
+        for _ in range(repeats):
+            _random.shuffle(order)
+            for index in order:
+                args, kwargs = inputs[index]
+                times[index].append(_time_per_call(func, args, kwargs, loops[index], clock))
+    finally:
+        if gc_was_enabled:
+            _gc.enable()
+    return [_statistics.median(input_times) for input_times in times]
+
+
+_COMPLEXITY_CLASSES = {  # The features every class is a linear combination of
+    "O(1)": lambda n: _np.ones((len(n), 1)),
+    "O(log N)": lambda n: _np.column_stack((_np.log(n), _np.ones(len(n)))),
+    "O(sqrt(N))": lambda n: _np.column_stack((_np.sqrt(n), _np.ones(len(n)))),
+    "O(N)": lambda n: _np.column_stack((n, _np.ones(len(n)))),
+    "O(N log N)": lambda n: _np.column_stack((n * _np.log(n), _np.ones(len(n)))),
+    "O(N^2)": lambda n: _np.column_stack((n ** 2, _np.ones(len(n)))),
+    "O(N^3)": lambda n: _np.column_stack((n ** 3, _np.ones(len(n)))),
+}
+
+
+_GROWTH_SIGNIFICANCE = 3  # How many residual spreads the growth term has to add over the measured sizes
+
+
+def _fit_complexity_classes(sizes, times) -> dict:
+    """Least squares fit of every complexity class, residuals are relative to the time so slow sizes don't drown
+    out fast ones. Classes that only fit with a negative growth term, or with one that is lost in the noise of the
+    measurements, are left out."""
+    count = len(sizes)
+    models = {}
+    for name, features in _COMPLEXITY_CLASSES.items():
+        design = features(sizes)
+        parameters = design.shape[1]
+        if count <= parameters:
+            continue
+        coefficients, *_ = _np.linalg.lstsq(design / times[:, None], _np.ones(count), rcond=None)
+        if parameters > 1 and coefficients[0] < 0:
+            continue
+        predictions = design @ coefficients
+        rss = max(float(_np.sum(((times - predictions) / times) ** 2)), 1e-300)
+        if parameters > 1:  # Noise alone gives every growth class a small slope that fits a little better than O(1)
+            growth = coefficients[0] * (design[:, 0].max() - design[:, 0].min()) / _np.median(times)
+            if growth < _GROWTH_SIGNIFICANCE * _np.sqrt(rss / (count - parameters)):
+                continue
+        log_likelihood_term = count * _np.log(rss / count)
+        models[name] = {
+            "coefficients": coefficients,
+            "constants": dict(zip(("a", "b"), coefficients.tolist())),
+            "aic": float(log_likelihood_term + 2 * parameters),
+            "bic": float(log_likelihood_term + parameters * _np.log(count)),
+            "r2": float(1 - _np.sum((times - predictions) ** 2) / max(_np.sum((times - times.mean()) ** 2), 1e-300)),
+        }
+    return models
+
+
+def _noop(*_, **__):
+    pass
+
+
+_sched_yield = getattr(_os, "sched_yield", None) or (lambda: _time.sleep(0))
+_SLEEP_CALIBRATION: _Optional[dict] = None
+# A yield can hand the core away for a whole time slice when something else is runnable, so the spin only yields
+# while more than this is left and burns the core for the last stretch
+_YIELD_ABOVE_NS = 200_000
+
+
+def calibrate_sleep(samples: int = 200, sleep_ms: float = 1) -> dict:
+    """Measures how late time.sleep(sleep_ms) wakes up on this platform. Precise waits sleep until margin_ns before
+    their deadline and spin for the rest, margin_ns is the 99th percentile overshoot (which is just the maximum
+    below 100 samples, so one preempted sleep would make every wait spin for it)."""
+    global _SLEEP_CALIBRATION
+    requested = int(sleep_ms * 1e6)
+    overshoots = []
+    for _ in range(samples):
+        start = _perf_counter_ns()
+        _time.sleep(sleep_ms / 1000)
+        overshoots.append(_perf_counter_ns() - start - requested)
+    overshoots.sort()
+    p99 = int(_percentile(overshoots, 99))
+    _SLEEP_CALIBRATION = {
+        "samples": samples, "sleep_ns": requested, "min_ns": overshoots[0],
+        "median_ns": int(_percentile(overshoots, 50)), "p99_ns": p99, "max_ns": overshoots[-1],
+        "margin_ns": max(0, p99),
+    }
+    return _SLEEP_CALIBRATION
+
+
+def sleep_calibration() -> dict:
+    """The calibration precise waits use, calibrated on first use."""
+    if _SLEEP_CALIBRATION is None:
+        with _LOCK_CREATION:
+            if _SLEEP_CALIBRATION is None:
+                calibrate_sleep()
+    return _SLEEP_CALIBRATION
+
+
+def wait_until(deadline: int, yield_above_ns: int = _YIELD_ABOVE_NS):
+    """Waits until perf_counter_ns() reaches deadline, sleeping while that's safe and spinning for the last margin.
+    The spin yields the core while more than yield_above_ns is left, so other threads can run during long spins, and
+    only burns it for the rest, since a yield on a busy core can come back a whole time slice late (see
+    benchmark_wait)."""
+    margin = (_SLEEP_CALIBRATION or sleep_calibration())["margin_ns"]
+    remaining = deadline - _perf_counter_ns()
+    while remaining > margin:
+        _time.sleep((remaining - margin) / 1e9)
+        remaining = deadline - _perf_counter_ns()
+    while deadline - _perf_counter_ns() > yield_above_ns:
+        _sched_yield()  # Gives other threads the core instead of only burning it
+    while _perf_counter_ns() < deadline:
+        pass
+
+
+class TimerHandle:
+    """A scheduled callback, cancel() stops it from being called again (a call that is already running finishes)."""
+    __slots__ = ("function", "args", "kwargs", "interval", "remaining", "_cancelled", "_running", "_scheduler")
+
+    def __init__(self, scheduler: "TimerScheduler", function: _Callable, args: tuple, kwargs: dict, interval: int,
+                 iterations: int):
+        self.function, self.args, self.kwargs = function, args, kwargs
+        self.interval = interval  # In nanoseconds
+        self.remaining = iterations  # Negative means forever
+        self._cancelled = self._running = False
+        self._scheduler = scheduler
+
+    def cancel(self) -> "TimerHandle":
+        with self._scheduler._condition:
+            self._cancelled = True
+            self._scheduler._condition.notify()
+        return self
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    @property
+    def active(self) -> bool:
+        """If the callback is still going to be called or is running right now."""
+        return self._running or (not self._cancelled and self.remaining != 0)
+
+    def _call(self):
+        if self._cancelled:  # Cancelled while waiting for a worker
+            return
+        self._running = True
+        try:
+            self.function(*self.args, **self.kwargs)
+        except Exception as e:
+            print(f"Error in scheduled callback: {e}")
+        finally:
+            self._running = False
+
+
+class TimerScheduler:
+    """Calls callbacks at their deadlines from one thread that sleeps on a condition until the earliest deadline in a
+    min-heap, the callbacks themselves run on at most max_workers worker threads.
+    All threads are only alive while something is scheduled, so a pending callback keeps the program running like a
+    thread of its own would have."""
+
+    def __init__(self, max_workers: _Optional[int] = None):
+        self.max_workers = max_workers or min(32, (_os.cpu_count() or 1) + 4)
+        self._heap: _List[_Tuple[int, int, TimerHandle]] = []
+        self._order = _itertools.count()  # Equal deadlines are called in the order they were scheduled
+        self._condition = _threading.Condition()
+        self._thread: _Optional[_threading.Thread] = None
+        self._jobs = _queue.SimpleQueue()
+        self._workers = self._idle_workers = 0
+
+    def schedule(self, delay: _Union[float, int], function: _Callable, args: tuple = (),
+                 kwargs: _Optional[dict] = None, interval: _Optional[_Union[float, int]] = None,
+                 iterations: int = 1) -> TimerHandle:
+        """Calls function after delay seconds and then every interval (default delay) seconds, iterations times in
+        total (negative for forever)."""
+        interval = delay if interval is None else interval
+        handle = TimerHandle(self, function, args, kwargs or {}, int(interval * 1e9), iterations)
+        if iterations == 0:
+            return handle
+        with self._condition:
+            _heapq.heappush(self._heap, (_perf_counter_ns() + int(delay * 1e9), next(self._order), handle))
+            if self._thread is None:
+                self._thread = _threading.Thread(target=self._run, name="TimerScheduler")
+                self._thread.start()
+            self._condition.notify()
+        return handle
+
+    @property
+    def pending(self) -> int:
+        with self._condition:
+            return sum(not handle.cancelled for *_, handle in self._heap)
+
+    def _run(self):
+        heap, condition = self._heap, self._condition
+        with condition:
+            while True:
+                while heap and heap[0][2].cancelled:
+                    _heapq.heappop(heap)
+                if not heap:
+                    break
+                deadline, order, handle = heap[0]
+                remaining = deadline - _perf_counter_ns()
+                if remaining > 0:
+                    condition.wait(remaining / 1e9)
+                    continue
+                if not handle._running:  # A periodic callback that's still running skips this call
+                    handle.remaining -= 1
+                    self._submit(handle)
+                if handle.remaining != 0:
+                    next_deadline = max(deadline + handle.interval, _perf_counter_ns())
+                    _heapq.heapreplace(heap, (next_deadline, order, handle))
+                else:
+                    _heapq.heappop(heap)
+            self._thread = None
+            for _ in range(self._workers):  # Queued behind the remaining jobs, so those still get done
+                self._jobs.put(None)
+            self._jobs = _queue.SimpleQueue()  # Workers started later never see the old workers' stop signals
+            self._workers = self._idle_workers = 0
+
+    def _submit(self, handle: TimerHandle):
+        self._jobs.put(handle)
+        if self._idle_workers:
+            self._idle_workers -= 1
+        elif self._workers < self.max_workers:
+            self._workers += 1
+            _threading.Thread(target=self._work, args=(self._jobs,),
+                              name=f"TimerScheduler-worker-{self._workers}").start()
+
+    def _work(self, jobs: _queue.SimpleQueue):
+        while True:
+            handle = jobs.get()
+            if handle is None:
+                return
+            handle._call()
+            with self._condition:
+                if jobs is self._jobs and jobs.empty():
+                    self._idle_workers += 1
+
+
+_SCHEDULER: _Optional[TimerScheduler] = None
+
+
+def get_scheduler() -> TimerScheduler:
+    """The scheduler all TimidTimers share."""
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        with _LOCK_CREATION:
+            if _SCHEDULER is None:
+                _SCHEDULER = TimerScheduler()
+    return _SCHEDULER
+
+
 class TimidTimer:
-    """If a time value is not specified as something specific, it's in seconds."""
-    EMPTY = (0, 0, 0, None)
-
-    def __init__(self, start_at: _Union[float, int] = 0, start_now: bool = True):
-        self._fires: _List[_Tuple[_Optional[_threading.Thread], _Optional[_threading.Event]]] = []
-        self._times: _List[_Optional[_Tuple[
-                        _Union[float, int]], _Union[float, int], _Union[float, int], _Optional[_threading.Lock]]] = []
-        self._tick_tocks: _List[_List[_Union[float, int, _Tuple[_Union[float, int], _Union[float, int]]]]] = []
+    """If a time value is not specified as something specific, it's in seconds.
+    Internally everything is integer nanoseconds, kept in arrays with one slot per index. No locks are taken while only
+    the thread that created the timer uses it, the first call from another thread makes it take a lock from then on
+    (thread_safe=True does that from the start). To keep them cheap, tick() and tock() only check the thread when they
+    move a chunk of samples, so create timers that several threads tick or tock at once with thread_safe=True."""
+    __slots__ = ("_fires", "_starts", "_ends", "_pauses", "_pause_limits", "_tick_tocks", "_pending", "_thread_data",
+                 "_owner", "_lock")
+    EMPTY = _EMPTY
+
+    def __init__(self, start_at: _Union[float, int] = 0, start_now: bool = True, thread_safe: bool = False):
+        self._fires: _List[_Optional[TimerHandle]] = []
+        self._starts, self._ends, self._pauses, self._pause_limits = (_array("q") for _ in range(4))
+        self._tick_tocks: _List[_array] = []  # Flat (start, end) pairs per index
+        self._pending: _List[_List[int]] = []  # Pairs not yet moved into _tick_tocks, see _samples
         self._thread_data = _threading.local()
+        self._owner = _get_ident()
+        self._lock: _Optional[_threading.Lock] = _threading.Lock() if thread_safe else None
 
         if start_now:
             self._warmup()
             self.start(start_at=start_at)
 
-    @staticmethod
-    def _time() -> _Union[float, int]:
-        return _default_timer() * 1e9
+    _time = staticmethod(_time.perf_counter_ns)
 
-    def start(self, index: int = None, start_at: _Union[float, int] = 0) -> "TimidTimer":
-        start_time = self._time()
-        if index is None:
-            index = len(self._times)
-        if index < len(self._times) and self._times[index][2] != 0:
-            self.resume(index)
-            return self
-        while len(self._times) < index:  # Ensure the _times and _tick_tocks lists has enough elements
-            self._times.append(self.EMPTY)
-            self._tick_tocks.append([])
-        if index < len(self._times) and self._times[index] is self.EMPTY:  # Append or replace the elements
-            self._times[index] = (start_time + (start_at * 1e9), 0, 0, _threading.Lock())  # at the specified index
-            self._tick_tocks[index] = []
-        elif index == len(self._times):
-            self._times.append((start_time + (start_at * 1e9), 0, 0, _threading.Lock()))
-            self._tick_tocks.append([])
-        else:
-            raise Exception(f"A Timer already running on index {index}")
-        return self
+    def _shared_lock(self) -> _threading.Lock:
+        if self._lock is None:
+            with _LOCK_CREATION:
+                if self._lock is None:
+                    self._lock = _threading.Lock()
+        return self._lock
+
+    def _run(self, operation: _Callable, *args):
+        """Runs operation without a lock on the owning thread, with the lock once the timer is shared."""
+        if self._lock is None and _get_ident() == self._owner:
+            return operation(*args)
+        with self._shared_lock():
+            return operation(*args)
+
+    @staticmethod
+    def _as(return_type: _Optional[str], nanoseconds: int, default=None):
+        if return_type == "SmallTimeDiff":
+            return SmallTimeDiff(microseconds=nanoseconds / 1000)
+        elif return_type == "timedelta":
+            return _timedelta(microseconds=nanoseconds / 1000)
+        return default
 
     def _get_first_index(self):
-        for i, t in enumerate(self._times):
-            if t is not self.EMPTY:
+        for i, start in enumerate(self._starts):
+            if start != _EMPTY:
                 return i
         raise IndexError("No active timers.")
 
-    def pause(self, index: _Optional[int] = None, for_seconds: _Optional[_Union[float, int]] = None) -> "TimidTimer":
-        pause_time = self._time()
+    def _active_index(self, index: _Optional[int], state: str = "running") -> int:
         index = index or self._get_first_index()  # If it's 0 it just sets it to 0 so it's okay.
+        if index >= len(self._starts) or self._starts[index] == _EMPTY:
+            raise IndexError(f"Index {index} doesn't exist or is not {state}.")
+        return index
 
-        if index >= len(self._times) or self._times[index] is self.EMPTY:
-            raise IndexError(f"Index {index} doesn't exist or is not running.")
-
-        with self._times[index][-1]:
-            start, end, paused_time, lock = self._times[index]
-            if paused_time != 0:
-                raise ValueError(f"Timer on index {index} is already paused.")
-            self._times[index] = (start, end, pause_time, lock)
-            if for_seconds:
-                self._tick_tocks[index].append(for_seconds * 1e9)
-            else:
-                self._tick_tocks[index].append(float('inf'))
+    def start(self, index: int = None, start_at: _Union[float, int] = 0) -> "TimidTimer":
+        self._run(self._start, index, self._time() + int(start_at * 1e9))
         return self
 
-    def resume(self, index: _Optional[int] = None) -> "TimidTimer":
-        resumed_time = self._time()
-        index = index or self._get_first_index()  # If it's 0 it just sets it to 0 so it's okay.
+    def _start(self, index: _Optional[int], start_time: int):
+        starts = self._starts
+        if index is None:
+            index = len(starts)
+        if index < len(starts) and self._pauses[index] != 0:
+            self._resume(start_time, index)
+            return
+        while len(starts) <= index:  # Ensure the arrays have enough slots
+            starts.append(_EMPTY)
+            self._ends.append(0)
+            self._pauses.append(0)
+            self._pause_limits.append(_NO_LIMIT)
+            self._tick_tocks.append(_array("q"))
+            self._pending.append([])
+        if starts[index] != _EMPTY:
+            raise RuntimeError(f"A Timer already running on index {index}")
+        starts[index] = start_time
+        self._ends[index] = self._pauses[index] = 0
+        self._tick_tocks[index] = _array("q")
+        self._pending[index] = []
 
-        if index >= len(self._times) or self._times[index] is self.EMPTY:
-            raise IndexError(f"Index {index} doesn't exist or is not paused.")
+    def pause(self, index: _Optional[int] = None, for_seconds: _Optional[_Union[float, int]] = None) -> "TimidTimer":
+        self._run(self._pause, self._active_index(index), self._time(), for_seconds)
+        return self
+
+    def _pause(self, index: int, pause_time: int, for_seconds: _Optional[_Union[float, int]]):
+        if self._pauses[index] != 0:
+            raise ValueError(f"Timer on index {index} is already paused.")
+        self._pauses[index] = pause_time
+        self._pause_limits[index] = int(for_seconds * 1e9) if for_seconds else _NO_LIMIT
 
-        with self._times[index][-1]:
-            self._resume(resumed_time, index)
+    def resume(self, index: _Optional[int] = None) -> "TimidTimer":
+        self._run(self._resume, self._time(), self._active_index(index, "paused"))
         return self
 
-    def _resume(self, resumed_time, index: _Optional[int] = None):
-        start, end, paused_time, lock = self._times[index]
-        if paused_time != 0:
-            max_paused_timedelta = self._tick_tocks[index].pop(-1)
-            actual_paused_time = min((resumed_time - paused_time), max_paused_timedelta)
-            self._times[index] = (start + actual_paused_time, (end + actual_paused_time) if end > 0 else end, 0, lock)
-        else:
+    def _resume(self, resumed_time: int, index: int):
+        paused_time = self._pauses[index]
+        if paused_time == 0:
             raise ValueError(f"Timer on index {index} isn't paused.")
+        actual_paused_time = min(resumed_time - paused_time, self._pause_limits[index])
+        self._starts[index] += actual_paused_time
+        if self._ends[index] > 0:
+            self._ends[index] += actual_paused_time
+        self._pauses[index] = 0
 
     def stop(self, index: _Optional[int] = None) -> "TimidTimer":
-        end_time = self._time()
-        index = index or self._get_first_index()  # If it's 0 it just sets it to 0 so it's okay.
-        if index >= len(self._times) or self._times[index] is self.EMPTY:
-            raise IndexError(f"Index {index} doesn't exist or is not running.")
-
-        with self._times[index][-1]:
-            start, end, paused_time, lock = self._times[index]
-            if paused_time != 0:
-                self._resume(end_time, index)
-            start, _, __, ___ = self._times[index]
-            self._times[index] = (start, end_time, 0, lock)
+        self._run(self._stop, self._time(), self._active_index(index))
         return self
 
+    def _stop(self, end_time: int, index: int):
+        if self._pauses[index] != 0:
+            self._resume(end_time, index)
+        self._ends[index] = end_time
+
     def get(self, index: _Optional[int] = None, return_type: _Literal["timedelta", "SmallTimeDiff"] = "SmallTimeDiff"
             ) -> _Union[SmallTimeDiff, _timedelta]:
-        index = index or self._get_first_index()  # If it's 0 it just sets it to 0 so it's okay.
-        if index >= len(self._times) or self._times[index] is self.EMPTY:
-            raise IndexError(f"Index {index} doesn't exist or is not running.")
-        with self._times[index][-1]:
-            start, end, paused_time, _ = self._times[index]
-        max_paused_time = float('inf')
-        if paused_time != 0:
-            paused_time = self._time() - paused_time
-            max_paused_time = self._tick_tocks[-1]
-        elapsed_time = (end or self._time()) - min(max_paused_time, start + paused_time)
-        return SmallTimeDiff(microseconds=elapsed_time / 1000) if return_type == "SmallTimeDiff" \
-            else _timedelta(microseconds=elapsed_time / 1000)
+        return self._as(return_type, self._run(self._get, self._time(), self._active_index(index)))
+
+    def _get(self, now: int, index: int) -> int:
+        elapsed_time = (self._ends[index] or now) - self._starts[index]
+        if self._pauses[index] != 0:
+            elapsed_time -= min(now - self._pauses[index], self._pause_limits[index])
+        return elapsed_time
 
     def end(self, index: _Optional[int] = None,
             return_type: _Literal["timedelta", "SmallTimeDiff", None] = "SmallTimeDiff"
             ) -> _Union[SmallTimeDiff, _timedelta, "TimidTimer"]:
         end_time = self._time()
-        index = index or self._get_first_index()  # If it's 0 it just sets it to 0 so it's okay.
-        if index >= len(self._times) or self._times[index] is self.EMPTY:
-            raise IndexError(f"Index {index} doesn't exist or is not running.")
-        with self._times[index][-1]:
-            start, _, paused_time, __ = self._times[index]
-            if paused_time != 0:
-                self._resume(end_time, index)
-            start, __, ___, ____ = self._times[index]
-            self._times[index] = self.EMPTY
-            self._tick_tocks[index] = []
-        if return_type == "SmallTimeDiff":
-            elapsed_time = end_time - start
-            return SmallTimeDiff(microseconds=elapsed_time / 1000)
-        elif return_type == "timedelta":
-            elapsed_time = end_time - start
-            return SmallTimeDiff(microseconds=elapsed_time / 1000)
-        return self
+        return self._as(return_type, self._run(self._end, end_time, self._active_index(index)), self)
+
+    def _end(self, end_time: int, index: int) -> int:
+        if self._pauses[index] != 0:
+            self._resume(end_time, index)
+        elapsed_time = end_time - self._starts[index]
+        self._starts[index] = _EMPTY
+        self._ends[index] = 0
+        self._tick_tocks[index] = _array("q")
+        self._pending[index] = []
+        return elapsed_time
 
     def tick(self, index: _Optional[int] = None,
              return_type: _Literal["timedelta", "SmallTimeDiff", None] = "SmallTimeDiff"
              ) -> _Union[SmallTimeDiff, _timedelta, "TimidTimer"]:
         """Return how much time has passed till the start. (Could also be called elapsed)"""
         tick_time = self._time()
-        index = index or self._get_first_index()  # If it's 0 it just sets it to 0 so it's okay.
-        if index >= len(self._times) or self._times[index] is self.EMPTY:
-            raise IndexError(f"Index {index} doesn't exist or is not running.")
-        with self._times[index][-1]:
-            start, _, paused_time, __ = self._times[index]
-            if tick_time - start < 0:
+        starts = self._starts
+        if self._lock is None and not index and starts and starts[0] != _EMPTY and self._pauses[0] == 0:
+            start = starts[0]  # The common case, inlined as this is the hot path
+            if tick_time < start:
                 raise ValueError(f"Please don't tick when the timer is paused.")
-            if paused_time != 0:
-                self._resume(tick_time, index)
-            self._tick_tocks[index].append((start, tick_time))
-        if return_type == "SmallTimeDiff":
-            return SmallTimeDiff(microseconds=(tick_time - start) / 1000)
-        elif return_type == "timedelta":
-            return _timedelta(microseconds=(tick_time - start) / 1000)
-        return self
+            pending = self._pending[0]
+            pending += (start, tick_time)
+            if len(pending) >= _SAMPLE_CHUNK:
+                self._run(self._samples, 0)
+            elapsed_time = tick_time - start
+        elif self._lock is None and _get_ident() == self._owner:
+            elapsed_time = self._tick(tick_time, index)
+        else:
+            with self._shared_lock():
+                elapsed_time = self._tick(tick_time, index)
+        if return_type is None:
+            return self
+        return self._as(return_type, elapsed_time)
+
+    def _tick(self, tick_time: int, index: _Optional[int]) -> int:
+        index = 0 if not index and self._starts and self._starts[0] != _EMPTY else self._active_index(index)
+        if self._pauses[index] != 0:
+            self._resume(tick_time, index)
+        start = self._starts[index]
+        if tick_time < start:
+            raise ValueError(f"Please don't tick when the timer is paused.")
+        self._add_sample(index, start, tick_time)
+        return tick_time - start
 
     def tock(self, index: _Optional[int] = None,
              return_type: _Literal["timedelta", "SmallTimeDiff", None] = "SmallTimeDiff"
              ) -> _Union[SmallTimeDiff, _timedelta, "TimidTimer"]:
         """Returns how much time has passed till the last tock. (Could also be called round/lap/split)"""
         tock_time = self._time()
-        index = index or self._get_first_index()  # If it's 0 it just sets it to 0 so it's okay.
-        if index >= len(self._times) or self._times[index] is self.EMPTY:
-            raise IndexError(f"Index {index} doesn't exist or is not running.")
-        with self._times[index][-1]:
-            start, end, paused_time, lock = self._times[index]
-
-            if paused_time != 0:
-                self._resume(tock_time, index)
-                start, end, _, __ = self._times[index]
-            last_time = end or start
-            if tock_time - last_time < 0:
+        starts = self._starts
+        if self._lock is None and not index and starts and starts[0] != _EMPTY and self._pauses[0] == 0:
+            ends = self._ends
+            last_time = ends[0] or starts[0]
+            if tock_time < last_time:
                 raise ValueError(f"Please don't tock when the timer is paused.")
-            end = tock_time
-            self._times[index] = (start, end, 0, lock)
-            self._tick_tocks[index].append((last_time, end))
-        if return_type == "SmallTimeDiff":
-            return SmallTimeDiff(microseconds=(end - last_time) / 1000)
-        elif return_type == "timedelta":
-            return _timedelta(microseconds=(end - last_time) / 1000)
-        return self
+            ends[0] = tock_time
+            pending = self._pending[0]
+            pending += (last_time, tock_time)
+            if len(pending) >= _SAMPLE_CHUNK:
+                self._run(self._samples, 0)
+            elapsed_time = tock_time - last_time
+        elif self._lock is None and _get_ident() == self._owner:
+            elapsed_time = self._tock(tock_time, index)
+        else:
+            with self._shared_lock():
+                elapsed_time = self._tock(tock_time, index)
+        if return_type is None:
+            return self
+        return self._as(return_type, elapsed_time)
+
+    def _tock(self, tock_time: int, index: _Optional[int]) -> int:
+        index = 0 if not index and self._starts and self._starts[0] != _EMPTY else self._active_index(index)
+        if self._pauses[index] != 0:
+            self._resume(tock_time, index)
+        last_time = self._ends[index] or self._starts[index]
+        if tock_time < last_time:
+            raise ValueError(f"Please don't tock when the timer is paused.")
+        self._ends[index] = tock_time
+        self._add_sample(index, last_time, tock_time)
+        return tock_time - last_time
+
+    def _add_sample(self, index: int, start: int, end: int):
+        pending = self._pending[index]
+        pending += (start, end)
+        if len(pending) >= _SAMPLE_CHUNK:
+            self._samples(index)
+
+    def _samples(self, index: int) -> _array:
+        """All (start, end) pairs of index, appending to a list and moving it into the array in chunks is cheaper than
+        growing the array by every pair."""
+        pending = self._pending[index]
+        if pending:
+            self._tick_tocks[index].fromlist(pending)
+            pending.clear()
+        return self._tick_tocks[index]
+
+    def _recorded(self, index: int) -> _Tuple[int, int]:
+        """Total nanoseconds and count of all ticks and tocks, plus the time till a later stop."""
+        samples = self._samples(index)
+        total, count = sum(samples[1::2]) - sum(samples[::2]), len(samples) // 2
+        end = self._ends[index]
+        last_end = samples[-1] if samples else 0
+        if end != 0 and end != last_end:
+            total += end - (last_end or self._starts[index])
+            count += 1
+        return total, count
 
     def tally(self, *indices: _Optional[int], return_type: _Literal["timedelta", "SmallTimeDiff"] = "SmallTimeDiff"
               ) -> _Union[SmallTimeDiff, _timedelta]:
         """Return the total time recorded across all ticks and tocks."""
-        indices = indices or [self._get_first_index()]  # If it's 0 it just sets it to 0 so it's okay.
-        total_time = 0
+        return self._as(return_type, self._run(self._recorded_sum, indices)[0])
 
+    def _recorded_sum(self, indices) -> _Tuple[int, int]:
+        indices = indices or [self._get_first_index()]  # If it's 0 it just sets it to 0 so it's okay.
+        total_time = total_count = 0
         for index in indices:
-            if index >= len(self._times) or self._times[index] is self.EMPTY:
+            if index >= len(self._starts) or self._starts[index] == _EMPTY:
                 continue
-            with self._times[index][-1]:
-                start, end, _, __ = self._times[index]
-                tick_tocks = self._tick_tocks[index].copy()
-            if end != 0 and len(tick_tocks) > 0:
-                tick_tocks.append((tick_tocks[-1][1], end))
-            elif end != 0:
-                tick_tocks.append((start, end))
-            total_time += sum((end - start for start, end in tick_tocks))
-
-        return SmallTimeDiff(microseconds=total_time / 1000) if return_type == "SmallTimeDiff" \
-            else _timedelta(microseconds=total_time / 1000)
+            time_ns, count = self._recorded(index)
+            total_time += time_ns
+            total_count += count
+        return total_time, total_count
 
     def average(self, *indices: _Optional[int], return_type: _Literal["timedelta", "SmallTimeDiff"] = "SmallTimeDiff"
                 ) -> _Union[SmallTimeDiff, _timedelta]:
         """Calculate the average time across all recorded ticks and tocks."""
-        indices = indices or [self._get_first_index()]  # If it's 0 it just sets it to 0 so it's okay.
-        total_tocks = 0
-
-        for index in indices:
-            if index >= len(self._times) or self._times[index] is self.EMPTY:
-                continue
-            with self._times[index][-1]:
-                _, end, __, ___ = self._times[index]
-                tick_tocks = self._tick_tocks[index].copy()
-            total_tocks += len(tick_tocks) + (1 if end != 0 and end != ([(0, 0)] + tick_tocks)[-1][1] else 0)
-
-        if total_tocks == 0:
-            return SmallTimeDiff(0) if return_type == "SmallTimeDiff" else _timedelta(0)
-
-        return self.tally(*indices, return_type=return_type) / total_tocks
+        total_time, total_count = self._run(self._recorded_sum, indices)
+        return self._as(return_type, total_time // total_count if total_count else 0)
 
     def show_tick_tocks(self, index: _Optional[int] = None, format_to: int = TimeFormat.SECONDS):
         index = index or self._get_first_index()  # If it's 0 it just sets it to 0 so it's okay.
         print("Tick Tock times:")
-        with self._times[index][-1]:
-            my_tick_tocks = self._tick_tocks[index].copy()
-            _, __, is_paused, _ = self._times[index]
-        if is_paused:
-            my_tick_tocks.pop(-1)
-        for i, (start, end) in enumerate(my_tick_tocks, start=1):
+        samples = self._run(lambda: self._samples(index).__copy__())
+        for i, (start, end) in enumerate(zip(samples[::2], samples[1::2]), start=1):
             td = _timedelta(microseconds=(end - start) / 1000)
             print(f"Lap {i}: {TimeFormat.get_static_readable(td, format_to)}")
 
     def get_readable(self, index: _Optional[int] = None, format_to: int = TimeFormat.SECONDS) -> str:
         return TimeFormat.get_static_readable(self.get(index), format_to)
 
+    def _reset(self):
+        self._starts, self._ends, self._pauses, self._pause_limits = (_array("q") for _ in range(4))
+        self._tick_tocks = []
+        self._pending = []
+
     def _warmup(self, rounds: int = 3):
         for _ in range(rounds):
             self.start()
             self.end()
-        self._times = []
-        self._tick_tocks = []
+        self._reset()
+
+    @classmethod
+    def measure_overhead(cls, rounds: int = 100_000) -> dict:
+        """Nanoseconds per call of the clock and of tick()/tock() (returning the timer and returning a SmallTimeDiff),
+        without and with the lock a shared timer takes."""
+        def per_call(func) -> float:
+            start = _perf_counter_ns()
+            for _ in range(rounds):
+                func()
+            return (_perf_counter_ns() - start) / rounds
+
+        results = {"clock": per_call(cls._time)}
+        for name, timer in (("", cls()), ("_locked", cls(thread_safe=True))):
+            results[f"tick{name}"] = per_call(lambda: timer.tick(return_type=None))
+            results[f"tock{name}"] = per_call(lambda: timer.tock(return_type=None))
+            results[f"tock_small_time_diff{name}"] = per_call(timer.tock)
+        loop = per_call(lambda: None)  # The loop and the lambda call, both aren't part of what's measured
+        return {name: max(0.0, ns - loop) for name, ns in results.items()}
 
     def countdown(self, seconds: _Union[float, int], callback: _Callable = print, args: tuple = (),
                   kwargs: dict = None):
@@ -522,8 +961,12 @@ class TimidTimer:
 
     def save_state(self) -> bytes:
         """Saves the state of all timers, threads aren't possible as I can't pickle the reference to the function."""
+        self._run(lambda: [self._samples(index) for index in range(len(self._tick_tocks))])
         state = {
-            "_times": self._times,
+            "_starts": self._starts,
+            "_ends": self._ends,
+            "_pauses": self._pauses,
+            "_pause_limits": self._pause_limits,
             "_tick_tocks": self._tick_tocks,
         }
         return _pickle.dumps(state)
@@ -531,126 +974,87 @@ class TimidTimer:
     def load_state(self, state_bytes: bytes):
         """Loads the state of all timers, threads aren't possible as I can't pickle the reference to the function."""
         state = _pickle.loads(state_bytes)
-        self._times = state["_times"]
+        self._starts, self._ends = state["_starts"], state["_ends"]
+        self._pauses, self._pause_limits = state["_pauses"], state["_pause_limits"]
         self._tick_tocks = state["_tick_tocks"]
+        self._pending = [[] for _ in self._tick_tocks]
 
     @classmethod
     def setup_timer_func(cls, func: _Callable, to_nanosecond_multiplier: _Union[float, int]) -> _Type["TimidTimer"]:
+        if to_nanosecond_multiplier == 1:
+            time_func = staticmethod(func)
+        else:
+            time_func = staticmethod(lambda: int(func() * to_nanosecond_multiplier))
         NewClass = type('TimidTimerModified', (cls,), {
-            '_time': lambda self=None: func() * to_nanosecond_multiplier
+            '__slots__': (),
+            '_time': time_func
         })
         return NewClass
 
     @classmethod
-    def _trigger(cls, interval: _Union[float, int], function, args: tuple, kwargs: dict, iterations: int,
-                 stop_event: _threading.Event = _threading.Event()):
-        cls.wait_static(interval)
-        while not stop_event.is_set():
-            if iterations == 0:
-                break
-            try:
-                function(*args, **kwargs)
-            except Exception as e:
-                print(f"Error in _trigger thread: {e}")
-            cls.wait_static(interval)
-            iterations -= 1
-
-    @classmethod
-    def _trigger_ms(cls, interval_ms: _Union[float, int], function, args: tuple, kwargs: dict, iterations: int,
-                    stop_event: _threading.Event = _threading.Event()):
-        cls.wait_ms_static(interval_ms)
-        while not stop_event.is_set():
-            if iterations == 0:
-                break
-            try:
-                function(*args, **kwargs)
-            except Exception as e:
-                print(f"Error in _trigger thread: {e}")
-            cls.wait_ms_static(interval_ms)
-            iterations -= 1
+    def schedule(cls, delay: _Union[float, int], function: _Callable, args: tuple = (),
+                 kwargs: _Optional[dict] = None, interval: _Optional[_Union[float, int]] = None,
+                 iterations: int = 1) -> TimerHandle:
+        """Schedules function on the shared scheduler and returns the handle to cancel it with."""
+        return get_scheduler().schedule(delay, function, args, kwargs, interval, iterations)
 
     @classmethod
     def single_shot(cls, wait_time: _Union[float, int], function: _Callable, args: tuple = (),
                     kwargs: _Optional[dict] = None) -> _Type["TimidTimer"]:
-        if kwargs is None:
-            kwargs = {}
-        _threading.Thread(target=cls._trigger, args=(wait_time, function, args, kwargs, 1)).start()
+        cls.schedule(wait_time, function, args, kwargs)
         return cls
 
     @classmethod
     def single_shot_ms(cls, wait_time_ms: _Union[float, int], function: _Callable, args: tuple = (),
                        kwargs: _Optional[dict] = None) -> _Type["TimidTimer"]:
-        if kwargs is None:
-            kwargs = {}
-        _threading.Thread(target=cls._trigger_ms, args=(wait_time_ms, function, args, kwargs, 1)).start()
+        cls.schedule(wait_time_ms / 1000, function, args, kwargs)
         return cls
 
     @classmethod
     def shoot(cls, interval: _Union[float, int], function: _Callable, args: tuple = (), kwargs: _Optional[dict] = None,
               iterations: int = 1) -> _Type["TimidTimer"]:
-        if kwargs is None:
-            kwargs = {}
-        _threading.Thread(target=cls._trigger, args=(interval, function, args, kwargs, iterations)).start()
+        cls.schedule(interval, function, args, kwargs, iterations=iterations)
         return cls
 
     @classmethod
     def shoot_ms(cls, interval_ms: _Union[float, int], function: _Callable, args: tuple = (),
                  kwargs: _Optional[dict] = None, iterations: int = 1) -> _Type["TimidTimer"]:
-        if kwargs is None:
-            kwargs = {}
-        _threading.Thread(target=cls._trigger_ms, args=(interval_ms, function, args, kwargs, iterations)).start()
+        cls.schedule(interval_ms / 1000, function, args, kwargs, iterations=iterations)
         return cls
 
     def fire(self, interval: _Union[float, int], function: _Callable, args: tuple = (), kwargs: _Optional[dict] = None,
              index: int = None) -> "TimidTimer":
-        if kwargs is None:
-            kwargs = {}
+        """Calls function every interval seconds until stop_fire is called for it, fire_handle returns its handle."""
+        handle = self.schedule(interval, function, args, kwargs, iterations=-1)
         if index is None:
             index = len(self._fires)
         while len(self._fires) < index:
-            self._fires.append((None, None))
-
-        event = _threading.Event()
-        thread = _threading.Thread(target=self._trigger, args=(interval, function, args, kwargs, -1, event))
-
-        if index < len(self._fires) and self._fires[index] == (None, None):
-            self._fires[index] = (thread, event)
+            self._fires.append(None)
+        if index < len(self._fires) and self._fires[index] is None:
+            self._fires[index] = handle
         else:
-            self._fires.insert(index, (thread, event))
-        thread.start()
+            self._fires.insert(index, handle)
         return self
 
     def fire_ms(self, interval_ms: _Union[float, int], function: _Callable, args: tuple = (),
                 kwargs: _Optional[dict] = None, index: int = None) -> "TimidTimer":
-        if kwargs is None:
-            kwargs = {}
-        if index is None:
-            index = len(self._fires)
-        while len(self._fires) < index:
-            self._fires.append((None, None))
+        return self.fire(interval_ms / 1000, function, args, kwargs, index)
 
-        event = _threading.Event()
-        thread = _threading.Thread(target=self._trigger_ms, args=(interval_ms, function, args, kwargs, -1, event))
-
-        if index < len(self._fires) and self._fires[index] == (None, None):
-            self._fires[index] = (thread, event)
-        else:
-            self._fires.insert(index, (thread, event))
-        thread.start()
-        return self
+    def fire_handle(self, index: _Optional[int] = None) -> TimerHandle:
+        return self._fires[-1 if index is None else index]
 
     def stop_fire(self, index: _Optional[int] = None, amount: _Optional[int] = None) -> "TimidTimer":
         if amount is None:
             amount = 1
         for _ in range(amount):
-            thread, event = self._fires.pop(index or 0)
-            event.set()
-            thread.join()
+            handle = self._fires.pop(index or 0)
+            if handle is not None:
+                handle.cancel()
         return self
 
-    def warmup_fire(self, rounds: int = 300) -> "TimidTimer":
-        for _ in range(rounds):
-            self.wait_ms_static(1)
+    def warmup_fire(self, rounds: int = 50) -> "TimidTimer":
+        """Calibrates the precise waits with rounds samples (otherwise done on their first use)."""
+        calibrate_sleep(rounds)
         return self
 
     def wait(self, seconds: int = 0) -> "TimidTimer":
@@ -690,19 +1094,64 @@ class TimidTimer:
 
     @classmethod
     def wait_ms_static(cls, milliseconds: int = 0) -> _Type["TimidTimer"]:
-        wanted_time = cls._time() + (milliseconds * 1e+6)
-        while cls._time() < wanted_time:
-            if wanted_time - cls._time() > 1_000_000:  # 3_000_000
-                _time.sleep(0.001)
-            else:
-                continue
+        """A precise wait, see wait_until."""
+        wait_until(_perf_counter_ns() + int(milliseconds * 1e6))
+        return cls
+
+    @classmethod
+    async def _sleep_until(cls, deadline: int):
+        remaining = deadline - _perf_counter_ns()
+        if remaining > _ASYNC_SPIN_MARGIN:
+            await _asyncio.sleep((remaining - _ASYNC_SPIN_MARGIN) / 1e9)
+        while _perf_counter_ns() < deadline:
+            await _asyncio.sleep(0)  # Lets the other tasks run while waiting for the deadline
+
+    @classmethod
+    async def sleep_precise(cls, milliseconds: _Union[float, int] = 0) -> _Type["TimidTimer"]:
+        """Like asyncio.sleep but sub-millisecond accurate, the last stretch is spent yielding to the event loop."""
+        await cls._sleep_until(_perf_counter_ns() + int(milliseconds * 1e6))
         return cls
 
+    @classmethod
+    async def aiter_interval(cls, period: _Union[float, int], count: _Union[int, _Literal["inf"]] = "inf",
+                             timer: _Optional["TimidTimer"] = None, index: _Optional[int] = None
+                             ) -> _AsyncGenerator[int, None]:
+        """Yields the tick number every period seconds. Deadlines are fixed to the start, so slow loop bodies don't
+        add up to drift, ticks that were missed completely are skipped. If a timer is passed it is tocked on index
+        every tick, so its tally and average show the real intervals."""
+        period_ns = int(period * 1e9)
+        start = _perf_counter_ns()
+        tick = 1
+        while count == "inf" or tick <= count:
+            await cls._sleep_until(start + tick * period_ns)
+            if timer is not None:
+                timer.tock(index, return_type=None)
+            yield tick
+            tick = max(tick + 1, (_perf_counter_ns() - start) // period_ns + 1)
+
+    @classmethod
+    def loop_single_shot(cls, wait_time: _Union[float, int], function: _Callable, args: tuple = (),
+                         kwargs: _Optional[dict] = None, loop: _Optional[_asyncio.AbstractEventLoop] = None
+                         ) -> _asyncio.TimerHandle:
+        """single_shot on the event loop (the running one if none is passed) instead of a thread, using loop.call_at.
+        Coroutine functions are run as a task."""
+        if kwargs is None:
+            kwargs = {}
+        loop = loop or _asyncio.get_running_loop()
+
+        def callback():
+            result = function(*args, **kwargs)
+            if _asyncio.iscoroutine(result):
+                loop.create_task(result)
+        return loop.call_at(loop.time() + wait_time, callback)
+
     @classmethod
     def complexity(cls, func: _Callable, input_generator: _Union[_Iterable[_Tuple[_Tuple[_Any, ...], dict]],
                                                                  _Generator[_Tuple[_Tuple[_Any, ...], dict], None, None]
                                                                  ],
-                   matplotlib_pyplt=None) -> str:
+                   matplotlib_pyplt=None, repeats: int = 5, criterion: _Literal["aic", "bic"] = "bic",
+                   processes: _Optional[int] = None, return_type: _Literal["str", "dict"] = "str"
+                   ) -> _Union[str, dict]:
         """
         Measures the execution time of a function over a range of input sizes and estimates the time complexity.
         Too little data points will lead to bigger error rates.
@@ -710,78 +1159,65 @@ class TimidTimer:
         The first argument/keyword argument you pass (in the generator) will be used as the x
         so you need to enable int conversion for that class.
 
+        Every size is timed repeats times, in a new random order of the sizes every round, and the median is used.
+        Every complexity class is fitted as time = a * f(N) + b with linear least squares on the relative error,
+        the class with the lowest AIC or BIC wins. Classes whose growth over the measured sizes isn't clearly above
+        the noise of the fit are left out, so noise doesn't make a constant function look like it grows.
+
         Parameters:
         func (Callable): The function to measure.
         input_generator (Iterable): A generator that yields increasing input sizes (e.g., range).
         matplotlib_pyplt: The pyplot class from the matplotlib library.
+        repeats (int): How often every input size is measured.
+        criterion (str): "aic" or "bic", BIC penalizes the extra parameter harder.
+        processes (int): Measures the input sizes in a pool of this many processes, func and the inputs need to be
+            picklable for that. Every measurement is a job of its own and the jobs run in a random order, there are
+            never more processes than cores.
+        return_type (str): "dict" returns the fitted constants (in seconds) and the confidence (the Akaike/Schwarz
+            weight of the winner, 0 to 1) of every class as well.
 
         Returns:
         str: Estimated time complexity (e.g., "O(N)", "O(N^2)", etc.).
         """
-        input_sizes = []
-        times = []
-
-        for args, kwargs in input_generator:
-            # Start the timer
-            start_time = cls._time()
-
-            # Execute the function
-            func(*args, **kwargs)
-
-            # Stop the timer
-            end_time = cls._time()
-
-            # Calculate elapsed time in seconds
-            elapsed_time = (end_time - start_time) / 1e9
-
-            # Store the input size and the elapsed time if valid
-            if elapsed_time > 0:
-                input_sizes.append(int(args[0]) if args else (int(next(iter(kwargs))) if kwargs else 0))
-                times.append(elapsed_time)
+        if criterion not in ("aic", "bic"):
+            raise ValueError(f"Unknown criterion '{criterion}', use 'aic' or 'bic'")
+        inputs = list(input_generator)
+        if processes:
+            from concurrent.futures import ProcessPoolExecutor
+            jobs = [index for index in range(len(inputs)) for _ in range(repeats)]
+            _random.shuffle(jobs)  # Like _interleaved_median_times, so drift doesn't turn into a trend over N
+            # More processes than cores would time slice the measurements against each other, which slows the long
+            # ones down the most
+            with ProcessPoolExecutor(min(processes, _os.cpu_count() or 1)) as pool:
+                job_times = pool.map(_median_time, *zip(*((func, *inputs[index], 1) for index in jobs)))
+                input_times = [[] for _ in inputs]
+                for index, job_time in zip(jobs, job_times):
+                    input_times[index].append(job_time)
+            times = [_statistics.median(job_times) for job_times in input_times]
+        else:
+            times = _interleaved_median_times(func, inputs, repeats, cls._time)
+        input_sizes = [int(args[0]) if args else (int(next(iter(kwargs.values()))) if kwargs else 0)
+                       for args, _ in inputs]
 
         # Ensure there are no zero or negative times and input sizes
-        input_sizes = _np.array(input_sizes)
-        times = _np.array(times)
+        input_sizes = _np.array([size for size, t in zip(input_sizes, times) if t > 0], dtype=_np.float64)
+        times = _np.array([t for t in times if t > 0], dtype=_np.float64) / 1e9
 
         if len(input_sizes) == 0 or len(times) == 0:
             return "Insufficient data"
 
-        if _np.any(input_sizes <= 0) or _np.any(times <= 0):
+        if _np.any(input_sizes <= 0):
             raise ValueError("Input sizes and times must be positive")
 
-        # Define complexity functions
-        complexity_classes = {
-            "O(1)": lambda n, a: a * _np.ones_like(n),
-            "O(log N)": lambda n, a, b: a * _np.log(n) + b,
-            "O(N)": lambda n, a: a * n,
-            "O(N log N)": lambda n, a, b: a * n * _np.log(n) + b,
-            "O(N^2)": lambda n, a: a * n ** 2,
-            "O(N^3)": lambda n, a: a * n ** 3,
-            "O(sqrt(N))": lambda n, a: a * _np.sqrt(n),
-        }
-
-        best_fit = None
-        best_params = None
-        best_mse = _np.inf
-
-        for name, func in complexity_classes.items():
-            try:
-                # Use RANSAC to find the robust subset of data points
-                ransac = _RANSACRegressor()
-                input_sizes_reshaped = input_sizes.reshape(-1, 1)
-                ransac.fit(input_sizes_reshaped, times)
-                inlier_mask = ransac.inlier_mask_
-
-                # Fit the curve to the inliers only
-                popt, *_ = _curve_fit(func, input_sizes[inlier_mask], times[inlier_mask], maxfev=10000)
-                predictions = func(input_sizes, *popt)
-                mse = _np.mean((times - predictions) ** 2)
-                if mse < best_mse:
-                    best_mse = mse
-                    best_fit = name
-                    best_params = popt
-            except (RuntimeError, TypeError):
-                continue
+        models = _fit_complexity_classes(input_sizes, times)
+        if not models:
+            return "Insufficient data"
+        scores = _np.array([model[criterion] for model in models.values()])
+        weights = _np.exp(-(scores - scores.min()) / 2)
+        weights /= weights.sum()
+        for model, weight in zip(models.values(), weights):
+            model["confidence"] = float(weight)
+        best_fit = min(models, key=lambda name: models[name][criterion])
 
         if matplotlib_pyplt:
             plt = matplotlib_pyplt
@@ -789,22 +1225,65 @@ class TimidTimer:
             plt.scatter(input_sizes, times, label='Actual Times')
 
             # Plot the best fit curve
-            if best_fit:
-                fitted_func = complexity_classes[best_fit]
-                x_model = _np.linspace(min(input_sizes), max(input_sizes), 100)
-                y_model = fitted_func(x_model, *best_params)
-                plt.plot(x_model, y_model, label=f'Best Fit: {best_fit}')
+            x_model = _np.linspace(min(input_sizes), max(input_sizes), 100)
+            plt.plot(x_model, _COMPLEXITY_CLASSES[best_fit](x_model) @ models[best_fit]["coefficients"],
+                     label=f'Best Fit: {best_fit}')
 
             plt.xlabel('Input Size')
             plt.ylabel('Execution Time (s)')
             plt.title('Execution Time vs Input Size')
             plt.legend()
             plt.show()
-        else:
-            cls.wait_static(1.5)
 
+        if return_type == "dict":
+            return {"complexity": best_fit, "constants": models[best_fit]["constants"],
+                    "confidence": models[best_fit]["confidence"], "criterion": criterion,
+                    "models": {name: {key: value for key, value in model.items() if key != "coefficients"}
+                               for name, model in models.items()},
+                    "sizes": input_sizes.tolist(), "times": times.tolist()}
         return best_fit
 
+    @classmethod
+    def _time_loops(cls, func: _Callable, args: tuple, kwargs: dict, loops: int) -> int:
+        iterator = _itertools.repeat(None, loops)
+        start = cls._time()
+        for _ in iterator:
+            func(*args, **kwargs)
+        return cls._time() - start
+
+    @classmethod
+    def bench(cls, func: _Callable, *args, kwargs: _Optional[dict] = None, repeats: int = 7,
+              target_time: _Union[float, int] = 0.1, warmup: int = 1, loops: _Optional[int] = None,
+              disable_gc: bool = True, name: _Optional[str] = None) -> BenchResult:
+        """Benchmarks func(*args, **kwargs) like timeit does.
+        The loop count is raised (1, 2, 5, 10, 20, ...) until one repeat takes at least target_time seconds, unless
+        loops is passed. After warmup untimed repeats, every repeat times loops calls and the time the same loop takes
+        with a function that does nothing is subtracted, so the result is the time of func alone."""
+        if kwargs is None:
+            kwargs = {}
+        if repeats < 1:
+            raise ValueError("repeats needs to be at least 1")
+
+        gc_was_enabled = _gc.isenabled()
+        if disable_gc:
+            _gc.disable()
+        try:
+            if loops is None:
+                target, loops = int(target_time * 1e9), 1
+                for factor in _itertools.cycle((2, 2.5, 2)):  # 1, 2, 5, 10, 20, 50, ...
+                    if cls._time_loops(func, args, kwargs, loops) >= target:
+                        break
+                    loops = int(loops * factor)
+            for _ in range(warmup):
+                cls._time_loops(func, args, kwargs, loops)
+            overhead = min(cls._time_loops(_noop, args, kwargs, loops) for _ in range(3))
+            timings = [max(0, cls._time_loops(func, args, kwargs, loops) - overhead) / loops for _ in range(repeats)]
+        finally:
+            if gc_was_enabled:
+                _gc.enable()
+        return BenchResult(name or getattr(func, "__qualname__", repr(func)), timings, loops, overhead / loops,
+                           cls.__name__)
+
     @classmethod
     def time(cls, func):
         def wrapper(*args, **kwargs):
@@ -827,7 +1306,7 @@ class TimidTimer:
 
     def __enter__(self):
         entry_index = getattr(self._thread_data, 'entry_index', 0)
-        if entry_index > len(self._times):
+        if entry_index > len(self._starts):
             self.start(entry_index)
         self._thread_data.entry_index = entry_index
         return self
@@ -858,8 +1337,108 @@ ThreadTimerNS = TimidTimer.setup_timer_func(_time.thread_time_ns, 1)
 
 class DateTimeTimer(TimidTimer):
     """This is obviously a joke and should not be taken seriously as it isn't performant."""
-    def _time(self) -> float:
-        return _datetime.now().timestamp() * 1e9
+    __slots__ = ()
+
+    @staticmethod
+    def _time() -> int:
+        return int(_datetime.now().timestamp() * 1e9)
+
+
+def _fixed_step_wait_ms(milliseconds: float):
+    """The wait_ms_static loop the calibrated wait replaced, kept as the benchmark baseline."""
+    wanted_time = _perf_counter_ns() + milliseconds * 1e6
+    while _perf_counter_ns() < wanted_time:
+        if wanted_time - _perf_counter_ns() > 1_000_000:
+            _time.sleep(0.001)
+
+
+def _thread_per_timer(interval: float, function: _Callable, args: tuple, iterations: int, spin: bool = False
+                      ) -> _threading.Thread:
+    """How shoot() (a thread per timer sleeping with time.sleep) and shoot_ms() (the same, but spinning with the old
+    wait_ms_static loop) worked before the shared scheduler, kept as the benchmark baseline."""
+    def trigger():
+        for _ in range(iterations):
+            if spin:
+                _fixed_step_wait_ms(interval * 1000)
+            else:
+                _time.sleep(interval)
+            function(*args)
+    thread = _threading.Thread(target=trigger)
+    thread.start()
+    return thread
+
+
+def benchmark_scheduler(callbacks: int = 100, interval: float = 0.01, iterations: int = 20) -> dict:
+    """Runs callbacks periodic callbacks with a thread each, the way shoot() and shoot_ms() used to, and on the shared
+    scheduler and prints the timing error (how far the gaps between two calls are off from interval), the CPU time
+    used and the most threads alive."""
+    results = {}
+    for name in ("threads_sleep", "threads_spin", "scheduler"):
+        calls = [[] for _ in range(callbacks)]
+        peak_threads = [_threading.active_count()]
+        done = _threading.Event()
+        finished = [0]
+        finished_lock = _threading.Lock()
+
+        def callback(i: int):
+            calls[i].append(_perf_counter_ns())
+            peak_threads[0] = max(peak_threads[0], _threading.active_count())
+            if len(calls[i]) == iterations:
+                with finished_lock:
+                    finished[0] += 1
+                    if finished[0] == callbacks:
+                        done.set()
+
+        cpu_start, wall_start = _time.process_time(), _perf_counter_ns()
+        for i in range(callbacks):
+            if name != "scheduler":
+                _thread_per_timer(interval, callback, (i,), iterations, spin=name == "threads_spin")
+            else:
+                TimidTimer.schedule(interval, callback, (i,), iterations=iterations)
+        done.wait()
+        cpu_time, wall_time = _time.process_time() - cpu_start, (_perf_counter_ns() - wall_start) / 1e9
+        errors = sorted(abs(later - earlier - interval * 1e9) / 1e6
+                        for times in calls for earlier, later in zip(times, times[1:]))
+        results[name] = {"mean_error_ms": sum(errors) / len(errors), "p99_error_ms": errors[int(len(errors) * 0.99)],
+                         "cpu_s": cpu_time, "wall_s": wall_time, "peak_threads": peak_threads[0]}
+        print(f"{name}: error {results[name]['mean_error_ms']:.3f} ms mean, {results[name]['p99_error_ms']:.3f} ms "
+              f"p99, {cpu_time:.2f}s CPU in {wall_time:.2f}s, {peak_threads[0]} threads")
+        _time.sleep(0.05)  # Let the threads of this run exit
+    return results
+
+
+def benchmark_wait(milliseconds: _Iterable[float] = (0.1, 0.5, 2, 10), repeats: int = 200) -> dict:
+    """Waits repeats times for every duration with time.sleep, the old fixed step loop and the calibrated wait and
+    prints how late they were and how much CPU time they used per wait. The calibrated wait runs with the default
+    yield threshold, yielding for the whole spin (always_yield) and never yielding (never_yield), which shows what
+    the threshold trades: yielding lets other threads run during the spin, but on a busy core a yield can return a
+    time slice late.
+    The p99 is left out (None) below 100 repeats, where it would only be the maximum."""
+    waits = {"sleep": lambda ms: _time.sleep(ms / 1000), "fixed_step": _fixed_step_wait_ms,
+             "calibrated": lambda ms: wait_until(_perf_counter_ns() + int(ms * 1e6)),
+             "calibrated_always_yield": lambda ms: wait_until(_perf_counter_ns() + int(ms * 1e6), 0),
+             "calibrated_never_yield": lambda ms: wait_until(_perf_counter_ns() + int(ms * 1e6), 1 << 62)}
+    print("Calibration:", sleep_calibration())
+    results = {}
+    for duration in milliseconds:
+        for name, wait in waits.items():
+            lateness = []
+            cpu_start = _time.process_time()
+            for _ in range(repeats):
+                start = _perf_counter_ns()
+                wait(duration)
+                lateness.append((_perf_counter_ns() - start) / 1e6 - duration)
+            cpu_ms = (_time.process_time() - cpu_start) * 1000 / repeats
+            lateness.sort()
+            p99 = _percentile(lateness, 99) if repeats >= 100 else None
+            results[f"{name}_{duration}ms"] = {"mean_late_ms": sum(lateness) / repeats,
+                                               "median_late_ms": _percentile(lateness, 50), "p99_late_ms": p99,
+                                               "max_late_ms": lateness[-1], "cpu_ms": cpu_ms}
+            print(f"{duration} ms {name}: {sum(lateness) / repeats:.4f} ms late on average, "
+                  f"{_percentile(lateness, 50):.4f} ms median, "
+                  + (f"{p99:.4f} ms p99, " if p99 is not None else "")
+                  + f"{lateness[-1]:.4f} ms max, {cpu_ms:.3f} ms CPU per wait")
+    return results
 
 
 def local_test():
@@ -902,6 +1481,53 @@ def local_test():
         with TimidTimer().enter(index=1):
             timer.wait_ms_static(1)
 
+        for target in ("get", "tock"):
+            shared_timer = TimidTimer()
+            calls = 1 if target == "get" else _SAMPLE_CHUNK // 2  # tock only checks the thread once per chunk
+            worker = _threading.Thread(target=lambda: [getattr(shared_timer, target)() for _ in range(calls)])
+            worker.start()
+            worker.join()
+            if shared_timer._lock is None:
+                raise RuntimeError(f"Using the timer from another thread ({target}) didn't make it take a lock")
+        print("Overhead (ns per call):", TimidTimer.measure_overhead(10_000))
+
+        calls = []
+        handle = TimidTimer.schedule(0.01, calls.append, (1,), iterations=-1)
+        TimidTimer.wait_static(0.1)
+        handle.cancel()
+        TimidTimer.wait_static(0.01)  # A call that already started may still finish
+        count = len(calls)
+        TimidTimer.wait_static(0.05)
+        if not 5 <= count == len(calls) or handle.active:
+            raise RuntimeError(f"Scheduled callback ran {count} then {len(calls)} times")
+        benchmark_scheduler(20, 0.01, 10)
+        benchmark_wait((0.5, 2), 10)
+
+        fast = TimidTimer.bench(sum, range(100), target_time=0.01)
+        slow = TimidTimer.bench(sum, range(10_000), target_time=0.01)
+        print(fast, slow, sep="\n")
+        if BenchResult.from_json(fast.to_json()).to_dict() != fast.to_dict():
+            raise RuntimeError("BenchResult didn't survive a JSON round trip")
+        if slow.compare(fast)["verdict"] != "slower":
+            raise RuntimeError(f"Summing 10,000 numbers wasn't slower than summing 100: {slow.compare(fast)}")
+
+        async def async_test():
+            loop_timer = TimidTimer()
+            fired = []
+            TimidTimer.loop_single_shot(0.01, fired.append, (True,))
+            start = _perf_counter_ns()
+            await TimidTimer.sleep_precise(5)
+            print(f"sleep_precise(5) took {(_perf_counter_ns() - start) / 1e6:.3f} ms")
+
+            async def ticker():
+                async for tick in TimidTimer.aiter_interval(0.005, 5, timer=loop_timer):
+                    await _asyncio.sleep(0.002)
+            await _asyncio.gather(ticker(), ticker())
+            if not fired or loop_timer._lock is not None:
+                raise RuntimeError("The event loop timers didn't run on the loop")
+            print("Average of 10 ticks of 2 coroutines:", loop_timer.average())
+        _asyncio.run(async_test())
+
         print("Starting timer tests...")
         test_timer(TimidTimer, "Timid Timer")
         test_timer(TimeTimer, "Time Timer")
@@ -970,11 +1596,17 @@ def local_test():
             return ((tuple([n]), {}) for n in rng)
 
         # Test functions with the complexity method
-        print("Constant Time:", timer.complexity(constant_time, create_simple_input_generator(range(1, 100_001, 1000))))
+        constant = timer.complexity(constant_time, create_simple_input_generator(range(1, 100_001, 1000)))
+        print("Constant Time:", constant)
         print("Logarithmic Time:", timer.complexity(logarithmic_time, create_simple_input_generator(range(1, 100_001, 1000))))
-        print("Linear Time:", timer.complexity(linear_time, create_simple_input_generator(range(1, 100_001, 100))))
+        linear = timer.complexity(linear_time, create_simple_input_generator(range(1, 100_001, 100)))
+        print("Linear Time:", linear)
         print("Linearithmic Time:", timer.complexity(linearithmic_time, create_simple_input_generator(range(1, 100_001, 1000))))
-        # print("Quadratic Time:", timer.complexity(quadratic_time, create_simple_input_generator(range(1, 10_001, 100))))
+        quadratic = timer.complexity(quadratic_time, create_simple_input_generator(range(1, 1001, 25)))
+        print("Quadratic Time:", quadratic)
+        if (constant, linear, quadratic) != ("O(1)", "O(N)", "O(N^2)"):
+            raise ValueError(f"complexity estimated {constant}, {linear} and {quadratic} instead of O(1), O(N) and "
+                             f"O(N^2)")
         # print("Cubic Time:", timer.complexity(cubic_time, create_simple_input_generator(range(1, 2001, 200))))
         print("Square Root Time:", timer.complexity(square_root_time, create_simple_input_generator(range(1, 100_001, 100))))
 
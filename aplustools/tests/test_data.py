@@ -34,3 +34,4 @@ class TestAdvancedImagetools:
 class TestCompressor:
     def test_local(self):
         assert compressor.local_test()
+
@@ -0,0 +1,33 @@
+# Kept apart from test_data, which imports modules with optional dependencies (and the missing faker module),
+# so these are collected even when that import fails
+from aplustools.data import container_index, container_bench, bitbuffer, unien, unien_bench, varint
+
+
+class TestContainerIndex:
+    def test_local(self):
+        assert container_index.local_test()
+
+
+class TestContainerBench:
+    def test_local(self):
+        assert container_bench.local_test()
+
+
+class TestBitBuffer:
+    def test_local(self):
+        assert bitbuffer.local_test()
+
+
+class TestUnien:
+    def test_local(self):
+        assert unien.local_test()
+
+
+class TestUnienBench:
+    def test_local(self):
+        assert unien_bench.local_test()
+
+
+class TestVarint:
+    def test_local(self):
+        assert varint.local_test()